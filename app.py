@@ -1,247 +1,500 @@
-import json
-from fastapi import FastAPI, Form, status, BackgroundTasks
-from fastapi.responses import PlainTextResponse, JSONResponse
-import uuid
-import os
-import subprocess
-from time import sleep
-active_jobs = {}
-
-def run_engine_background(uuid, seed, input_path, output_folder, output_name, output_path_pdb, output_path_json, error_path):
-    
-    try:
-        process = subprocess.Popen([
-            "grapharna",
-            f"--input={input_path}",
-            f"--seed={seed}",
-            f"--output-folder={output_folder}",
-            f"--output-name={output_name}"
-        ])
-        
-        active_jobs[uuid] = process
-        return_code = process.wait()
-        
-        if return_code != 0:
-            raise Exception(f"GraphaRNA process exited with code {return_code}")
-        if not os.path.exists(output_path_pdb):
-            raise Exception("GraphaRNA finished but output PDB is missing")
-
-        if uuid not in active_jobs:
-            raise Exception("Job cancelled before Arena step")
-        process = subprocess.Popen([
-            "Arena",
-            output_path_pdb,
-            output_path_pdb,
-            "5"
-        ], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        active_jobs[uuid] = process
-        stdout, stderr = process.communicate()
-
-        if process.returncode != 0:
-            raise Exception(f"Arena failed: {stderr.decode()}")
-
-        process = subprocess.Popen([
-            "annotator",
-            "--json", str(output_path_json),
-            "--extended", str(output_path_pdb)
-        ], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        active_jobs[uuid] = process
-        stdout, stderr = process.communicate()
-        if process.returncode != 0:
-            raise Exception(f"Annotator failed: {stderr.decode()}")
-
-    except subprocess.CalledProcessError as e:
-        error_data = {"error": "Process failed", "cmd": e.cmd, "stderr": e.stderr.decode() if e.stderr else ""}
-        with open(error_path, "w") as f:
-            json.dump(error_data, f)
-        print(f"Background task failed: {e}")
-
-    except Exception as e:
-        error_data = {"error": str(e)}
-        with open(error_path, "w") as f:
-            json.dump(error_data, f)
-        print(f"Background task failed: {e}")
-    finally:
-        if uuid in active_jobs:
-            del active_jobs[uuid]
-
-app = FastAPI()
-
-@app.get("/")
-def root():
-    return {"status": "OK"}
-
-    
-@app.post("/run")
-async def run_grapharna(
-    background_tasks: BackgroundTasks,
-    uuid: str = Form(...), 
-    seed: int = Form(42)
-):
-    print(f"Incoming request with uuid: {uuid} and seed: {seed}")
-    
-    input_path = f"/shared/samples/engine_inputs/{uuid}.dotseq"
-    output_folder = "/shared/samples/engine_outputs"
-    output_name = f"{uuid}_{seed}"
-    
-    output_path_pdb = os.path.join(output_folder, output_name + ".pdb")
-    output_path_json = os.path.join(output_folder, output_name + ".json")
-    error_path = os.path.join(output_folder, output_name + ".err")
-
-    if not os.path.exists(input_path):
-        return JSONResponse(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            content={"error": f"Input file {input_path} does not exist."}
-        )
-
-    if os.path.exists(error_path): os.remove(error_path)
-    if os.path.exists(output_path_json): os.remove(output_path_json)
-
-    background_tasks.add_task(
-        run_engine_background,
-        uuid, seed, input_path, output_folder, output_name, 
-        output_path_pdb, output_path_json, error_path
-    )
-
-    return JSONResponse(
-        status_code=status.HTTP_202_ACCEPTED,
-        content={
-            "message": "Job accepted", 
-            "status_endpoint": f"/status/{uuid}"
-        }
-    )
-
-@app.get("/status/{uuid}")
-async def check_status(uuid: str, seed: int):
-    output_folder = "/shared/samples/engine_outputs"
-    output_name = f"{uuid}_{seed}"
-    
-    output_path_pdb = os.path.join(output_folder, output_name + ".pdb")
-    output_path_json = os.path.join(output_folder, output_name + ".json")
-    error_path = os.path.join(output_folder, output_name + ".err")
-    print(f"output_path_pdb: {output_path_pdb}, output_path_json: {output_path_json}, error_path: {error_path}")
-    if os.path.exists(error_path):
-        with open(error_path, "r") as f:
-            err_content = json.load(f)
-        try:
-            os.remove(error_path)
-        except OSError as e:
-            print(f"Error removing file {error_path}: {e}")
-        return JSONResponse(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            content=err_content
-        )
-
-    if os.path.exists(output_path_json) and os.path.exists(output_path_pdb):
-        return JSONResponse(
-            status_code=status.HTTP_200_OK,
-            content={
-                "status": "COMPLETED",
-                "pdbFilePath": output_path_pdb,
-                "jsonFilePath": output_path_json
-            }
-        )
-
-    return JSONResponse(
-        status_code=status.HTTP_202_ACCEPTED,
-        content={"status": "PROCESSING"}
-    )
-
-
-@app.post("/cancel/{uuid}")
-async def cancel_job(uuid: str):
-    process = active_jobs.get(uuid)
-    
-    if process:
-        if process.poll() is None:
-            process.terminate()  
-            
-            del active_jobs[uuid]
-            return {"status": "CANCELLED", "message": f"Job {uuid} has been terminated."}
-        else:
-            del active_jobs[uuid]
-            return {"status": "FINISHED", "message": "Job had already finished."}
-    
-    return JSONResponse(
-        status_code=status.HTTP_404_NOT_FOUND,
-        content={"error": "Job not found or not running"}
-    )
-
-
-@app.post("/test")
-async def test_run(uuid: str = Form(...), seed: int = Form(42)):
-    """
-    This function is the testing function that the backend can use. Takes the same params as the run function,
-    so it can be used by changing the /run to /test in tasks.py. It behaves exactly the same as the /run endpoint, but
-    it does not turn the subprocess on, saving about 30-40min per test. The output is a random .pdb file that has to be
-    placed in the main engine folder under the name "test_res.pdb" BEFORE the image is built
-    """
-    print(f"Incomming request with uuid: {uuid} and seed: {seed}")
-    output_folder = f"/shared/samples/engine_outputs"
-    output_name = f"{uuid}_{seed}"
-
-    output_path_pdb = os.path.join(output_folder, output_name + ".pdb")
-    output_path_json = os.path.join(output_folder, output_name + ".json")
-
-    test_path = "test_res.pdb"
-
-    try:
-        with open(test_path, "r") as f:
-            tekst = f.readlines()
-        with open(output_path_pdb, "w") as f:
-            f.writelines(tekst)
-        sleep(1)
-
-        for _ in range(20):
-            if os.path.exists(output_path_pdb):
-                break
-            sleep(0.5)
-
-        if not os.path.exists(output_path_pdb):
-            print(f"Output file {output_path_pdb} can't be found or wasn't generated.")
-            return JSONResponse(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                content={"error": f"Output file {output_path_pdb} can't be found or wasn't generated."}
-            )
-        
-        try:
-            subprocess.run([
-                "Arena",
-                output_path_pdb,
-                output_path_pdb,
-                "5"
-            ], check=True, capture_output=True, text=True)
-
-        except subprocess.CalledProcessError as e:
-            print(f"Arena conversion failed. Stderr: {e.stderr}")
-            return JSONResponse(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                content={"ERROR": "Arena conversion has failed", "details": e.stderr})
-        
-        try:
-            result = subprocess.run([
-                "annotator",
-                "--json", str(output_path_json),
-                "--extended", str(output_path_pdb)
-            ], check=True, stderr=subprocess.PIPE)
-
-        
-        except subprocess.CalledProcessError as e:
-            print(f"Annotator has failed, {e.stderr.decode()}")
-            return JSONResponse(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                content={"ERROR": f"Annotator has failed"}
-            )
-        
-            
-        return_content = {"message": "OK", "pdbFilePath": output_path_pdb, 
-                          "jsonFilePath": output_path_json}
-        
-        return JSONResponse(content=return_content, status_code=status.HTTP_200_OK)
-
-    except subprocess.CalledProcessError as e:
-        print(f"GraphaRNA engine failed")
-        return JSONResponse(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            content={"ERROR": f"GraphaRNA engine has failed"}
+import argparse
+import asyncio
+import gzip
+import json
+import shlex
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Form, Request, status
+from fastapi.responses import PlainTextResponse, JSONResponse, Response, StreamingResponse
+import uuid
+import os
+import subprocess
+
+from grapharna.service import Job, WorkerPool, Zygote, SamplingRunner, Scheduler, QueueFull, JobTooLarge, default_num_workers
+from grapharna.service import Spool, SpoolExecutor
+from grapharna.service import CostModel, MemoryModel, FifoQueue, ShortestJobFirst, ResultCache, JobStore, file_digest
+from grapharna.service import Annotator, Metrics, ResultBuffer, pack_result, run_annotator
+from grapharna.service.scheduler import QUEUED, SAMPLING, COMPLETED, FAILED, CANCELLED
+
+INPUT_FOLDER = "/shared/samples/engine_inputs"
+OUTPUT_FOLDER = os.environ.get("GRAPHARNA_OUTPUT_FOLDER", "/shared/samples/engine_outputs")
+MODEL_PATH = os.environ.get("GRAPHARNA_MODEL_PATH", "save/grapharna/model_800.h5")
+scheduler = None
+
+def create_executor():
+    """
+    Executor of the sampling jobs, configured with the environment variables:
+    GRAPHARNA_EXECUTOR ("pool": long-lived workers, "zygote": a process forked per job from a process with the loaded
+    model, CPU only, "spool": jobs sampled by other hosts from the spool directory GRAPHARNA_SPOOL_DIR, with at most
+    GRAPHARNA_SPOOL_JOBS jobs in the spool and leases of GRAPHARNA_SPOOL_LEASE seconds), GRAPHARNA_WORKERS (number of workers or concurrent jobs, default: from the available cores and
+    memory), GRAPHARNA_THREADS (threads per job), GRAPHARNA_WORKER_MEMORY_GB (memory of one job),
+    GRAPHARNA_SAMPLING_ARGS (extra grapharna arguments) and, for the pool, GRAPHARNA_BATCH_SIZE (jobs sampled together
+    by a worker, default 1), GRAPHARNA_BATCH_ATOMS (atoms of a batch) and GRAPHARNA_BATCH_WINDOW (seconds a batch
+    waits for more jobs, default 0.2).
+    """
+    if os.environ.get("GRAPHARNA_EXECUTOR", "pool") == "spool":
+        spool = Spool(os.environ.get("GRAPHARNA_SPOOL_DIR", "/shared/samples/spool"),
+                      lease=float(os.environ.get("GRAPHARNA_SPOOL_LEASE", 60)))
+        print(f"Queueing the jobs in the spool {spool.directory}")
+        return SpoolExecutor(spool, capacity=int(os.environ.get("GRAPHARNA_SPOOL_JOBS", 16))).start()
+    threads = int(os.environ.get("GRAPHARNA_THREADS", 4))
+    memory = float(os.environ.get("GRAPHARNA_WORKER_MEMORY_GB", 8))
+    num_workers = int(os.environ.get("GRAPHARNA_WORKERS", default_num_workers(threads, memory)))
+    sampling_args = shlex.split(os.environ.get("GRAPHARNA_SAMPLING_ARGS", ""))
+    if os.environ.get("GRAPHARNA_EXECUTOR", "pool") == "zygote":
+        print(f"Starting the zygote, up to {num_workers} concurrent jobs with {threads} threads each")
+        return Zygote(SamplingRunner(sampling_args, MODEL_PATH, threads=threads, device='cpu'), max_jobs=num_workers).start()
+    batch_size = int(os.environ.get("GRAPHARNA_BATCH_SIZE", 1))
+    batch_atoms = os.environ.get("GRAPHARNA_BATCH_ATOMS")
+    print(f"Starting {num_workers} sampling workers with {threads} threads each, up to {batch_size} jobs per batch")
+    return WorkerPool(SamplingRunner(sampling_args, MODEL_PATH, threads=threads), num_workers=num_workers, batch_size=batch_size,
+                      max_batch_atoms=int(batch_atoms) if batch_atoms is not None else None,
+                      batch_window=float(os.environ.get("GRAPHARNA_BATCH_WINDOW", 0.2))).start()
+
+def create_cache():
+    """
+    Result cache, configured with the environment variables GRAPHARNA_CACHE_DIR (default /shared/samples/result_cache)
+    and GRAPHARNA_CACHE_GB (size of the cache, default 10, 0 disables it). The results are keyed by the input, the seed,
+    the model checkpoint and GRAPHARNA_SAMPLING_ARGS.
+    """
+    max_gb = float(os.environ.get("GRAPHARNA_CACHE_GB", 10))
+    if max_gb <= 0:
+        return None
+    try:
+        model_digest = file_digest(MODEL_PATH)
+    except OSError as e:
+        print(f"Cannot hash the model checkpoint, the result cache is disabled: {e}")
+        return None
+    settings = " ".join(shlex.split(os.environ.get("GRAPHARNA_SAMPLING_ARGS", "")))
+    return ResultCache(os.environ.get("GRAPHARNA_CACHE_DIR", "/shared/samples/result_cache"),
+                       max_bytes=int(max_gb * 1024 ** 3), model_digest=model_digest, settings=settings)
+
+def create_store():
+    """
+    Durable job store, configured with the environment variables GRAPHARNA_JOB_STORE (path of the SQLite database,
+    default /shared/samples/jobs.sqlite, empty to disable it) and GRAPHARNA_JOB_STORE_DAYS (finished jobs are
+    removed after this many days, default 30).
+    """
+    path = os.environ.get("GRAPHARNA_JOB_STORE", "/shared/samples/jobs.sqlite")
+    if not path:
+        return None
+    store = JobStore(path)
+    removed = store.prune(float(os.environ.get("GRAPHARNA_JOB_STORE_DAYS", 30)) * 24 * 3600, [COMPLETED, FAILED, CANCELLED])
+    print(f"Job store {path}, removed {removed} old jobs")
+    return store
+
+def create_results():
+    """
+    In-memory buffer of the packed results delivered by /result, configured with the environment variable
+    GRAPHARNA_RESULTS_MB (size of the buffer, default 256, 0 disables it).
+    """
+    max_mb = float(os.environ.get("GRAPHARNA_RESULTS_MB", 256))
+    if max_mb <= 0:
+        return None
+    return ResultBuffer(max_bytes=int(max_mb * 1024 ** 2))
+
+def sampling_copies():
+    """
+    Structures sampled together by every job: the --num-samples of GRAPHARNA_SAMPLING_ARGS (an ensemble).
+    """
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--num-samples', type=int, default=1)
+    args, _ = parser.parse_known_args(shlex.split(os.environ.get("GRAPHARNA_SAMPLING_ARGS", "")))
+    return max(1, args.num_samples)
+
+def create_scheduler(executor, cache=None, store=None, metrics=None, results=None):
+    """
+    Job scheduler, configured with the environment variables: GRAPHARNA_MAX_QUEUE (queued jobs, default 100),
+    GRAPHARNA_MAX_SAMPLING (jobs sampled at the same time, default: the capacity of the executor),
+    GRAPHARNA_MAX_ARENA and GRAPHARNA_MAX_ANNOTATE (concurrent Arena and annotator runs, default 2),
+    GRAPHARNA_SCHEDULING ("sjf": shortest estimated job first, default, or "fifo"), GRAPHARNA_AGING (seconds of
+    priority gained per second of waiting, default 1), GRAPHARNA_LARGE_JOB_SECONDS (jobs estimated to take longer
+    wait in a separate lane, default: no lane), GRAPHARNA_MAX_LARGE (large jobs sampled at the same time, default 1),
+    GRAPHARNA_MAX_JOB_GB (jobs estimated to need more memory are rejected, default: no limit),
+    GRAPHARNA_LARGE_JOB_GB (jobs estimated to need more memory wait in the large lane, default: no lane),
+    GRAPHARNA_ANNOTATOR ("library": rnapolis in a pool of processes, default, or "command": the annotator CLI) and
+    GRAPHARNA_ARCHIVE_DIR (the completed results are copied there, default: not archived).
+    """
+    max_sampling = os.environ.get("GRAPHARNA_MAX_SAMPLING")
+    large_job_seconds = os.environ.get("GRAPHARNA_LARGE_JOB_SECONDS")
+    max_job_gb = os.environ.get("GRAPHARNA_MAX_JOB_GB")
+    large_job_gb = os.environ.get("GRAPHARNA_LARGE_JOB_GB")
+    if os.environ.get("GRAPHARNA_SCHEDULING", "sjf") == "fifo":
+        queue, large_queue = FifoQueue(), FifoQueue()
+    else:
+        aging = float(os.environ.get("GRAPHARNA_AGING", 1.))
+        queue, large_queue = ShortestJobFirst(aging), ShortestJobFirst(aging)
+    max_annotate = int(os.environ.get("GRAPHARNA_MAX_ANNOTATE", 2))
+    if os.environ.get("GRAPHARNA_ANNOTATOR", "library") == "command":
+        annotate = run_annotator
+    else:
+        annotate = Annotator(workers=max_annotate)
+    return Scheduler(executor,
+                     max_queue=int(os.environ.get("GRAPHARNA_MAX_QUEUE", 100)),
+                     max_sampling=int(max_sampling) if max_sampling is not None else None,
+                     max_arena=int(os.environ.get("GRAPHARNA_MAX_ARENA", 2)),
+                     max_annotate=max_annotate,
+                     annotate=annotate,
+                     queue=queue,
+                     large_queue=large_queue,
+                     cost_model=CostModel(),
+                     large_job_seconds=float(large_job_seconds) if large_job_seconds is not None else None,
+                     max_large=int(os.environ.get("GRAPHARNA_MAX_LARGE", 1)),
+                     memory_model=MemoryModel(copies=sampling_copies()),
+                     max_job_bytes=int(float(max_job_gb) * 1024 ** 3) if max_job_gb is not None else None,
+                     large_job_bytes=int(float(large_job_gb) * 1024 ** 3) if large_job_gb is not None else None,
+                     cache=cache,
+                     store=store,
+                     metrics=metrics,
+                     results=results,
+                     archive_dir=os.environ.get("GRAPHARNA_ARCHIVE_DIR") or None)
+
+@asynccontextmanager
+async def lifespan(app):
+    global scheduler
+    executor = create_executor()
+    store = create_store()
+    scheduler = create_scheduler(executor, create_cache(), store, Metrics(), create_results())
+    scheduler.recover()
+    yield
+    scheduler.shutdown()
+    executor.shutdown()
+    if store is not None:
+        store.close()
+
+app = FastAPI(lifespan=lifespan)
+
+@app.get("/")
+def root():
+    return {"status": "OK"}
+
+    
+@app.post("/run")
+async def run_grapharna(
+    uuid: str = Form(...), 
+    seed: int = Form(42)
+):
+    print(f"Incoming request with uuid: {uuid} and seed: {seed}")
+    
+    input_path = os.path.join(INPUT_FOLDER, f"{uuid}.dotseq")
+    job = Job(uuid, seed, input_path, OUTPUT_FOLDER)
+
+    if not os.path.exists(input_path):
+        return JSONResponse(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            content={"error": f"Input file {input_path} does not exist."}
+        )
+
+    record = scheduler.get(job.id)
+    if record is None or not record.active:
+        if os.path.exists(job.error_path): os.remove(job.error_path)
+        if os.path.exists(job.json_path): os.remove(job.json_path)
+    try:
+        record = scheduler.submit(job)
+    except QueueFull as e:
+        return JSONResponse(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            content={"error": str(e)}
+        )
+    except JobTooLarge as e:
+        return JSONResponse(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            content={"error": str(e), **scheduler.plan(job)}
+        )
+
+    if record.cached:
+        return JSONResponse(
+            status_code=status.HTTP_200_OK,
+            content={
+                "status": "COMPLETED",
+                "cached": True,
+                "pdbFilePath": job.pdb_path,
+                "jsonFilePath": job.json_path
+            }
+        )
+
+    return JSONResponse(
+        status_code=status.HTTP_202_ACCEPTED,
+        content={
+            "message": "Job accepted", 
+            "status_endpoint": f"/status/{uuid}",
+            "queue_position": scheduler.position(job.id)
+        }
+    )
+
+@app.get("/estimate/{uuid}")
+async def estimate_job(uuid: str):
+    """
+    Estimated sampling time and peak memory of the input, the lane it would wait in and whether it would be admitted,
+    without submitting a job.
+    """
+    input_path = os.path.join(INPUT_FOLDER, f"{uuid}.dotseq")
+    if not os.path.exists(input_path):
+        return JSONResponse(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            content={"error": f"Input file {input_path} does not exist."}
+        )
+    job = Job(uuid, 0, input_path, OUTPUT_FOLDER)
+    try:
+        num_residues = job.num_residues
+    except (OSError, IndexError) as e:
+        return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, content={"error": f"Cannot read {input_path}: {e}"})
+    return {"num_residues": num_residues, **scheduler.plan(job)}
+
+def job_status(record):
+    """
+    Status code and content of /status for a job known to the scheduler, from its in-memory record.
+    """
+    job = record.job
+    if record.state == COMPLETED:
+        content = {
+            "status": "COMPLETED",
+            "pdbFilePath": job.pdb_path,
+            "jsonFilePath": job.json_path
+        }
+        if scheduler.store is not None:
+            content["stage_seconds"] = {stage: round(seconds, 1) for stage, seconds in scheduler.store.timings(job.id).items()}
+        return status.HTTP_200_OK, content
+    if not record.active:
+        return status.HTTP_500_INTERNAL_SERVER_ERROR, {"error": record.error}
+    content = {"status": "PROCESSING", "stage": record.state}
+    if record.state == QUEUED:
+        content = {"status": "QUEUED", "queue_position": scheduler.position(job.id)}
+    if record.estimate is not None:
+        content["estimated_sampling_seconds"] = round(record.estimate)
+    if record.state == SAMPLING and record.progress is not None:
+        content["step"] = record.progress["step"]
+        content["total_steps"] = record.progress["total"]
+        if record.progress["eta"] is not None:
+            content["eta_seconds"] = round(record.progress["eta"])
+    return status.HTTP_202_ACCEPTED, content
+
+@app.get("/status/{uuid}")
+async def check_status(uuid: str, seed: int):
+    job = Job(uuid, seed, None, OUTPUT_FOLDER)
+    record = scheduler.get(job.id)
+    if record is not None:
+        code, content = job_status(record)
+        return JSONResponse(status_code=code, content=content)
+
+    stored = scheduler.store.get(job.id) if scheduler.store is not None else None
+    if stored is not None and stored["state"] in [FAILED, CANCELLED]:
+        return JSONResponse(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            content={"error": stored["error"]}
+        )
+
+    # jobs of a previous run of the service
+    output_path_pdb = job.pdb_path
+    output_path_json = job.json_path
+    error_path = job.error_path
+    print(f"output_path_pdb: {output_path_pdb}, output_path_json: {output_path_json}, error_path: {error_path}")
+
+    if os.path.exists(error_path):
+        with open(error_path, "r") as f:
+            err_content = json.load(f)
+        try:
+            os.remove(error_path)
+        except OSError as e:
+            print(f"Error removing file {error_path}: {e}")
+        return JSONResponse(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            content=err_content
+        )
+
+    if os.path.exists(output_path_json) and os.path.exists(output_path_pdb):
+        return JSONResponse(
+            status_code=status.HTTP_200_OK,
+            content={
+                "status": "COMPLETED",
+                "pdbFilePath": output_path_pdb,
+                "jsonFilePath": output_path_json
+            }
+        )
+
+    return JSONResponse(
+        status_code=status.HTTP_202_ACCEPTED,
+        content={"status": "PROCESSING"}
+    )
+
+
+async def wait_finished(record, timeout: float):
+    # waits up to `timeout` seconds for an active job to finish
+    loop = asyncio.get_running_loop()
+    changed = asyncio.Event()
+    notify = lambda record: loop.call_soon_threadsafe(changed.set)
+    scheduler.subscribe(record.job.id, notify)
+    try:
+        deadline = loop.time() + timeout
+        while record.active and loop.time() < deadline:
+            changed.clear()
+            try:
+                await asyncio.wait_for(changed.wait(), timeout=deadline - loop.time())
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        scheduler.unsubscribe(record.job.id, notify)
+
+
+@app.get("/result/{uuid}")
+async def job_result(uuid: str, seed: int, request: Request, wait: float = 0):
+    """
+    Result of a completed job in the response body: a JSON document {"pdb": the PDB file, "json": the secondary
+    structure}, gzip-compressed if the client accepts it. The results are delivered from memory, without reading
+    the shared filesystem. With `wait`, an active job is awaited up to `wait` seconds, then its status is returned (202).
+    """
+    job = Job(uuid, seed, None, OUTPUT_FOLDER)
+    record = scheduler.get(job.id)
+    if record is not None and record.active and wait > 0:
+        await wait_finished(record, min(wait, 600))
+    if record is not None and record.state != COMPLETED:
+        code, content = job_status(record)
+        return JSONResponse(status_code=code, content=content)
+    data = scheduler.results.get(job.id) if scheduler.results is not None else None
+    if data is None:
+        # jobs of a previous run of the service, or dropped from memory
+        try:
+            data = await asyncio.to_thread(pack_result, job)
+        except (OSError, ValueError):
+            stored = scheduler.store.get(job.id) if scheduler.store is not None else None
+            if stored is not None and stored["state"] in [FAILED, CANCELLED]:
+                return JSONResponse(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, content={"error": stored["error"]})
+            return JSONResponse(status_code=status.HTTP_404_NOT_FOUND, content={"error": "Result not found"})
+    if "gzip" in request.headers.get("accept-encoding", ""):
+        return Response(content=data, media_type="application/json", headers={"Content-Encoding": "gzip"})
+    return Response(content=gzip.decompress(data), media_type="application/json")
+
+
+@app.get("/events/{uuid}")
+async def job_events(uuid: str, seed: int):
+    """
+    Server-sent events with the status of the job (as returned by /status), sent whenever its stage or sampling
+    progress changes. The stream ends when the job is finished.
+    """
+    job = Job(uuid, seed, None, OUTPUT_FOLDER)
+    record = scheduler.get(job.id)
+    if record is None:
+        return JSONResponse(
+            status_code=status.HTTP_404_NOT_FOUND,
+            content={"error": "Job not found"}
+        )
+    loop = asyncio.get_running_loop()
+    changed = asyncio.Event()
+    notify = lambda record: loop.call_soon_threadsafe(changed.set)
+    scheduler.subscribe(job.id, notify)
+
+    async def stream():
+        try:
+            while True:
+                changed.clear()
+                code, content = job_status(record)
+                yield f"data: {json.dumps(content)}\n\n"
+                if not record.active:
+                    return
+                while True:
+                    try:
+                        await asyncio.wait_for(changed.wait(), timeout=15)
+                        break
+                    except asyncio.TimeoutError:
+                        yield ": keep-alive\n\n"
+        finally:
+            scheduler.unsubscribe(job.id, notify)
+
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+@app.get("/cache")
+async def cache_stats():
+    if scheduler.cache is None:
+        return {"enabled": False, "deduplicated": scheduler.deduplicated}
+    return {"enabled": True, "deduplicated": scheduler.deduplicated, **scheduler.cache.stats()}
+
+
+@app.get("/metrics")
+async def metrics():
+    """
+    Metrics of the service in the Prometheus text format: queue depth, active jobs, latency of every stage,
+    sampling speed, memory and CPU time of the jobs and the result cache.
+    """
+    if scheduler.metrics is None:
+        return PlainTextResponse("", media_type="text/plain; version=0.0.4")
+    return PlainTextResponse(scheduler.metrics.render(scheduler), media_type="text/plain; version=0.0.4")
+
+
+@app.post("/cancel/{uuid}")
+async def cancel_job(uuid: str):
+    if scheduler.cancel(uuid):
+        return {"status": "CANCELLED", "message": f"Job {uuid} has been cancelled."}
+    if any(record.job.uuid == uuid for record in list(scheduler.records.values())):
+        return {"status": "FINISHED", "message": "Job had already finished."}
+    
+    return JSONResponse(
+        status_code=status.HTTP_404_NOT_FOUND,
+        content={"error": "Job not found or not running"}
+    )
+
+
+@app.post("/test")
+async def test_run(uuid: str = Form(...), seed: int = Form(42)):
+    """
+    This function is the testing function that the backend can use. Takes the same params as the run function,
+    so it can be used by changing the /run to /test in tasks.py. It behaves exactly the same as the /run endpoint, but
+    it does not turn the subprocess on, saving about 30-40min per test. The output is a random .pdb file that has to be
+    placed in the main engine folder under the name "test_res.pdb" BEFORE the image is built
+    """
+    print(f"Incomming request with uuid: {uuid} and seed: {seed}")
+    output_folder = OUTPUT_FOLDER
+    output_name = f"{uuid}_{seed}"
+
+    output_path_pdb = os.path.join(output_folder, output_name + ".pdb")
+    output_path_json = os.path.join(output_folder, output_name + ".json")
+
+    test_path = "test_res.pdb"
+
+    try:
+        with open(test_path, "r") as f:
+            tekst = f.readlines()
+        with open(output_path_pdb, "w") as f:
+            f.writelines(tekst)
+
+        try:
+            subprocess.run([
+                "Arena",
+                output_path_pdb,
+                output_path_pdb,
+                "5"
+            ], check=True, capture_output=True, text=True)
+
+        except subprocess.CalledProcessError as e:
+            print(f"Arena conversion failed. Stderr: {e.stderr}")
+            return JSONResponse(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                content={"ERROR": "Arena conversion has failed", "details": e.stderr})
+        
+        try:
+            result = subprocess.run([
+                "annotator",
+                "--json", str(output_path_json),
+                "--extended", str(output_path_pdb)
+            ], check=True, stderr=subprocess.PIPE)
+
+        
+        except subprocess.CalledProcessError as e:
+            print(f"Annotator has failed, {e.stderr.decode()}")
+            return JSONResponse(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                content={"ERROR": f"Annotator has failed"}
+            )
+        
+            
+        return_content = {"message": "OK", "pdbFilePath": output_path_pdb, 
+                          "jsonFilePath": output_path_json}
+        
+        return JSONResponse(content=return_content, status_code=status.HTTP_200_OK)
+
+    except subprocess.CalledProcessError as e:
+        print(f"GraphaRNA engine failed")
+        return JSONResponse(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            content={"ERROR": f"GraphaRNA engine has failed"}
         )
\ No newline at end of file
@@ -16,7 +16,7 @@ import wandb
 
 from grapharna.models import PAMNet, Config
 from grapharna.datasets import RNAPDBDataset
-from grapharna.utils import Sampler, SampleToPDB, SamplingMask
+from grapharna.utils import Sampler, SampleToPDB, SamplingMask, ensemble_diversity
 from grapharna.losses import p_losses
 
 def set_seed(seed):
@@ -49,7 +49,7 @@ def validation(model, loader, device, sampler, args):
 def sample(model, loader, device, sampler, epoch, args, num_batches=None, exp_name: str = "run", output_folder = None, output_name = None):
     model.eval()
     s = SampleToPDB()
-    # mask_sampler = SamplingMask(args.sampling_resids, device=device)
+    mask_sampler = SamplingMask(getattr(args, 'sampling_resids', None), device=device)
     s_counter = 0
 
     if output_folder is None:
@@ -59,9 +59,30 @@ def sample(model, loader, device, sampler, epoch, args, num_batches=None, exp_na
         for data, name, seqs in loader:
             print(f"Sample batch {s_counter}")
             data = data.to(device)
-            # sampling_mask = mask_sampler.get_mask(data, name)
-            samples = sampler.sample(model, seqs, data)[-1]
-            s.to('pdb', samples, output_folder, name if output_name is None else [output_name])
+            sampling_mask = mask_sampler.get_mask(data, name)
+            names = name if output_name is None else [output_name]
+            num_samples = getattr(args, 'num_samples', 1)
+            if num_samples > 1:
+                assert sampling_mask.all(), "Ensembles are not supported with --sampling-resids"
+                ensemble = sampler.sample_ensemble(model, seqs, data, num_samples, args.fork_step, names=name, seed=args.seed)
+                for k, samples in enumerate(ensemble):
+                    s.to('pdb', samples, output_folder, [f"{n.replace('.pdb', '').replace('.cif', '')}_{k}" for n in names])
+                for i, n in enumerate(names):
+                    diversity = ensemble_diversity([e.x[e.batch == i, :3].numpy() * 10 for e in ensemble])
+                    print(f"{n}: {num_samples} samples, fork step {args.fork_step}, mean pairwise RMSD {diversity:.2f} A")
+            else:
+                if getattr(args, 'time_budget', None) is not None:
+                    samples, steps = sampler.sample_with_deadline(model, seqs, data, args.time_budget, names=name, seed=args.seed)
+                    samples = samples[-1]
+                    print(f"Sampled in {steps} of {sampler.timesteps} steps (time budget {args.time_budget} s)")
+                elif getattr(args, 'start_t', None) is not None: # warm start from the input coordinates
+                    assert sampling_mask.all(), "Refinement is not supported with --sampling-resids"
+                    samples = sampler.refine(model, seqs, data, args.start_t, names=name, seed=args.seed)[-1]
+                elif sampling_mask.all():
+                    samples = sampler.sample(model, seqs, data, names=name, seed=args.seed)[-1]
+                else: # resample only the selected residues, the rest is fixed
+                    samples = sampler.inpaint(model, seqs, data, sampling_mask, cutoff=model.cutoff_g, names=name, seed=args.seed)[-1]
+                s.to('pdb', samples, output_folder, names)
             # s.to('xyz', samples, f"./samples/{exp_name}/{epoch}", name)
             # s.to('trafl', samples, f"./samples/{exp_name}/{epoch}", name)
             s_counter += 1
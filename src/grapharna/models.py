@@ -4,9 +4,10 @@ import torch.nn as nn
 import torch.nn.functional as F
 from torch_sparse import SparseTensor
 from torch_geometric.nn import knn
-from torch_geometric.utils import remove_self_loops
+from torch_geometric.utils import remove_self_loops, subgraph
 from rinalmo.pretrained import get_pretrained_model
 
+from grapharna.utils.reduced_compute import LOCAL_MODES, ComputeSchedule, FeatureCache
 from grapharna.layers import Global_MessagePassing, Local_MessagePassing, \
     BesselBasisLayer, SphericalBasisLayer, MLP
 
@@ -81,14 +82,81 @@ class SequenceStructureModule(nn.Module):
         self.encoder_layer = nn.TransformerEncoderLayer(d_model=dim, nhead=nhead, batch_first=True)
         self.transformer_encoder = nn.TransformerEncoder(self.encoder_layer, num_layers=n_layers, norm=nn.LayerNorm(dim))
 
-    def forward(self, seq_emb, x_struct, batch):
+    @staticmethod
+    def attention_mask(batch):
+        # Block attention between atoms of different structures
+        return batch[:, None] != batch[None, :]
+
+    def forward(self, seq_emb, x_struct, batch, attn_mask=None):
         x = torch.cat((seq_emb, x_struct), dim=1)
-        attn_mask = torch.ones(x.size(0), x.size(0), device=x.device) # Default: block all
-        attn_pos = torch.where(batch[:, None] == batch[None, :])
-        attn_mask[attn_pos] = 0 # Allow attention within same structure
-        out = self.transformer_encoder(x, mask=attn_mask.bool())
+        if attn_mask is None:
+            attn_mask = self.attention_mask(batch)
+        out = self.transformer_encoder(x, mask=attn_mask)
         return out
 
+class SamplingSession(object):
+    """
+    Inputs of PAMNet that do not change between the denoising steps of a batch: atom and residue one-hots merged
+    with the sequence embeddings, the 2D structure and covalent edges, the attention mask and the time embeddings
+    of every timestep. Calling the session with the current coordinates runs only the geometry-dependent part of the model.
+    """
+    def __init__(self, model, seq_x, seq_emb, batch, edge_index, edge_attr, time_table):
+        self.model = model
+        self.seq_x = seq_x
+        self.seq_emb = seq_emb
+        self.batch = batch
+        self.edge_index = edge_index
+        self.edge_attr = edge_attr
+        self.time_table = time_table
+        self.attn_mask = SequenceStructureModule.attention_mask(batch)
+        self.compute = {} # reduced compute of the current step, see ComputeSchedule
+        self.feature_cache = None # see FeatureCache
+
+    @property
+    def num_atoms(self):
+        return self.seq_x.size(0)
+
+    @property
+    def num_graphs(self):
+        return int(self.batch.max()) + 1 if self.batch.numel() > 0 else 0
+
+    def subset(self, index):
+        """
+        Session of the subgraph induced by the atoms in `index` (sorted), e.g. the region resampled during inpainting.
+        The sequence embeddings are still the ones computed for the full sequences.
+        """
+        edge_index, edge_attr = subgraph(index, self.edge_index, self.edge_attr, relabel_nodes=True, num_nodes=self.num_atoms)
+        return SamplingSession(self.model, self.seq_x[index], self.seq_emb[index], self.batch[index],
+                               edge_index, edge_attr, self.time_table)
+
+    @classmethod
+    def concat(cls, sessions):
+        """
+        Batches the sessions of separate inputs into one. The model and the time embeddings are taken from the first session.
+        """
+        atom_offset = 0
+        graph_offset = 0
+        batch, edge_index = [], []
+        for session in sessions:
+            batch.append(session.batch + graph_offset)
+            edge_index.append(session.edge_index + atom_offset)
+            atom_offset += session.num_atoms
+            graph_offset += session.num_graphs
+        first = sessions[0]
+        return cls(first.model,
+                   torch.cat([s.seq_x for s in sessions], dim=0),
+                   torch.cat([s.seq_emb for s in sessions], dim=0),
+                   torch.cat(batch, dim=0),
+                   torch.cat(edge_index, dim=1),
+                   torch.cat([s.edge_attr for s in sessions], dim=0),
+                   first.time_table)
+
+    def __call__(self, pos, t):
+        time_emb = self.time_table[t]
+        return self.model.denoise(pos, self.seq_x, self.seq_emb, time_emb, self.batch,
+                                  self.edge_index, self.edge_attr, attn_mask=self.attn_mask,
+                                  cache=self.feature_cache, **self.compute)
+
 class PAMNet(nn.Module):
     def __init__(self, config: Config, num_spherical=7, num_radial=6, envelope_exponent=5, time_dim=16):
         super(PAMNet, self).__init__()
@@ -194,14 +262,14 @@ class PAMNet(nn.Module):
                 new_edge_attr.append(edge_attr[i])
         return torch.tensor(new_edge_index, device=device).t(), torch.stack(new_edge_attr, dim=0)
     
-    def merge_edge_attr(self, data, shape):
+    def merge_edge_attr(self, struct_edge_attr, shape):
         """
         Shape is extended to dimension 3 to add the edge type. The classes are 0 (interactios like 2D structure), 1 (covalent bondings),
         and 2 (interactions found by knn)
         """
-        edge_attr = torch.zeros(shape, device=data.edge_attr.device).float()
+        edge_attr = torch.zeros(shape, device=struct_edge_attr.device).float()
         edge_attr[:, 2] = 1
-        return torch.cat((edge_attr, data.edge_attr), dim=0)
+        return torch.cat((edge_attr, struct_edge_attr), dim=0)
     
     def get_interaction_edges(self, data, cutoff):
         atom_names = data.x[:, -4:]
@@ -223,7 +291,7 @@ class PAMNet(nn.Module):
         edges[0, :] = base_atoms[edges[0, :]]
         edges[1, :] = base_atoms[edges[1, :]]
         
-        edge_attr = self.merge_edge_attr(data, (edges.size(1),3))
+        edge_attr = self.merge_edge_attr(data.edge_attr, (edges.size(1),3))
         edge_indeces = torch.cat((edges, data.edge_index), dim=1) # TODO: should we remove redundant edges?
         # edge_indeces, edge_attr = self.get_non_redundant_edges(edge_indeces, edge_attr, device=data.edge_attr.device)
         return edge_indeces, edge_attr
@@ -247,23 +315,66 @@ class PAMNet(nn.Module):
         seq_emb = seq_emb[valid_positions]
         return torch.cat((x, seq_emb), dim=1), seq_emb
 
-    def forward(self, data, seqs, t=None):
+    def embed_invariants(self, data, seqs):
+        """
+        Computes the part of the input that does not depend on the coordinates nor on the timestep:
+        one-hot encoded atom types merged with the sequence embeddings.
+        """
         x_raw = data.x.contiguous()
-        batch = data.batch # This parameter assigns an index to each node in the graph, indicating which graph it belongs to.
-
         x_raw = x_raw.unsqueeze(-1) if x_raw.dim() == 1 else x_raw
         x = x_raw[:, 3:]  # one-hot encoded atom types;
         
         seq_emb = self.sequence_module(seqs, x.device)
-        
-        seq_x, seq_emb = self.merge_seq_embeddings(seq_emb, x)
+        return self.merge_seq_embeddings(seq_emb, x)
+
+    def time_table(self, timesteps, device):
+        return self.time_mlp(torch.arange(timesteps, device=device))
+
+    def sampling_session(self, data, seqs, timesteps, time_table=None):
+        """
+        Precomputes the timestep-invariant inputs of the batch once, so that every denoising step
+        only processes the current coordinates. See SamplingSession.
+        """
+        seq_x, seq_emb = self.embed_invariants(data, seqs)
+        if time_table is None:
+            time_table = self.time_table(timesteps, seq_x.device)
+        return SamplingSession(self, seq_x, seq_emb, data.batch, data.edge_index, data.edge_attr.float(), time_table)
+
+    def forward(self, data, seqs, t=None):
+        x_raw = data.x.contiguous()
+        batch = data.batch # This parameter assigns an index to each node in the graph, indicating which graph it belongs to.
+
+        x_raw = x_raw.unsqueeze(-1) if x_raw.dim() == 1 else x_raw
+        seq_x, seq_emb = self.embed_invariants(data, seqs)
         time_emb = self.time_mlp(t)
         pos = x_raw[:,:3].contiguous()
+        return self.denoise(pos, seq_x, seq_emb, time_emb, batch, data.edge_index, data.edge_attr)
+
+    def denoise(self, pos, seq_x, seq_emb, time_emb, batch, edge_index, edge_attr, attn_mask=None,
+                knns=None, n_layer=None, local='full', cache=None):
+        """
+        Geometry-dependent part of the forward pass. `edge_index` and `edge_attr` are the 2D structure
+        and covalent edges of the input graph, the knn edges are computed here from `pos`.
+        `knns`, `n_layer` and `local` reduce the compute (see ComputeSchedule): the number of knn neighbours,
+        the number of message passing layers, and the local stage - 'full', 'pairs' (without the two-hop
+        and one-hop angles) or 'skip' (global layers only). `cache` (FeatureCache) reuses the deep features
+        of the previous steps.
+        """
+        knns = self.knns if knns is None else knns
+        n_layer = self.n_layer if n_layer is None else min(n_layer, self.n_layer)
+        assert local in LOCAL_MODES, f"Invalid local mode: {local}"
+
         x_pos = self.init_linear(pos) # coordinates embeddings
         # x_prop = self.atom_properties(x) # atom properties embeddings
         x = torch.cat([x_pos, seq_x, time_emb], dim=1)
-
-        row, col = knn(pos, pos, self.knns, batch, batch)
+        if cache is not None:
+            x_in = x
+            graph = (edge_index, seq_x)
+            if cache.valid(pos, graph):
+                delta, out = cache.reuse()
+                return self.out_linear(torch.cat((x_in + delta, out), dim=1))
+
+        row, col = knn(pos, pos, knns, batch, batch)
         edge_index_knn = torch.stack([row, col], dim=0)
         edge_index_knn, _, dist_knn = self.get_edge_info(edge_index_knn, edge_attr=None, pos=pos)
 
@@ -273,56 +384,15 @@ class PAMNet(nn.Module):
         edge_index_g = edge_index_knn[:, mask_g]
         
         # edge_index_g = self.get_non_redundant_edges(edge_index_g)
-        edge_g_attr = self.merge_edge_attr(data, (edge_index_g.size(1),3))
-        edge_index_g = torch.cat((edge_index_g, data.edge_index), dim=1)
+        edge_g_attr = self.merge_edge_attr(edge_attr, (edge_index_g.size(1),3))
+        edge_index_g = torch.cat((edge_index_g, edge_index), dim=1)
         edge_index_g, edge_g_attr, dist_g = self.get_edge_info(edge_index_g, edge_attr=edge_g_attr, pos=pos)
-
-        # Compute pairwise distances in local layer
-        tensor_l = torch.ones_like(dist_knn, device=dist_knn.device) * self.cutoff_l
-        mask_l = dist_knn <= tensor_l
-        edge_index_l = edge_index_knn[:, mask_l]
-        
-        # edge_index_l = self.get_non_redundant_edges(edge_index_l)
-        edge_l_attr = self.merge_edge_attr(data, (edge_index_l.size(1),3))
-        edge_index_l = torch.cat((edge_index_l, data.edge_index), dim=1)
-        edge_index_l, edge_l_attr, dist_l = self.get_edge_info(edge_index_l, edge_attr=edge_l_attr, pos=pos)
-        idx_i, idx_j, idx_k, idx_kj, idx_ji, idx_i_pair, idx_j1_pair, idx_j2_pair, idx_jj_pair, idx_ji_pair = self.indices(edge_index_l, num_nodes=x.size(0))
-        
-        # Compute two-hop angles in local layer
-        pos_ji, pos_kj = pos[idx_j] - pos[idx_i], pos[idx_k] - pos[idx_j]
-        a = (pos_ji * pos_kj).sum(dim=-1)
-        b = torch.linalg.cross(pos_ji, pos_kj).norm(dim=-1)
-        angle2 = torch.atan2(b, a)
-
-        # Compute one-hop angles in local layer
-        pos_i_pair = pos[idx_i_pair]
-        pos_j1_pair = pos[idx_j1_pair]
-        pos_j2_pair = pos[idx_j2_pair]
-        pos_ji_pair, pos_jj_pair = pos_j1_pair - pos_i_pair, pos_j2_pair - pos_j1_pair
-        a = (pos_ji_pair * pos_jj_pair).sum(dim=-1)
-        b = torch.linalg.cross(pos_ji_pair, pos_jj_pair).norm(dim=-1)
-        angle1 = torch.atan2(b, a)
-
-        # Get rbf and sbf embeddings
-        rbf_l = self.rbf_l(dist_l)
         rbf_g = self.rbf_g(dist_g)
-        sbf1 = self.sbf(dist_l, angle1, idx_jj_pair)
-        sbf2 = self.sbf(dist_l, angle2, idx_kj)
-        
-        if torch.isnan(dist_l).any():
-            print("NaN in dist_l")
-            print(dist_l)
-            raise ValueError("NaN in dist_l")
-        if torch.isnan(rbf_l).any():
-            print("NaN in rbf_l before concatenation")
-            raise ValueError("NaN in rbf_l before concatenation")
-        
-        rbf_l = torch.cat((rbf_l, edge_l_attr), dim=1)
         rbf_g = torch.cat((rbf_g, edge_g_attr), dim=1)
-        edge_attr_rbf_l = self.mlp_rbf_l(rbf_l)
         edge_attr_rbf_g = self.mlp_rbf_g(rbf_g)
-        edge_attr_sbf1 = self.mlp_sbf1(sbf1)
-        edge_attr_sbf2 = self.mlp_sbf2(sbf2)
+
+        if local != 'skip':
+            local_inputs = self.local_inputs(pos, dist_knn, edge_index_knn, edge_index, edge_attr, triplets=(local == 'full'))
 
         # Message Passing Modules
         out_global = []
@@ -330,13 +400,17 @@ class PAMNet(nn.Module):
         att_score_global = []
         att_score_local = []
         
-        for layer in range(self.n_layer):
+        for layer in range(n_layer):
             x, out_g, att_score_g = self.global_layer[layer](x, edge_attr_rbf_g, edge_index_g)
             out_global.append(out_g)
             att_score_global.append(att_score_g)
 
-            x, out_l, att_score_l = self.local_layer[layer](x, edge_attr_rbf_l, edge_attr_sbf2, edge_attr_sbf1, \
-                                                            idx_kj, idx_ji, idx_jj_pair, idx_ji_pair, edge_index_l)
+            if local == 'skip':
+                # no local features, the fusion module attends only to the global ones
+                out_local.append(torch.zeros_like(out_g))
+                att_score_local.append(torch.full_like(att_score_g, float('-inf')))
+                continue
+            x, out_l, att_score_l = self.local_layer[layer](x, *local_inputs)
             out_local.append(out_l)
             att_score_local.append(att_score_l)
         # Fusion Module
@@ -350,12 +424,97 @@ class PAMNet(nn.Module):
         out = (out * att_weight)
         out = out.sum(dim=0)
         out = self.struct_emb(out)
-        out = self.seq_struct_module(seq_emb, out, batch)
+        out = self.seq_struct_module(seq_emb, out, batch, attn_mask=attn_mask)
+        if cache is not None:
+            if cache.out is not None and cache.out.shape == out.shape:
+                cache.record_error(self.out_linear(torch.cat((x_in + cache.delta, cache.out), dim=1)),
+                                   self.out_linear(torch.cat((x, out), dim=1)))
+            cache.store(pos, x - x_in, out, graph)
         out = torch.cat((x, out), dim=1)
         out = self.out_linear(out)
         # out = F.relu(out)
         
         return out
+
+    def graph_stats(self, pos, batch, edge_index, knns=None):
+        """
+        Sizes of the graphs that denoise builds for the coordinates `pos`: the knn edges, the global and local edges
+        within the cutoffs (with the 2D structure and covalent edges `edge_index`), the two-hop and one-hop angle
+        triplets of the local layers and the entries of the attention of SequenceStructureModule.
+        """
+        knns = self.knns if knns is None else knns
+        row, col = knn(pos, pos, knns, batch, batch)
+        edge_index_knn, _, dist_knn = self.get_edge_info(torch.stack([row, col], dim=0), edge_attr=None, pos=pos)
+        edge_index_g, _, _ = self.get_edge_info(torch.cat((edge_index_knn[:, dist_knn <= self.cutoff_g], edge_index), dim=1),
+                                                edge_attr=None, pos=pos)
+        edge_index_l, _, _ = self.get_edge_info(torch.cat((edge_index_knn[:, dist_knn <= self.cutoff_l], edge_index), dim=1),
+                                                edge_attr=None, pos=pos)
+        indices = self.indices(edge_index_l, num_nodes=pos.size(0))
+        return {
+            "atoms": pos.size(0),
+            "knn_edges": edge_index_knn.size(1),
+            "global_edges": edge_index_g.size(1),
+            "local_edges": edge_index_l.size(1),
+            "two_hop_triplets": indices[0].numel(),
+            "one_hop_triplets": indices[5].numel(),
+            "attention_entries": pos.size(0) ** 2,
+        }
+
+    def local_inputs(self, pos, dist_knn, edge_index_knn, edge_index, edge_attr, triplets=True):
+        """
+        Edges and embeddings of the local layers. Without `triplets` the two-hop and one-hop angles
+        are not computed and the local layers only pass messages along the edges.
+        """
+        # Compute pairwise distances in local layer
+        tensor_l = torch.ones_like(dist_knn, device=dist_knn.device) * self.cutoff_l
+        mask_l = dist_knn <= tensor_l
+        edge_index_l = edge_index_knn[:, mask_l]
+        
+        # edge_index_l = self.get_non_redundant_edges(edge_index_l)
+        edge_l_attr = self.merge_edge_attr(edge_attr, (edge_index_l.size(1),3))
+        edge_index_l = torch.cat((edge_index_l, edge_index), dim=1)
+        edge_index_l, edge_l_attr, dist_l = self.get_edge_info(edge_index_l, edge_attr=edge_l_attr, pos=pos)
+
+        if torch.isnan(dist_l).any():
+            print("NaN in dist_l")
+            print(dist_l)
+            raise ValueError("NaN in dist_l")
+
+        rbf_l = self.rbf_l(dist_l)
+        if torch.isnan(rbf_l).any():
+            print("NaN in rbf_l before concatenation")
+            raise ValueError("NaN in rbf_l before concatenation")
+        rbf_l = torch.cat((rbf_l, edge_l_attr), dim=1)
+        edge_attr_rbf_l = self.mlp_rbf_l(rbf_l)
+
+        if not triplets:
+            empty_idx = torch.zeros(0, dtype=torch.long, device=pos.device)
+            empty_sbf = torch.zeros((0, self.total_dim), device=pos.device)
+            return edge_attr_rbf_l, empty_sbf, empty_sbf, empty_idx, empty_idx, empty_idx, empty_idx, edge_index_l
+
+        idx_i, idx_j, idx_k, idx_kj, idx_ji, idx_i_pair, idx_j1_pair, idx_j2_pair, idx_jj_pair, idx_ji_pair = self.indices(edge_index_l, num_nodes=pos.size(0))
+        
+        # Compute two-hop angles in local layer
+        pos_ji, pos_kj = pos[idx_j] - pos[idx_i], pos[idx_k] - pos[idx_j]
+        a = (pos_ji * pos_kj).sum(dim=-1)
+        b = torch.linalg.cross(pos_ji, pos_kj).norm(dim=-1)
+        angle2 = torch.atan2(b, a)
+
+        # Compute one-hop angles in local layer
+        pos_i_pair = pos[idx_i_pair]
+        pos_j1_pair = pos[idx_j1_pair]
+        pos_j2_pair = pos[idx_j2_pair]
+        pos_ji_pair, pos_jj_pair = pos_j1_pair - pos_i_pair, pos_j2_pair - pos_j1_pair
+        a = (pos_ji_pair * pos_jj_pair).sum(dim=-1)
+        b = torch.linalg.cross(pos_ji_pair, pos_jj_pair).norm(dim=-1)
+        angle1 = torch.atan2(b, a)
+
+        # Get sbf embeddings
+        sbf1 = self.sbf(dist_l, angle1, idx_jj_pair)
+        sbf2 = self.sbf(dist_l, angle2, idx_kj)
+        edge_attr_sbf1 = self.mlp_sbf1(sbf1)
+        edge_attr_sbf2 = self.mlp_sbf2(sbf2)
+        return edge_attr_rbf_l, edge_attr_sbf2, edge_attr_sbf1, idx_kj, idx_ji, idx_jj_pair, idx_ji_pair, edge_index_l
     
     def fine_tuning(self):
         # freeze all layers
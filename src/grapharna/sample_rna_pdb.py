@@ -1,5 +1,6 @@
 import os
 import argparse
+import json
 import torch
 from torch_geometric.loader import DataLoader
 from torch_geometric import seed_everything
@@ -9,9 +10,9 @@ import numpy as np
 
 from grapharna import dot_to_bpseq, process_rna_file
 from grapharna.datasets import RNAPDBDataset
-from grapharna.utils import Sampler, read_dotseq_file
+from grapharna.utils import Sampler, estimate_cost, read_dotseq_file
 from grapharna.main_rna_pdb import sample
-from grapharna.models import PAMNet, Config
+from grapharna.models import PAMNet, Config, ComputeSchedule, FeatureCache
 
 
 
@@ -23,7 +24,7 @@ def set_seed(seed):
     torch.backends.cudnn.deterministic = True
     torch.backends.cudnn.benchmark = False
 
-def main():
+def build_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument('--input', type=str, default=None, help='Input file in *.dotseq format')
     parser.add_argument('--output-folder', type=str, default=None, help='Output file path')
@@ -44,43 +45,20 @@ def main():
     parser.add_argument('--knns', type=int, default=20, help='Number of knns')
     parser.add_argument('--blocks', type=int, default=6, help='Number of transformer blocks')
     parser.add_argument('--sampling-resids', type=str, default=None, help='Residues that will be sampled, while the rest of the structure will remain fixed')
+    parser.add_argument('--template', type=str, default=None, help='PDB/CIF structure with the coordinates of the fixed residues (use with --sampling-resids)')
+    parser.add_argument('--compute-schedule', type=str, default=None, help='Reduced compute in the noisy steps, e.g. "0.6:knns=8,local=skip,n_layer=3;0.3:local=pairs" (see ComputeSchedule)')
+    parser.add_argument('--feature-cache-every', type=int, default=None, help='Recompute the deep features of the model every N steps and reuse them in between (see FeatureCache)')
+    parser.add_argument('--feature-cache-drift', type=float, default=None, help='Recompute the deep features earlier if the relative RMS change of the coordinates exceeds this value')
+    parser.add_argument('--init-structure', type=str, default=None, help='PDB/CIF structure to refine instead of sampling from pure noise (use with --start-t)')
+    parser.add_argument('--start-t', type=int, default=None, help='Timestep to which the initial structure is noised before denoising (warm start)')
+    parser.add_argument('--time-budget', type=float, default=None, help='Sampling time budget in seconds per batch; the timesteps are strided to fit into it')
+    parser.add_argument('--num-samples', type=int, default=1, help='Number of structures sampled for each input')
+    parser.add_argument('--fork-step', type=int, default=0, help='With --num-samples > 1, number of initial (high noise) steps shared by all samples of an input')
+    parser.add_argument('--estimate', action='store_true', help='Print the estimated peak memory and runtime of the sampling as JSON instead of sampling')
     # parser.add_argument('--fixed-ps', action='store_true', help='If True, P atoms will be fixed and the rest of the structure will be generated. Otherwise, the whole structure will be generated')
-    args = parser.parse_args()
-
-    print('Seed:', args.seed)
-    set_seed(args.seed)
-    # Load the model
-    exp_name = "grapharna"
-    epoch = 800
-    model_path = f"save/{exp_name}/model_{epoch}.h5"
-    
-    if args.input is None and args.dataset is None:
-        # print help message
-        print("Please provide input file (or dataset name).")
-        return
-    elif args.input is not None and args.dataset is not None:
-        print("Please provide only one of the following: input file or dataset name.")
-        return
-    elif args.dataset is not None and args.output_name is not None:
-        print("Cannot use --output-name with --dataset. This option is only allowed when using --input.")
-        return
-
-    if args.input is not None:
-        # generate input file
-        print(args.input)
-        _, dot, seq = read_dotseq_file(args.input)
-        name = os.path.basename(args.input)
-        dir_name = name.replace(".dotseq", "")
-        bpseq = dot_to_bpseq(dot)
-        process_rna_file(rna_file=args.input,
-                         seq_segments=seq,
-                         file_3d_type=".dotseq",
-                         sampling=True,
-                         save_dir_full=f"data/user_inputs/{dir_name}",
-                         name = name,
-                         res_pairs=bpseq)
-        print(f"Input file generated at! data/user_inputs/{dir_name}")
+    return parser
 
+def load_model(args, model_path, device):
     config = Config(dataset=args.dataset,
                     dim=args.dim,
                     n_layer=args.n_layer,
@@ -91,7 +69,6 @@ def main():
                     transformer_blocks=args.blocks
                     )
     
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     model = PAMNet(config)
     model.load_state_dict(torch.load(model_path, map_location=device), strict=False)
     print("Model loaded!")
@@ -99,13 +76,132 @@ def main():
     
     print("Device: ", device)
     model.to(device)
-    ds = RNAPDBDataset("data/user_inputs/", name=dir_name, mode='coarse-grain')
-    
+    return model
+
+def build_sampler(args):
+    compute_schedule = None
+    if args.compute_schedule is not None:
+        compute_schedule = ComputeSchedule.parse(args.compute_schedule, args.timesteps)
+        print("Compute schedule:", compute_schedule)
+    feature_cache = None
+    if getattr(args, 'feature_cache_every', None) is not None:
+        feature_cache = FeatureCache(every=args.feature_cache_every, drift=args.feature_cache_drift)
+    return Sampler(timesteps=args.timesteps, compute_schedule=compute_schedule, feature_cache=feature_cache)
+
+MODEL_PATH = "save/grapharna/model_800.h5"
+
+def validate_args(args):
+    """
+    Returns the error message for an invalid combination of the arguments, None if they are valid.
+    """
+    if args.input is None and args.dataset is None:
+        return "Please provide input file (or dataset name)."
+    elif args.input is not None and args.dataset is not None:
+        return "Please provide only one of the following: input file or dataset name."
+    elif args.dataset is not None and args.output_name is not None:
+        return "Cannot use --output-name with --dataset. This option is only allowed when using --input."
+    elif args.input is not None and args.sampling_resids is not None and args.template is None:
+        return "Please provide --template with the coordinates of the fixed residues when using --sampling-resids."
+    elif args.init_structure is not None and (args.input is None or args.start_t is None):
+        return "--init-structure requires --input and --start-t."
+    elif args.template is not None and args.sampling_resids is None:
+        return "--template requires --sampling-resids, the residues to resample."
+    elif args.input is not None and args.start_t is not None and args.init_structure is None:
+        return "Please provide --init-structure with the structure to refine when using --start-t with --input."
+    elif args.time_budget is not None and (args.start_t is not None or args.num_samples > 1 or args.sampling_resids is not None):
+        return "--time-budget cannot be combined with --start-t, --num-samples or --sampling-resids."
+    elif args.init_structure is not None and args.template is not None:
+        return "Please provide only one of the following: --template or --init-structure."
+    return None
+
+def prepare_input(args, data_dir="data/user_inputs", dir_name=None):
+    """
+    Converts the *.dotseq input (and the template or initial structure, if any) to the graph of the model,
+    stored in `data_dir`/`dir_name`. Returns `dir_name`, by default the name of the input file.
+    """
+    print(args.input)
+    _, dot, seq = read_dotseq_file(args.input)
+    name = os.path.basename(args.input)
+    if dir_name is None:
+        dir_name = name.replace(".dotseq", "")
+    bpseq = dot_to_bpseq(dot)
+    structure = args.template if args.template is not None else args.init_structure
+    if structure is not None:
+        # read the coordinates of the template instead of generating an empty structure
+        template_type = os.path.splitext(structure)[1]
+        process_rna_file(rna_file=structure,
+                         seq_segments=seq,
+                         file_3d_type=template_type,
+                         sampling=False,
+                         save_dir_full=os.path.join(data_dir, dir_name),
+                         name = dir_name + template_type,
+                         res_pairs=bpseq)
+    else:
+        process_rna_file(rna_file=args.input,
+                         seq_segments=seq,
+                         file_3d_type=".dotseq",
+                         sampling=True,
+                         save_dir_full=os.path.join(data_dir, dir_name),
+                         name = name,
+                         res_pairs=bpseq)
+    print(f"Input file generated at! {os.path.join(data_dir, dir_name)}")
+    return dir_name
+
+def run(args, model, sampler, device, dir_name, data_dir="data/user_inputs"):
+    """
+    Samples the structures of the dataset `data_dir`/`dir_name` with a loaded model.
+    """
+    ds = RNAPDBDataset(data_dir, name=dir_name, mode='coarse-grain')
     ds_loader = DataLoader(ds, batch_size=args.batch_size, shuffle=False, pin_memory=True)
-    sampler = Sampler(timesteps=args.timesteps)
     print("Sampling...")
-    sample(model, ds_loader, device, sampler, epoch, args, num_batches=None, exp_name=f"{exp_name}-seed={args.seed}", output_folder=args.output_folder, output_name=args.output_name)
-    print(f"Results stored in path: ",  args.output_folder if args.output_folder is not None else f"samples/{exp_name}")
+    sample(model, ds_loader, device, sampler, 800, args, num_batches=None, exp_name=f"grapharna-seed={args.seed}", output_folder=args.output_folder, output_name=args.output_name)
+    if sampler.feature_cache is not None:
+        print("Feature cache:", sampler.feature_cache.stats())
+
+def planned_steps(args):
+    """
+    Denoising steps of the sampling with the options of `args` (an ensemble forks after `fork_step` of them).
+    """
+    if args.start_t is not None:
+        return min(args.start_t, args.timesteps - 1) + 1
+    return args.timesteps
+
+def estimate(args, model, sampler, dir_name, data_dir="data/user_inputs"):
+    """
+    Estimated cost of sampling the first batch of the dataset `data_dir`/`dir_name` (see utils.estimate_cost).
+    """
+    device = next(model.parameters()).device
+    ds = RNAPDBDataset(data_dir, name=dir_name, mode='coarse-grain')
+    data, name, seqs = next(iter(DataLoader(ds, batch_size=args.batch_size, shuffle=False)))
+    cost = estimate_cost(model, sampler, data.to(device), seqs, steps=planned_steps(args),
+                         num_samples=args.num_samples, fork_step=args.fork_step)
+    if args.time_budget is not None: # the steps are strided to fit into the budget
+        cost["total_seconds"] = min(cost["total_seconds"], args.time_budget)
+    return cost
+
+def main():
+    args = build_parser().parse_args()
+
+    print('Seed:', args.seed)
+    set_seed(args.seed)
+    error = validate_args(args)
+    if error is not None:
+        print(error)
+        return
+
+    if args.input is not None:
+        # generate input file
+        dir_name = prepare_input(args)
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    # Load the model
+    model = load_model(args, MODEL_PATH, device)
+    sampler = build_sampler(args)
+    if args.estimate:
+        print(json.dumps(estimate(args, model, sampler, dir_name), indent=2))
+        return
+    run(args, model, sampler, device, dir_name)
+    print(f"Results stored in path: ",  args.output_folder if args.output_folder is not None else f"samples/grapharna")
 
 if __name__ == "__main__":
     main()
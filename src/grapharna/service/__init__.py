@@ -0,0 +1,23 @@
+from .jobs import Job
+from .executor import Executor
+from .worker import WorkerPool, SamplingRunner, default_num_workers
+from .zygote import Zygote
+from .spool import Spool, SpoolExecutor, SpoolWorker
+from .cache import ResultCache, file_digest
+from .policy import CostModel, MemoryModel, FifoQueue, ShortestJobFirst
+from .postprocess import Annotator, run_arena, run_annotator
+from .store import JobStore
+from .results import ResultBuffer, pack_result
+from .scheduler import Scheduler, JobRecord, QueueFull, JobTooLarge
+from .metrics import Metrics
+
+__all__ = [
+    "Job",
+    "Executor", "WorkerPool", "Zygote", "SamplingRunner", "default_num_workers",
+    "Spool", "SpoolExecutor", "SpoolWorker",
+    "ResultCache", "file_digest",
+    "CostModel", "MemoryModel", "FifoQueue", "ShortestJobFirst",
+    "Annotator", "run_arena", "run_annotator",
+    "JobStore", "ResultBuffer", "pack_result", "Scheduler", "JobRecord", "QueueFull", "JobTooLarge",
+    "Metrics"
+]
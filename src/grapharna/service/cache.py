@@ -0,0 +1,128 @@
+import hashlib
+import os
+import shutil
+import threading
+from collections import OrderedDict
+
+from grapharna.utils.prepare_user_input import read_dotseq_file
+
+
+def file_digest(path, chunk_size: int = 1 << 20):
+    """
+    SHA-256 of a file, e.g. of the model checkpoint.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def copy_results(source, target):
+    # copies the PDB and JSON of the job `source` to the paths of the job `target`
+    for src, dst in [(source.pdb_path, target.pdb_path), (source.json_path, target.json_path)]:
+        if src != dst:
+            shutil.copyfile(src, dst)
+
+
+class ResultCache():
+    """
+    Content-addressed cache of the results (PDB and JSON) of the service, stored in `directory`.
+    The key is a hash of the normalized input (the sequence and the dot-bracket, without the name and whitespace),
+    the seed, the digest of the model checkpoint and the sampling settings, so a resubmitted input gets the stored
+    result instead of being sampled again. The least recently used results are evicted above `max_bytes`.
+    """
+    def __init__(self, directory: str, max_bytes: int = 10 * 1024 ** 3, model_digest: str = "", settings: str = ""):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.model_digest = model_digest
+        self.settings = settings
+        self.entries = OrderedDict() # key -> size in bytes, the least recently used first
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.load()
+
+    def path(self, key, extension):
+        return os.path.join(self.directory, key + extension)
+
+    def load(self):
+        # entries stored by a previous run, ordered by their last use
+        found = []
+        for file in os.listdir(self.directory):
+            key, extension = os.path.splitext(file)
+            if extension == ".pdb" and os.path.exists(self.path(key, ".json")):
+                found.append((os.path.getmtime(self.path(key, ".pdb")), key))
+        for _, key in sorted(found):
+            self.entries[key] = os.path.getsize(self.path(key, ".pdb")) + os.path.getsize(self.path(key, ".json"))
+            self.size += self.entries[key]
+        self.evict()
+
+    def key(self, job):
+        _, dot, seq_segments = read_dotseq_file(job.input_path)
+        content = [" ".join(s.upper() for s in seq_segments), dot, str(job.seed), self.model_digest, self.settings]
+        return hashlib.sha256("\n".join(content).encode()).hexdigest()
+
+    def fetch(self, key, job) -> bool:
+        """
+        Copies the stored result to the output paths of the job. Returns False if the result is not cached.
+        """
+        with self.lock:
+            if key in self.entries:
+                try:
+                    shutil.copyfile(self.path(key, ".pdb"), job.pdb_path)
+                    shutil.copyfile(self.path(key, ".json"), job.json_path)
+                    os.utime(self.path(key, ".pdb"))
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return True
+                except OSError as e:
+                    print(f"Cannot read the cached result {key}: {e}")
+                    self.remove(key)
+            self.misses += 1
+            return False
+
+    def store(self, key, job):
+        """
+        Stores the result of a completed job.
+        """
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return
+            try:
+                # the JSON is written last, an entry without it is ignored by load()
+                for src, extension in [(job.pdb_path, ".pdb"), (job.json_path, ".json")]:
+                    shutil.copyfile(src, self.path(key, extension) + ".tmp")
+                    os.replace(self.path(key, extension) + ".tmp", self.path(key, extension))
+            except OSError as e:
+                print(f"Cannot cache the result of {job.id}: {e}")
+                return
+            self.entries[key] = os.path.getsize(self.path(key, ".pdb")) + os.path.getsize(self.path(key, ".json"))
+            self.size += self.entries[key]
+            self.evict()
+
+    def remove(self, key):
+        # called with the lock held
+        self.size -= self.entries.pop(key, 0)
+        for extension in [".pdb", ".json"]:
+            try:
+                os.remove(self.path(key, extension))
+            except OSError:
+                pass
+
+    def evict(self):
+        while self.size > self.max_bytes and self.entries:
+            self.remove(next(iter(self.entries)))
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.,
+            "entries": len(self.entries),
+            "bytes": self.size,
+        }
@@ -0,0 +1,122 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+
+class Executor():
+    """
+    Base class of the executors of sampling jobs (WorkerPool, Zygote). Jobs wait in `pending` until the executor
+    has a free slot (see dispatch), so a queued job is cancelled without touching the running ones.
+    Subclasses implement dispatch, cancel_running, num_running and capacity, and call finish when a job is done.
+    The futures are resolved by resolve(), outside of the lock, because their callbacks may submit new jobs.
+    The progress reports of the running jobs are passed to the `progress(job_id, payload)` callback.
+    """
+    def __init__(self):
+        self.pending = deque()
+        self.submitted = {} # job id -> submission time of the pending jobs
+        self.futures = {}
+        self.outbox = []
+        self.lock = threading.Lock()
+        self.running = False
+        self.error = None
+        self.progress = None
+
+    def submit(self, job) -> Future:
+        """
+        Queues the job. The future resolves to the payload reported by the job (with the sampling time in "seconds").
+        """
+        future = Future()
+        with self.lock:
+            if self.error is not None:
+                future.set_exception(RuntimeError(f"Workers failed to start: {self.error}"))
+                return future
+            if job.id in self.futures:
+                raise ValueError(f"Job {job.id} is already submitted")
+            self.futures[job.id] = (job, future)
+            self.submitted[job.id] = time.monotonic()
+            self.pending.append(job)
+            self.dispatch()
+        return future
+
+    def cancel(self, job_id) -> bool:
+        with self.lock:
+            if job_id not in self.futures:
+                return False
+            job, future = self.futures.pop(job_id)
+            if job in self.pending:
+                self.pending.remove(job)
+                self.submitted.pop(job.id, None)
+            else:
+                self.cancel_running(job)
+            self.dispatch()
+        future.cancel()
+        return True
+
+    @property
+    def num_pending(self):
+        return len(self.pending)
+
+    @property
+    def num_running(self):
+        raise NotImplementedError
+
+    @property
+    def capacity(self):
+        # number of jobs run at the same time
+        raise NotImplementedError
+
+    def dispatch(self):
+        # starts pending jobs, called with the lock held
+        raise NotImplementedError
+
+    def take(self):
+        # removes the next pending job, called with the lock held
+        job = self.pending.popleft()
+        self.submitted.pop(job.id, None)
+        return job
+
+    def cancel_running(self, job):
+        # called with the lock held
+        raise NotImplementedError
+
+    def report(self, job_id, payload):
+        # progress of a running job, called without the lock
+        if self.progress is not None and job_id in self.futures:
+            self.progress(job_id, payload)
+
+    def finish(self, job_id, result=None, error=None):
+        # called with the lock held
+        entry = self.futures.pop(job_id, None)
+        if entry is None:
+            return # cancelled
+        if error is None:
+            self.outbox.append((entry[1], "result", result))
+        else:
+            self.outbox.append((entry[1], "error", error))
+
+    def fail_all(self, error):
+        # called with the lock held
+        for job_id in list(self.futures):
+            self.finish(job_id, error=error)
+        self.pending.clear()
+        self.submitted.clear()
+
+    def cancel_all(self):
+        # called with the lock held
+        for job_id in list(self.futures):
+            self.outbox.append((self.futures.pop(job_id)[1], "cancel", None))
+        self.pending.clear()
+        self.submitted.clear()
+
+    def resolve(self):
+        # resolves the futures of the finished jobs, called without the lock
+        with self.lock:
+            outbox, self.outbox = self.outbox, []
+        for future, kind, value in outbox:
+            if kind == "result":
+                future.set_result(value)
+            elif kind == "error":
+                future.set_exception(RuntimeError(value))
+            else:
+                future.cancel()
@@ -0,0 +1,49 @@
+import os
+
+from grapharna.utils.prepare_user_input import read_dotseq_file
+
+
+class Job():
+    """
+    A single sampling request of the service: the *.dotseq input `input_path` sampled with `seed`.
+    The results are stored in `output_folder` as {uuid}_{seed}.pdb / .json, errors as {uuid}_{seed}.err.
+    """
+    def __init__(self, uuid: str, seed: int, input_path: str, output_folder: str):
+        self.uuid = uuid
+        self.seed = seed
+        self.input_path = input_path
+        self.output_folder = output_folder
+        self._num_residues = None
+
+    @property
+    def id(self):
+        return f"{self.uuid}_{self.seed}"
+
+    @property
+    def output_name(self):
+        return self.id
+
+    @property
+    def num_residues(self):
+        """
+        Length of the input sequence, read from the *.dotseq file.
+        """
+        if self._num_residues is None:
+            _, _, seq_segments = read_dotseq_file(self.input_path)
+            self._num_residues = sum(len(s) for s in seq_segments)
+        return self._num_residues
+
+    @property
+    def pdb_path(self):
+        return os.path.join(self.output_folder, self.output_name + ".pdb")
+
+    @property
+    def json_path(self):
+        return os.path.join(self.output_folder, self.output_name + ".json")
+
+    @property
+    def error_path(self):
+        return os.path.join(self.output_folder, self.output_name + ".err")
+
+    def __repr__(self):
+        return f"Job({self.id})"
@@ -0,0 +1,152 @@
+import threading
+
+from grapharna.service.scheduler import ACTIVE_STATES
+
+# upper bounds of the buckets of the histograms
+STAGE_BUCKETS = [0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200]
+RATE_BUCKETS = [0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500]
+MEMORY_BUCKETS = [2 ** i * 1024 ** 2 for i in range(7, 16)] # 128 MiB to 32 GiB
+CPU_BUCKETS = [1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, 7200, 14400]
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels.items()) + "}"
+
+
+class Histogram():
+    """
+    Prometheus histogram: the number of observations up to each bucket bound, their sum and their count.
+    """
+    def __init__(self, buckets):
+        self.buckets = list(buckets) + [float("inf")]
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labels=None):
+        labels = labels or {}
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f"{name}_bucket{format_labels({**labels, 'le': format_value(bound)})} {cumulative}")
+        lines.append(f"{name}_sum{format_labels(labels)} {format_value(self.sum)}")
+        lines.append(f"{name}_count{format_labels(labels)} {self.count}")
+        return lines
+
+
+class Metrics():
+    """
+    Metrics of the service in the Prometheus text format (see render): the time spent by the jobs in each stage,
+    the sampling speed and the resources used by the jobs (reported by the executor with their result), the number
+    of finished jobs, and the current state of the scheduler (queues, active jobs, workers and result cache).
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stage_seconds = {} # state -> Histogram
+        self.steps_per_second = Histogram(RATE_BUCKETS)
+        self.peak_rss_bytes = Histogram(MEMORY_BUCKETS)
+        self.cpu_seconds = Histogram(CPU_BUCKETS)
+        self.preprocess_seconds = Histogram(STAGE_BUCKETS)
+        self.model_load_seconds = None
+        self.finished = {} # final state -> number of jobs
+
+    def observe_stage(self, state, seconds):
+        with self.lock:
+            if state not in self.stage_seconds:
+                self.stage_seconds[state] = Histogram(STAGE_BUCKETS)
+            self.stage_seconds[state].observe(seconds)
+
+    def observe_job(self, payload):
+        """
+        Records the resources used by a sampled job, from the payload of its result.
+        """
+        with self.lock:
+            for key, histogram in [("steps_per_second", self.steps_per_second), ("peak_rss_bytes", self.peak_rss_bytes),
+                                   ("cpu_seconds", self.cpu_seconds), ("preprocess_seconds", self.preprocess_seconds)]:
+                if payload.get(key) is not None:
+                    histogram.observe(payload[key])
+            if payload.get("model_load_seconds") is not None:
+                self.model_load_seconds = payload["model_load_seconds"]
+
+    def observe_finished(self, state):
+        with self.lock:
+            self.finished[state] = self.finished.get(state, 0) + 1
+
+    def render(self, scheduler) -> str:
+        lines = []
+
+        def metric(name, kind, help, samples):
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+
+        with scheduler.lock:
+            metric("grapharna_queue_depth", "gauge", "Jobs waiting to be sampled.",
+                   [({"lane": lane.name}, len(lane.queue)) for lane in scheduler.lanes])
+            active = {}
+            for record in scheduler.records.values():
+                if record.active:
+                    active[record.state] = active.get(record.state, 0) + 1
+            metric("grapharna_active_jobs", "gauge", "Active jobs by state.",
+                   [({"state": state}, active.get(state, 0)) for state in ACTIVE_STATES])
+            metric("grapharna_stage_waiting", "gauge", "Jobs waiting for a post-processing stage.",
+                   [({"stage": stage.name}, stage.waiting) for stage in scheduler.stages])
+            metric("grapharna_stage_running", "gauge", "Jobs running in a post-processing stage.",
+                   [({"stage": stage.name}, stage.running) for stage in scheduler.stages])
+            metric("grapharna_deduplicated_jobs_total", "counter", "Jobs attached to an identical active job.",
+                   [({}, scheduler.deduplicated)])
+        metric("grapharna_executor_running_jobs", "gauge", "Jobs sampled by the executor.",
+               [({}, scheduler.executor.num_running)])
+        metric("grapharna_executor_capacity", "gauge", "Jobs the executor samples at the same time.",
+               [({}, scheduler.executor.capacity)])
+        if scheduler.cache is not None:
+            stats = scheduler.cache.stats()
+            metric("grapharna_cache_hits_total", "counter", "Jobs served from the result cache.", [({}, stats["hits"])])
+            metric("grapharna_cache_misses_total", "counter", "Jobs not found in the result cache.", [({}, stats["misses"])])
+            metric("grapharna_cache_hit_ratio", "gauge", "Hit rate of the result cache.", [({}, stats["hit_rate"])])
+            metric("grapharna_cache_entries", "gauge", "Results stored in the result cache.", [({}, stats["entries"])])
+            metric("grapharna_cache_bytes", "gauge", "Size of the result cache.", [({}, stats["bytes"])])
+
+        with self.lock:
+            metric("grapharna_jobs_finished_total", "counter", "Finished jobs by final state.",
+                   [({"state": state}, count) for state, count in sorted(self.finished.items())])
+            if self.model_load_seconds is not None:
+                metric("grapharna_model_load_seconds", "gauge", "Time to load the model in the last started worker.",
+                       [({}, self.model_load_seconds)])
+            histograms = [
+                ("grapharna_stage_seconds", "Time spent by the jobs in each state.",
+                 [({"stage": state}, histogram) for state, histogram in self.stage_seconds.items()]),
+                ("grapharna_sampling_steps_per_second", "Denoising steps per second of the sampled jobs.",
+                 [({}, self.steps_per_second)]),
+                ("grapharna_job_peak_rss_bytes", "Peak resident memory of the worker during a job.",
+                 [({}, self.peak_rss_bytes)]),
+                ("grapharna_job_cpu_seconds", "CPU time of the sampled jobs.", [({}, self.cpu_seconds)]),
+                ("grapharna_preprocess_seconds", "Time to prepare the input of the sampled jobs.",
+                 [({}, self.preprocess_seconds)]),
+            ]
+            for name, help, samples in histograms:
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} histogram")
+                for labels, histogram in samples:
+                    lines.extend(histogram.render(name, labels))
+        return "\n".join(lines) + "\n"
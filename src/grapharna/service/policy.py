@@ -0,0 +1,137 @@
+import math
+import time
+from collections import deque
+
+import numpy as np
+
+
+class CostModel():
+    """
+    Runtime of the sampling of an RNA with n residues, seconds = a * n ** b. The cost grows super-linearly with
+    the length (knn graphs, triplets and the attention of SequenceStructureModule). The parameters are refitted
+    (least squares in log-log space) to the last `max_samples` observed runtimes once there are `min_samples` of them.
+    """
+    def __init__(self, a: float = 2.0, b: float = 1.5, min_samples: int = 5, max_samples: int = 1000):
+        self.a = a
+        self.b = b
+        self.min_samples = min_samples
+        self.samples = deque(maxlen=max_samples)
+
+    def estimate(self, num_residues):
+        return self.a * num_residues ** self.b
+
+    def observe(self, num_residues, seconds):
+        if num_residues <= 0 or seconds <= 0:
+            return
+        self.samples.append((math.log(num_residues), math.log(seconds)))
+        if len(self.samples) < self.min_samples:
+            return
+        x, y = np.array(self.samples).T
+        if np.ptp(x) == 0: # a single length, only the scale can be fitted
+            self.a = math.exp(np.mean(y - self.b * x))
+            return
+        self.b, log_a = np.polyfit(x, y, 1)
+        self.a = math.exp(log_a)
+
+
+class MemoryModel():
+    """
+    Peak memory of the sampling of an RNA with n residues, bytes = base + linear * n + quadratic * n ** 2: the weights
+    of the model, the knn, cutoff and triplet graphs (linear in the atoms) and the attention of SequenceStructureModule
+    (quadratic). The defaults can be calibrated with `grapharna --estimate`. The coefficients are refitted (least squares)
+    to the last `max_samples` observed peaks once there are `min_samples` of them. A job that samples `copies`
+    structures together (an ensemble, grapharna --num-samples) holds the graphs and the attention of copies * n residues.
+    """
+    def __init__(self, base: float = 3 * 1024 ** 3, linear: float = 1024 ** 2, quadratic: float = 1600.,
+                 min_samples: int = 5, max_samples: int = 1000, copies: int = 1):
+        self.base = base
+        self.linear = linear
+        self.quadratic = quadratic
+        self.copies = copies
+        self.min_samples = min_samples
+        self.samples = deque(maxlen=max_samples)
+
+    def estimate(self, num_residues):
+        n = self.copies * num_residues
+        return self.base + self.linear * n + self.quadratic * n ** 2
+
+    def observe(self, num_residues, peak_bytes):
+        if num_residues <= 0 or peak_bytes <= 0:
+            return
+        self.samples.append((self.copies * num_residues, peak_bytes))
+        if len(self.samples) < self.min_samples:
+            return
+        n, y = np.array(self.samples, dtype=float).T
+        if len(np.unique(n)) < 3: # too few lengths for the shape, only the base is fitted
+            self.base = float(np.mean(y - self.linear * n - self.quadratic * n ** 2))
+            return
+        coefficients = np.linalg.lstsq(np.stack([np.ones_like(n), n, n ** 2], axis=1), y, rcond=None)[0]
+        if (coefficients >= 0).all(): # a negative term does not extrapolate to longer RNAs
+            self.base, self.linear, self.quadratic = (float(c) for c in coefficients)
+
+
+class FifoQueue():
+    """
+    Jobs in the order of submission.
+    """
+    def __init__(self):
+        self.records = deque()
+
+    def push(self, record):
+        self.records.append(record)
+
+    def pop(self):
+        return self.records.popleft()
+
+    def remove(self, record):
+        self.records.remove(record)
+
+    def ordered(self):
+        return list(self.records)
+
+    def __len__(self):
+        return len(self.records)
+
+
+class ShortestJobFirst():
+    """
+    Jobs ordered by their estimated runtime (JobRecord.estimate), shortest first. A waiting job gains `aging`
+    seconds of priority per second, so long jobs are not starved: a job estimated to take an hour longer than
+    the others starts at the latest after 3600 / aging seconds of waiting.
+    """
+    def __init__(self, aging: float = 1.0):
+        self.aging = aging
+        self.records = []
+
+    def priority(self, record, now):
+        return (record.estimate or 0.) - self.aging * (now - record.submitted)
+
+    def push(self, record):
+        self.records.append(record)
+
+    def pop(self):
+        now = time.time()
+        record = min(self.records, key=lambda r: self.priority(r, now))
+        self.records.remove(record)
+        return record
+
+    def remove(self, record):
+        self.records.remove(record)
+
+    def ordered(self):
+        now = time.time()
+        return sorted(self.records, key=lambda r: self.priority(r, now))
+
+    def __len__(self):
+        return len(self.records)
+
+
+class Lane():
+    """
+    A queue of the scheduler with its own limit of jobs sampled at the same time.
+    """
+    def __init__(self, name, queue, max_sampling):
+        self.name = name
+        self.queue = queue
+        self.max_sampling = max_sampling
+        self.sampling = 0
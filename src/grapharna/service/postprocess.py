@@ -0,0 +1,88 @@
+import os
+import subprocess
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def run_command(record, cmd, stage):
+    """
+    Runs a post-processing command of the job. The process is kept in the record, so that the job can be cancelled.
+    """
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    record.process = process
+    _, stderr = process.communicate()
+    record.process = None
+    if record.cancelled:
+        raise JobCancelled()
+    if process.returncode != 0:
+        raise RuntimeError(f"{stage} failed: {stderr.decode()}")
+
+
+def run_arena(record):
+    """
+    All-atom reconstruction of the sampled coarse-grained structure, in place.
+    """
+    job = record.job
+    run_command(record, ["Arena", job.pdb_path, job.pdb_path, "5"], "Arena")
+
+
+def run_annotator(record):
+    """
+    Secondary structure annotation of the reconstructed structure, stored in the JSON result of the job.
+    """
+    job = record.job
+    run_command(record, ["annotator", "--json", str(job.json_path), "--extended", str(job.pdb_path)], "Annotator")
+
+
+def import_rnapolis():
+    # initializer of the annotation processes
+    import rnapolis.annotator
+
+
+def annotate_file(pdb_path, json_path, find_gaps: bool = False):
+    """
+    Writes the secondary structure of the PDB/CIF file, as `annotator --json json_path pdb_path` does.
+    """
+    from rnapolis.annotator import extract_secondary_structure, write_json
+    from rnapolis.parser import read_3d_structure
+    from rnapolis.util import handle_input_file
+
+    structure3d = read_3d_structure(handle_input_file(pdb_path), None)
+    structure2d = extract_secondary_structure(structure3d, None, find_gaps)
+    write_json(json_path + ".tmp", structure2d)
+    os.replace(json_path + ".tmp", json_path) # the result is complete once the JSON exists
+
+
+class Annotator():
+    """
+    Secondary structure annotation with rnapolis, in a pool of `workers` processes that import it once,
+    instead of starting the annotator command for every job. Writes the same JSON as run_annotator.
+    """
+    def __init__(self, workers: int = 2, find_gaps: bool = False, context: str = 'spawn'):
+        self.workers = workers
+        self.find_gaps = find_gaps
+        self.ctx = mp.get_context(context)
+        self.pool = self.start()
+
+    def start(self):
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=self.ctx, initializer=import_rnapolis)
+
+    def __call__(self, record):
+        job = record.job
+        pool = self.pool
+        try:
+            pool.submit(annotate_file, job.pdb_path, job.json_path, self.find_gaps).result()
+        except BrokenProcessPool:
+            if self.pool is pool:
+                self.pool = self.start()
+            raise RuntimeError("Annotator failed: the annotation process died")
+        except Exception as e:
+            raise RuntimeError(f"Annotator failed: {type(e).__name__}: {e}")
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
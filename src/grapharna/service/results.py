@@ -0,0 +1,55 @@
+import gzip
+import json
+import os
+import shutil
+import threading
+from collections import OrderedDict
+
+
+def pack_result(job) -> bytes:
+    """
+    Result of a completed job as a gzip-compressed JSON document {"pdb": the PDB file, "json": the secondary structure}.
+    """
+    with open(job.pdb_path) as f:
+        pdb = f.read()
+    with open(job.json_path) as f:
+        structure = json.load(f)
+    return gzip.compress(json.dumps({"pdb": pdb, "json": structure}).encode(), compresslevel=6)
+
+
+def archive_result(job, directory):
+    """
+    Copies the PDB and JSON of a completed job to `directory`, e.g. on the shared filesystem.
+    """
+    for path in [job.pdb_path, job.json_path]:
+        target = os.path.join(directory, os.path.basename(path))
+        shutil.copyfile(path, target + ".tmp")
+        os.replace(target + ".tmp", target)
+
+
+class ResultBuffer():
+    """
+    Packed results (see pack_result) of the last completed jobs, kept in memory up to `max_bytes`, so that the
+    service delivers them in the response without reading the output files again. The oldest results are dropped first.
+    """
+    def __init__(self, max_bytes: int = 256 * 1024 ** 2):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict() # job id -> packed result, the oldest first
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def put(self, job_id, data: bytes):
+        with self.lock:
+            self.size -= len(self.entries.pop(job_id, b""))
+            self.entries[job_id] = data
+            self.size += len(data)
+            while self.size > self.max_bytes and self.entries:
+                self.size -= len(self.entries.popitem(last=False)[1])
+
+    def get(self, job_id):
+        with self.lock:
+            return self.entries.get(job_id)
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "bytes": self.size}
@@ -0,0 +1,591 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from grapharna.service.cache import copy_results
+from grapharna.service.policy import FifoQueue, Lane
+from grapharna.service.postprocess import JobCancelled, run_arena, run_annotator
+from grapharna.service.results import archive_result, pack_result
+
+QUEUED = "QUEUED"
+SAMPLING = "SAMPLING"
+ARENA = "ARENA"
+ANNOTATING = "ANNOTATING"
+COMPLETED = "COMPLETED"
+FAILED = "FAILED"
+CANCELLED = "CANCELLED"
+ACTIVE_STATES = [QUEUED, SAMPLING, ARENA, ANNOTATING]
+
+
+class QueueFull(Exception):
+    pass
+
+
+class JobTooLarge(Exception):
+    pass
+
+
+class JobRecord():
+    """
+    State of a job in the scheduler.
+    """
+    def __init__(self, job):
+        self.job = job
+        self.state = QUEUED
+        self.error = None
+        self.future = None
+        self.process = None # running post-processing command
+        self.stage_future = None # queued post-processing stage
+        self.lane = None
+        self.estimate = None # estimated sampling time [s]
+        self.memory = None # estimated peak memory of the sampling [bytes]
+        self.estimated = False # the estimates above are computed once, see Scheduler.estimate
+        self.key = None # key of the result cache
+        self.cached = False # served from the result cache
+        self.leader = None # identical active job whose result this job receives
+        self.followers = []
+        self.progress = None # last progress report of the sampling: step, total and eta
+        self.metrics = None # resources used by the sampling, reported by the executor
+        self.timings = {} # state -> seconds spent in it
+        self.last_state = None
+        self.last_time = None
+        self.submitted = time.time()
+        self.done = threading.Event()
+
+    @property
+    def active(self):
+        return self.state in ACTIVE_STATES
+
+    @property
+    def cancelled(self):
+        return self.state == CANCELLED
+
+    def stage_seconds(self):
+        """
+        Seconds spent in each state, including the current one.
+        """
+        timings = dict(self.timings)
+        if self.last_state is not None and self.active:
+            timings[self.last_state] = timings.get(self.last_state, 0.) + time.time() - self.last_time
+        return timings
+
+
+class Stage():
+    """
+    A post-processing stage of the pipeline: runs `run(record)` for the jobs of its queue in its own pool of `workers` threads.
+    """
+    def __init__(self, name, run, workers: int):
+        self.name = name
+        self.run = run
+        self.workers = workers
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name.lower())
+        self.waiting = 0
+        self.running = 0
+
+
+class Scheduler():
+    """
+    Job scheduler of the service. Jobs wait in a bounded queue (submit raises QueueFull when it is full) and
+    at most `max_sampling` of them are sampled by the executor at the same time. The sampled structures go through
+    a pipeline of post-processing stages, `arena` and `annotate` (called with the JobRecord), each with its own
+    queue and pool of `max_arena` and `max_annotate` threads, so a sampling slot is freed as soon as the structure
+    is sampled. Failed and cancelled jobs store their error in the .err file.
+
+    `queue` orders the waiting jobs (FifoQueue by default, or policy.ShortestJobFirst), using the sampling time
+    estimated by `cost_model` from the length of the input. The cost model is refitted to the observed times.
+    With `large_job_seconds`, the jobs estimated to take longer wait in a separate lane (ordered by `large_queue`)
+    and only `max_large` of them are sampled at the same time, so they never occupy all the workers.
+
+    With a `memory_model` (policy.MemoryModel), the peak memory of the sampling is estimated from the length of the
+    input and refitted to the peaks reported by the executor. submit raises JobTooLarge for the jobs estimated to need
+    more than `max_job_bytes`, and with `large_job_bytes` the jobs estimated to need more wait in the large lane.
+
+    With a `cache` (ResultCache), the results of identical inputs are served from the cache, and a job identical
+    to an active one (with another uuid) follows it instead of being sampled again.
+
+    The changes of the state and the progress of a job are published to the callbacks registered with subscribe().
+    With a `store` (JobStore), the state transitions are stored durably and recover() resumes the jobs that were
+    active when the service stopped.
+
+    With `metrics` (metrics.Metrics), the time spent by the jobs in each state and the resources used by their
+    sampling are recorded, and added to the JSON result of every completed job under "metrics".
+
+    With `results` (results.ResultBuffer), the PDB and JSON of a completed job are packed in memory before it is
+    reported as completed, so they are delivered without reading the output folder. With `archive_dir`, the results
+    are also copied there in the background, e.g. when the output folder is a local scratch directory.
+    """
+    def __init__(self, executor, max_queue: int = 100, max_sampling: int = None, max_arena: int = 2, max_annotate: int = 2,
+                 arena=run_arena, annotate=run_annotator, max_records: int = 10000,
+                 queue=None, cost_model=None, large_job_seconds: float = None, max_large: int = 1, large_queue=None,
+                 cache=None, store=None, metrics=None, results=None, archive_dir: str = None,
+                 memory_model=None, max_job_bytes: int = None, large_job_bytes: int = None):
+        self.executor = executor
+        self.max_queue = max_queue
+        self.cost_model = cost_model
+        self.large_job_seconds = large_job_seconds
+        self.memory_model = memory_model
+        self.max_job_bytes = max_job_bytes
+        self.large_job_bytes = large_job_bytes
+        large_lane = large_job_seconds is not None or large_job_bytes is not None
+        if max_sampling is None:
+            max_sampling = executor.capacity
+            if large_lane:
+                max_sampling = max(1, max_sampling - max_large)
+        self.lanes = [Lane("default", queue if queue is not None else FifoQueue(), max_sampling)]
+        if large_lane:
+            self.lanes.append(Lane("large", large_queue if large_queue is not None else FifoQueue(), max_large))
+        self.stages = [Stage(ARENA, arena, max_arena), Stage(ANNOTATING, annotate, max_annotate)]
+        self.max_records = max_records
+        self.cache = cache
+        self.store = store
+        self.metrics = metrics
+        self.results = results
+        self.archive_dir = archive_dir
+        self.archiver = ThreadPoolExecutor(max_workers=1, thread_name_prefix="archive") if archive_dir is not None else None
+        if archive_dir is not None:
+            os.makedirs(archive_dir, exist_ok=True)
+        self.deduplicated = 0
+        self.dispatching = False
+        self.redispatch = False
+
+        self.records = {}
+        self.inflight = {} # cache key -> active record that samples it
+        self.subscribers = {} # job id -> callbacks
+        executor.progress = self.progressed
+        self.finished = deque()
+        self.lock = threading.RLock() # the executor may call back while the lock is held
+
+    def submit(self, job, submitted: float = None) -> JobRecord:
+        """
+        Queues the job, or returns its record if the same job (uuid and seed) is already active.
+        A job served from the result cache is returned already completed. Raises JobTooLarge if the job is estimated
+        to need more memory than max_job_bytes.
+        `submitted` is the original submission time of a recovered job, which is queued even if the queue is full.
+        """
+        with self.lock:
+            record = self.records.get(job.id)
+            if record is not None and record.active:
+                return record
+            record = JobRecord(job)
+            if submitted is not None:
+                record.submitted = submitted
+            if self.cache is not None and self.serve(record):
+                return record
+            if self.queue_depth >= self.max_queue and submitted is None:
+                raise QueueFull(f"The queue is full ({self.max_queue} jobs)")
+            self.estimate(record)
+            if not self.admitted(record):
+                raise JobTooLarge(f"The job needs about {record.memory / 1024 ** 3:.1f} GiB of memory, "
+                                  f"more than the {self.max_job_bytes / 1024 ** 3:.1f} GiB of a worker")
+            if record.key is not None:
+                self.inflight[record.key] = record
+            self.records[job.id] = record
+            self.enqueue(record)
+            self.changed(record)
+            self.dispatch()
+        return record
+
+    def recover(self):
+        """
+        Resumes the jobs that were active when the service stopped, from the store. A job interrupted in Arena or
+        the annotator continues from that stage if its sampled PDB exists, the other jobs are queued again
+        (in the order of their submission). Returns the number of recovered jobs.
+        """
+        if self.store is None:
+            return 0
+        jobs = self.store.unfinished(ACTIVE_STATES)
+        # the post-processing is resumed first, so that the identical queued jobs follow it
+        jobs.sort(key=lambda entry: entry[1] not in [ARENA, ANNOTATING])
+        for job, state, submitted in jobs:
+            if state in [ARENA, ANNOTATING] and os.path.exists(job.pdb_path):
+                record = JobRecord(job)
+                record.submitted = submitted
+                with self.lock:
+                    if self.cache is not None:
+                        try:
+                            record.key = self.cache.key(job)
+                            self.inflight.setdefault(record.key, record)
+                        except (OSError, IndexError):
+                            pass
+                    self.records[job.id] = record
+                self.enter(record, [stage.name for stage in self.stages].index(state))
+            elif job.input_path is not None and os.path.exists(job.input_path):
+                try:
+                    self.submit(job, submitted=submitted)
+                except JobTooLarge as e:
+                    self.fail(JobRecord(job), str(e))
+            else:
+                self.fail(JobRecord(job), f"The input of the interrupted job is missing: {job.input_path}")
+        if jobs:
+            print(f"Recovered {len(jobs)} interrupted jobs")
+        return len(jobs)
+
+    def serve(self, record):
+        # serves the job from the result cache or attaches it to an identical active job, called with the lock held
+        try:
+            record.key = self.cache.key(record.job)
+        except (OSError, IndexError, TypeError) as e:
+            print(f"Cannot read {record.job.input_path}: {e}")
+            return False
+        if self.cache.fetch(record.key, record.job):
+            record.cached = True
+            self.records[record.job.id] = record
+            self.complete(record)
+            return True
+        leader = self.inflight.get(record.key)
+        if leader is None:
+            return False
+        record.leader = leader
+        record.state = leader.state
+        leader.followers.append(record)
+        self.records[record.job.id] = record
+        self.deduplicated += 1
+        self.changed(record)
+        return True
+
+    def estimate(self, record):
+        # estimates the sampling time and the peak memory of the job from the length of its input
+        if record.estimated or (self.cost_model is None and self.memory_model is None):
+            return
+        try:
+            num_residues = record.job.num_residues
+        except (OSError, IndexError) as e:
+            print(f"Cannot read the length of {record.job.input_path}: {e}")
+            return
+        if self.cost_model is not None:
+            record.estimate = self.cost_model.estimate(num_residues)
+        if self.memory_model is not None:
+            record.memory = self.memory_model.estimate(num_residues)
+        record.estimated = True
+
+    def admitted(self, record):
+        return self.max_job_bytes is None or record.memory is None or record.memory <= self.max_job_bytes
+
+    def enqueue(self, record):
+        # called with the lock held
+        self.estimate(record)
+        record.state = QUEUED
+        record.lane = self.lane_for(record)
+        record.lane.queue.push(record)
+
+    def lane_for(self, record):
+        if self.large_job_seconds is not None and record.estimate is not None and record.estimate > self.large_job_seconds:
+            return self.lanes[1]
+        if self.large_job_bytes is not None and record.memory is not None and record.memory > self.large_job_bytes:
+            return self.lanes[1]
+        return self.lanes[0]
+
+    def plan(self, job) -> dict:
+        """
+        Estimated sampling time [s] and peak memory [bytes] of the job (None without a cost or memory model),
+        the lane it would wait in and whether it would be admitted, without queueing it.
+        """
+        record = JobRecord(job)
+        with self.lock:
+            self.estimate(record)
+            return {"estimated_seconds": record.estimate, "estimated_memory_bytes": record.memory,
+                    "lane": self.lane_for(record).name, "admitted": self.admitted(record)}
+
+    def get(self, job_id):
+        return self.records.get(job_id)
+
+    def position(self, job_id):
+        """
+        Position of a queued job in its lane (1 for the next one to start), None if the job is not queued.
+        """
+        with self.lock:
+            record = self.records.get(job_id)
+            if record is not None and record.leader is not None:
+                record = record.leader
+            if record is None or record.state != QUEUED:
+                return None
+            return record.lane.queue.ordered().index(record) + 1
+
+    @property
+    def queue_depth(self):
+        return sum(len(lane.queue) for lane in self.lanes)
+
+    @property
+    def num_sampling(self):
+        return sum(lane.sampling for lane in self.lanes)
+
+    def dispatch(self):
+        # called with the lock held. The callback of a future that fails at once (sampled) calls dispatch from
+        # within the loop, it only asks for another pass instead of recursing once per queued job.
+        if self.dispatching:
+            self.redispatch = True
+            return
+        self.dispatching = True
+        try:
+            self.redispatch = True
+            while self.redispatch:
+                self.redispatch = False
+                for lane in self.lanes:
+                    while len(lane.queue) > 0 and lane.sampling < lane.max_sampling:
+                        record = lane.queue.pop()
+                        self.advance(record, SAMPLING)
+                        lane.sampling += 1
+                        record.future = self.executor.submit(record.job)
+                        record.future.add_done_callback(lambda future, record=record: self.sampled(record, future))
+        finally:
+            self.dispatching = False
+
+    def sampled(self, record, future):
+        with self.lock:
+            record.lane.sampling -= 1
+            self.dispatch()
+        if not future.cancelled() and future.exception() is None:
+            record.metrics = future.result()
+            if self.metrics is not None:
+                self.metrics.observe_job(record.metrics)
+            if self.cost_model is not None:
+                try:
+                    self.cost_model.observe(record.job.num_residues, record.metrics["seconds"])
+                except (OSError, IndexError, KeyError):
+                    pass
+            # the peak of a micro-batch is shared by its jobs, it says little about one of them
+            if self.memory_model is not None and record.metrics.get("batch_size", 1) == 1:
+                try:
+                    self.memory_model.observe(record.job.num_residues, record.metrics["peak_rss_bytes"])
+                except (OSError, IndexError, KeyError, TypeError):
+                    pass
+        if record.cancelled or future.cancelled():
+            self.fail(record, "Job cancelled", CANCELLED)
+        elif future.exception() is not None:
+            self.fail(record, str(future.exception()))
+        else:
+            self.enter(record, 0)
+
+    def enter(self, record, index):
+        # queues the job in the stage `index` of the pipeline, the job is completed after the last stage
+        if index == len(self.stages):
+            self.complete(record)
+            return
+        stage = self.stages[index]
+        with self.lock:
+            if record.cancelled:
+                self.fail(record, "Job cancelled", CANCELLED)
+                return
+            self.advance(record, stage.name)
+            stage.waiting += 1
+            record.stage_future = stage.pool.submit(self.process, record, index)
+
+    def process(self, record, index):
+        stage = self.stages[index]
+        with self.lock:
+            stage.waiting -= 1
+            stage.running += 1
+            record.stage_future = None
+        try:
+            if record.cancelled:
+                raise JobCancelled()
+            stage.run(record)
+            if record.cancelled:
+                raise JobCancelled()
+        except JobCancelled:
+            self.fail(record, "Job cancelled", CANCELLED)
+            return
+        except Exception as e:
+            self.fail(record, str(e))
+            return
+        finally:
+            with self.lock:
+                stage.running -= 1
+        self.enter(record, index + 1)
+
+    def subscribe(self, job_id, callback):
+        """
+        Calls `callback(record)` from the scheduler threads whenever the state or the progress of the job changes.
+        """
+        with self.lock:
+            self.subscribers.setdefault(job_id, []).append(callback)
+
+    def unsubscribe(self, job_id, callback):
+        with self.lock:
+            callbacks = self.subscribers.get(job_id, [])
+            if callback in callbacks:
+                callbacks.remove(callback)
+            if not callbacks:
+                self.subscribers.pop(job_id, None)
+
+    def changed(self, record):
+        # a state transition of the job
+        self.timed(record)
+        if self.store is not None:
+            try:
+                self.store.update(record)
+            except Exception as e:
+                print(f"Cannot store the state of {record.job.id}: {e}")
+        self.publish(record)
+
+    def timed(self, record):
+        # accumulates the time spent in the previous state
+        now = time.time()
+        if record.last_state == record.state:
+            return
+        if record.last_state is not None:
+            seconds = now - record.last_time
+            record.timings[record.last_state] = record.timings.get(record.last_state, 0.) + seconds
+            # the followers and the cached jobs would count the sampling of their leader again
+            if self.metrics is not None and record.leader is None and not record.cached:
+                self.metrics.observe_stage(record.last_state, seconds)
+        if self.metrics is not None and not record.active:
+            self.metrics.observe_finished(record.state)
+        record.last_state = record.state
+        record.last_time = now
+
+    def publish(self, record):
+        for callback in list(self.subscribers.get(record.job.id, [])):
+            try:
+                callback(record)
+            except Exception as e:
+                print(f"Progress subscriber of {record.job.id} failed: {e}")
+
+    def progressed(self, job_id, payload):
+        record = self.records.get(job_id)
+        if record is None or record.state != SAMPLING:
+            return
+        for r in [record] + list(record.followers):
+            r.progress = payload
+            self.publish(r)
+
+    def advance(self, record, state):
+        for r in [record] + list(record.followers):
+            r.state = state
+            self.changed(r)
+
+    def release(self, record):
+        # detaches the followers of a finished job
+        with self.lock:
+            if record.key is not None and self.inflight.get(record.key) is record:
+                del self.inflight[record.key]
+            followers, record.followers = record.followers, []
+        return followers
+
+    def complete(self, record):
+        if self.cache is not None and record.key is not None and not record.cached and record.leader is None:
+            self.cache.store(record.key, record.job)
+        if self.metrics is not None:
+            self.write_metrics(record)
+        if self.results is not None:
+            try:
+                self.results.put(record.job.id, pack_result(record.job))
+            except (OSError, ValueError) as e:
+                print(f"Cannot pack the result of {record.job.id}: {e}")
+        record.state = COMPLETED
+        followers = self.release(record)
+        self.retire(record)
+        self.changed(record)
+        if self.archiver is not None:
+            self.archiver.submit(self.archive, record.job)
+        for follower in followers:
+            if follower.cancelled:
+                continue
+            try:
+                copy_results(record.job, follower.job)
+            except OSError as e:
+                self.fail(follower, f"Cannot copy the result of {record.job.id}: {e}")
+                continue
+            self.complete(follower)
+
+    def write_metrics(self, record):
+        # adds the metrics of the job to its JSON result, after it is cached. A job served from the cache or
+        # following another one has no sampling metrics, only the time it spent in each state.
+        path = record.job.json_path
+        try:
+            with open(path) as f:
+                result = json.load(f)
+            if not isinstance(result, dict):
+                return
+            result["metrics"] = dict(record.metrics or {}, stage_seconds=record.stage_seconds())
+            with open(path + ".tmp", "w") as f:
+                json.dump(result, f)
+            os.replace(path + ".tmp", path)
+        except (OSError, ValueError) as e:
+            print(f"Cannot add the metrics to {path}: {e}")
+
+    def archive(self, job):
+        try:
+            archive_result(job, self.archive_dir)
+        except OSError as e:
+            print(f"Cannot archive the result of {job.id}: {e}")
+
+    def fail(self, record, error, state=FAILED):
+        print(f"Job {record.job.id} failed: {error}")
+        record.state = state
+        record.error = error
+        try:
+            with open(record.job.error_path, "w") as f:
+                json.dump({"error": error}, f)
+        except OSError as e:
+            print(f"Cannot write {record.job.error_path}: {e}")
+        followers = self.release(record)
+        self.retire(record)
+        self.changed(record)
+        for follower in followers:
+            self.fail(follower, error, state)
+
+    def retire(self, record):
+        record.done.set()
+        with self.lock:
+            self.finished.append(record.job.id)
+            while len(self.finished) > self.max_records:
+                job_id = self.finished.popleft()
+                if job_id in self.records and not self.records[job_id].active:
+                    del self.records[job_id]
+
+    def cancel(self, uuid):
+        """
+        Cancels the active jobs of the request `uuid` (all seeds). Returns the cancelled records.
+        """
+        cancelled = []
+        with self.lock:
+            for record in list(self.records.values()):
+                if record.job.uuid != uuid or not record.active:
+                    continue
+                state = record.state
+                record.state = CANCELLED
+                cancelled.append(record)
+                if record.leader is not None:
+                    if record in record.leader.followers:
+                        record.leader.followers.remove(record)
+                    self.fail(record, "Job cancelled", CANCELLED)
+                    continue
+                self.promote(self.release(record))
+                if state == QUEUED:
+                    record.lane.queue.remove(record)
+                    self.fail(record, "Job cancelled", CANCELLED)
+                elif state == SAMPLING:
+                    self.executor.cancel(record.job.id) # the done callback stores the error
+                elif record.stage_future is not None and record.stage_future.cancel():
+                    # still waiting for its stage
+                    self.stages[[stage.name for stage in self.stages].index(state)].waiting -= 1
+                    self.fail(record, "Job cancelled", CANCELLED)
+                elif record.process is not None:
+                    record.process.terminate()
+        return cancelled
+
+    def promote(self, followers):
+        # the followers of a cancelled job are sampled again, the first of them is the new leader
+        if not followers:
+            return
+        leader, followers = followers[0], followers[1:]
+        leader.leader = None
+        leader.followers = followers
+        for follower in followers:
+            follower.leader = leader
+        self.inflight[leader.key] = leader
+        self.enqueue(leader)
+        self.advance(leader, QUEUED)
+        self.dispatch()
+
+    def shutdown(self):
+        for stage in self.stages:
+            stage.pool.shutdown(wait=False, cancel_futures=True)
+            if hasattr(stage.run, 'shutdown'): # e.g. postprocess.Annotator
+                stage.run.shutdown()
+        if self.archiver is not None:
+            self.archiver.shutdown() # the completed results are archived before the service stops
@@ -0,0 +1,360 @@
+import argparse
+import json
+import os
+import shlex
+import socket
+import threading
+import time
+
+from grapharna.service.executor import Executor
+from grapharna.service.jobs import Job
+
+PENDING = "pending"
+CLAIMED = "claimed"
+DONE = "done"
+FAILED = "failed"
+CANCEL = "cancel"
+
+
+def write_atomic(path, content):
+    # readers of the spool never see a partially written file
+    with open(path + ".tmp", "w") as f:
+        json.dump(content, f)
+    os.replace(path + ".tmp", path)
+
+
+def remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class Spool():
+    """
+    Work queue in a shared directory, without a broker: any number of hosts pull the jobs with SpoolWorker.
+    A job is a file in pending/ named "<submission time>-<attempt>-<job id>", so the oldest job is claimed first.
+    A host claims a job by renaming it to claimed/<name>@<owner>, the rename is atomic, so only one host gets it.
+    The owner renews its lease by touching the claimed file (heartbeat). A claim that is not renewed for `lease`
+    seconds, e.g. of a host that died, is moved back to pending/ by any host, up to `max_attempts` times.
+    The results are written to done/<job id> and the errors to failed/<job id>. A running job is cancelled
+    with the marker cancel/<job id>.
+    """
+    def __init__(self, directory: str, lease: float = 60., max_attempts: int = 3):
+        self.directory = directory
+        self.lease = lease
+        self.max_attempts = max_attempts
+        for name in [PENDING, CLAIMED, DONE, FAILED, CANCEL]:
+            os.makedirs(os.path.join(directory, name), exist_ok=True)
+
+    def path(self, *parts):
+        return os.path.join(self.directory, *parts)
+
+    def entries(self, folder):
+        return sorted(name for name in os.listdir(self.path(folder)) if not name.endswith(".tmp"))
+
+    def put(self, job) -> str:
+        """
+        Queues the job, returns the name of its file.
+        """
+        name = f"{time.time_ns():020d}-1-{job.id}"
+        self.clear_cancel(job.id) # a marker left by a previous run of the job
+        write_atomic(self.path(PENDING, name), {"uuid": job.uuid, "seed": job.seed, "input_path": job.input_path,
+                                                "output_folder": job.output_folder})
+        return name
+
+    def withdraw(self, name) -> bool:
+        """
+        Removes a job that is not claimed yet. Returns False if it is claimed or finished.
+        """
+        try:
+            os.remove(self.path(PENDING, name))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def claim(self, owner):
+        """
+        Claims the oldest pending job for `owner`. Returns (claim, Job), None if there is no pending job.
+        """
+        for name in self.entries(PENDING):
+            claim = f"{name}@{owner}"
+            try:
+                # the rename keeps the mtime, a job that waited longer than the lease would be claimed already expired
+                os.utime(self.path(PENDING, name))
+                os.rename(self.path(PENDING, name), self.path(CLAIMED, claim))
+                with open(self.path(CLAIMED, claim)) as f:
+                    content = json.load(f)
+            except FileNotFoundError:
+                continue # claimed by another host, or requeued
+            return claim, Job(content["uuid"], content["seed"], content["input_path"], content["output_folder"])
+        return None
+
+    def heartbeat(self, claim) -> bool:
+        """
+        Renews the lease of a claimed job. Returns False if the lease was lost (the job was requeued).
+        """
+        try:
+            os.utime(self.path(CLAIMED, claim))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def cancelled(self, job_id) -> bool:
+        return os.path.exists(self.path(CANCEL, job_id))
+
+    def cancel(self, job_id):
+        write_atomic(self.path(CANCEL, job_id), {})
+
+    def clear_cancel(self, job_id):
+        remove(self.path(CANCEL, job_id))
+
+    def finish(self, claim, job_id, result=None, error=None):
+        """
+        Stores the result (or the error) of a claimed job and releases the claim. Nothing is stored if the lease
+        was lost, another host runs the job again.
+        """
+        if not os.path.exists(self.path(CLAIMED, claim)):
+            return
+        if error is None:
+            write_atomic(self.path(DONE, job_id), {"result": result})
+        else:
+            write_atomic(self.path(FAILED, job_id), {"error": error})
+        remove(self.path(CLAIMED, claim))
+        self.clear_cancel(job_id)
+
+    def release(self, claim):
+        """
+        Queues a claimed job again, e.g. when its host stops.
+        """
+        try:
+            os.rename(self.path(CLAIMED, claim), self.path(PENDING, claim.rsplit("@", 1)[0]))
+        except FileNotFoundError:
+            pass
+
+    def requeue_expired(self) -> int:
+        """
+        Moves the claims whose lease expired back to pending/, or to failed/ after `max_attempts` attempts.
+        Returns the number of requeued jobs.
+        """
+        now = time.time()
+        requeued = 0
+        for claim in self.entries(CLAIMED):
+            try:
+                if now - os.path.getmtime(self.path(CLAIMED, claim)) < self.lease:
+                    continue
+                name = claim.rsplit("@", 1)[0]
+                submitted, attempt, job_id = name.split("-", 2)
+                if int(attempt) >= self.max_attempts:
+                    # the rename decides which host fails the job
+                    os.rename(self.path(CLAIMED, claim), self.path(FAILED, job_id + ".tmp"))
+                    write_atomic(self.path(FAILED, job_id), {"error": f"The job was abandoned by {attempt} workers"})
+                    continue
+                os.rename(self.path(CLAIMED, claim), self.path(PENDING, f"{submitted}-{int(attempt) + 1}-{job_id}"))
+                print(f"Lease of {job_id} expired, the job is queued again")
+                requeued += 1
+            except (FileNotFoundError, ValueError):
+                continue # requeued or finished by another host
+        return requeued
+
+    def results(self):
+        """
+        Finished jobs as (job id, result or None, error or None), the result files are removed.
+        Only one service reads the results of a spool.
+        """
+        finished = []
+        for folder in [DONE, FAILED]:
+            for job_id in self.entries(folder):
+                try:
+                    with open(self.path(folder, job_id)) as f:
+                        content = json.load(f)
+                    os.remove(self.path(folder, job_id))
+                except (OSError, ValueError):
+                    continue
+                self.clear_cancel(job_id) # the job was cancelled after it finished
+                finished.append((job_id, content.get("result"), content.get("error")))
+        return finished
+
+
+class SpoolExecutor(Executor):
+    """
+    Executor of the service that queues the jobs in a Spool, where they are sampled by SpoolWorker processes
+    on any number of hosts. At most `capacity` jobs of the service are in the spool at the same time, so the
+    scheduler still orders the waiting jobs. The results are collected every `interval` seconds.
+
+    executor = SpoolExecutor(Spool("/shared/samples/spool"), capacity=16).start()
+    """
+    def __init__(self, spool, capacity: int = 16, interval: float = 0.5):
+        super().__init__()
+        self.spool = spool
+        self.max_jobs = capacity
+        self.interval = interval
+        self.spooled = {} # job id -> name of the job in the spool
+        self.collector = None
+
+    def start(self):
+        self.running = True
+        self.collector = threading.Thread(target=self.collect, daemon=True)
+        self.collector.start()
+        return self
+
+    @property
+    def num_running(self):
+        return len(self.spooled)
+
+    @property
+    def capacity(self):
+        return self.max_jobs
+
+    def dispatch(self):
+        # called with the lock held
+        while self.pending and len(self.spooled) < self.max_jobs:
+            job = self.take()
+            try:
+                self.spooled[job.id] = self.spool.put(job)
+            except OSError as e:
+                self.finish(job.id, error=f"Cannot queue the job in the spool: {e}")
+
+    def cancel_running(self, job):
+        # a claimed job keeps its slot until its worker reports that it stopped
+        if self.spool.withdraw(self.spooled[job.id]):
+            del self.spooled[job.id]
+        else:
+            self.spool.cancel(job.id)
+
+    def collect(self):
+        while self.running:
+            try:
+                self.spool.requeue_expired()
+                finished = self.spool.results()
+            except OSError as e:
+                print(f"Cannot read the spool: {e}")
+                finished = []
+            with self.lock:
+                for job_id, result, error in finished:
+                    name = self.spooled.pop(job_id, None)
+                    # the job may have been cancelled after results() read it
+                    self.spool.clear_cancel(job_id)
+                    if name is not None:
+                        # a job resubmitted after a restart may have been finished by the claim of the previous run
+                        self.spool.withdraw(name)
+                        self.finish(job_id, result=result, error=error)
+                self.dispatch()
+            self.resolve()
+            time.sleep(self.interval)
+
+    def shutdown(self):
+        with self.lock:
+            # the jobs that are not claimed yet are recovered from the job store at the next start
+            for name in self.spooled.values():
+                self.spool.withdraw(name)
+            self.spooled.clear()
+            self.cancel_all()
+        self.resolve()
+        self.running = False
+        if self.collector is not None:
+            self.collector.join()
+
+
+class SpoolWorker():
+    """
+    Pulls the jobs of a Spool into a local executor (e.g. WorkerPool) while it has free capacity, renews the leases
+    of the running jobs and stores their results in the spool. A job whose lease is lost or that is cancelled
+    is cancelled in the executor. Run one per host: python -m grapharna.service.spool <spool directory>
+    """
+    def __init__(self, spool, executor, owner: str = None, interval: float = 1.):
+        self.spool = spool
+        self.executor = executor
+        self.owner = owner or f"{socket.gethostname()}-{os.getpid()}"
+        self.interval = interval
+        self.claims = {} # job id -> claim
+        self.lock = threading.Lock()
+        self.running = False
+
+    def run(self):
+        self.running = True
+        last_heartbeat = 0.
+        while self.running:
+            try:
+                if time.monotonic() - last_heartbeat > self.spool.lease / 4:
+                    self.heartbeat()
+                    self.spool.requeue_expired()
+                    last_heartbeat = time.monotonic()
+                self.check_cancelled()
+                self.pull()
+            except OSError as e:
+                print(f"Cannot read the spool: {e}")
+            time.sleep(self.interval)
+
+    def pull(self):
+        # claims jobs while the executor has free capacity
+        while self.running and len(self.claims) < self.executor.capacity:
+            claimed = self.spool.claim(self.owner)
+            if claimed is None:
+                break
+            claim, job = claimed
+            with self.lock:
+                self.claims[job.id] = claim
+            self.executor.submit(job).add_done_callback(lambda future, job=job, claim=claim: self.finished(job, claim, future))
+
+    def heartbeat(self):
+        with self.lock:
+            claims = list(self.claims.items())
+        for job_id, claim in claims:
+            if not self.spool.heartbeat(claim):
+                print(f"Lease of {job_id} lost, cancelling it")
+                self.executor.cancel(job_id)
+
+    def check_cancelled(self):
+        with self.lock:
+            job_ids = list(self.claims)
+        for job_id in job_ids:
+            if self.spool.cancelled(job_id):
+                self.executor.cancel(job_id)
+
+    def finished(self, job, claim, future):
+        with self.lock:
+            self.claims.pop(job.id, None)
+        if not self.running:
+            self.spool.release(claim) # the host stops, another one samples the job
+        elif future.cancelled():
+            self.spool.finish(claim, job.id, error="Job cancelled")
+        elif future.exception() is not None:
+            self.spool.finish(claim, job.id, error=str(future.exception()))
+        else:
+            self.spool.finish(claim, job.id, result=future.result())
+
+    def stop(self):
+        # the running jobs are queued again when the executor is shut down
+        self.running = False
+
+
+def main():
+    from grapharna.service.worker import WorkerPool, SamplingRunner, default_num_workers
+
+    parser = argparse.ArgumentParser(description="Samples the jobs of a GraphaRNA spool directory on this host.")
+    parser.add_argument('spool', type=str, help='Spool directory shared by the service and the worker hosts')
+    parser.add_argument('--workers', type=int, default=None, help='Number of sampling workers (default: from the cores and memory)')
+    parser.add_argument('--threads', type=int, default=4, help='Torch threads per worker')
+    parser.add_argument('--batch-size', type=int, default=1, help='Jobs sampled together by a worker')
+    parser.add_argument('--model-path', type=str, default=None, help='Model checkpoint')
+    parser.add_argument('--sampling-args', type=str, default="", help='Extra grapharna arguments for every job')
+    parser.add_argument('--lease', type=float, default=60., help='Seconds after which the jobs of a silent host are requeued')
+    args = parser.parse_args()
+
+    runner = SamplingRunner(shlex.split(args.sampling_args), args.model_path, threads=args.threads)
+    num_workers = args.workers if args.workers is not None else default_num_workers(args.threads)
+    pool = WorkerPool(runner, num_workers=num_workers, batch_size=args.batch_size).start()
+    worker = SpoolWorker(Spool(args.spool, lease=args.lease), pool)
+    print(f"Sampling the jobs of {args.spool} as {worker.owner} with {num_workers} workers")
+    try:
+        worker.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        worker.stop()
+        pool.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+import sqlite3
+import threading
+import time
+
+from grapharna.service.jobs import Job
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    uuid TEXT NOT NULL,
+    seed INTEGER NOT NULL,
+    input_path TEXT,
+    output_folder TEXT NOT NULL,
+    state TEXT NOT NULL,
+    error TEXT,
+    submitted REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS transitions (
+    job_id TEXT NOT NULL,
+    state TEXT NOT NULL,
+    time REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS transitions_job ON transitions (job_id, time);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state);
+"""
+
+
+class JobStore():
+    """
+    Durable record of the jobs of the service, in a SQLite database in WAL mode. Stores the state of every job
+    (with the seed, the input and the output folder) and the time of every state transition, so that the
+    scheduler can recover the jobs that were active when the service stopped (see Scheduler.recover).
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL") # durable at the checkpoints, a crash loses at most the last transitions
+        self.db.executescript(SCHEMA)
+
+    def update(self, record):
+        """
+        Stores the current state of the job and its transition.
+        """
+        job = record.job
+        now = time.time()
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT INTO jobs (id, uuid, seed, input_path, output_folder, state, error, submitted, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (id) DO UPDATE SET input_path = excluded.input_path, output_folder = excluded.output_folder, "
+                "state = excluded.state, error = excluded.error, submitted = excluded.submitted, updated = excluded.updated",
+                (job.id, job.uuid, job.seed, job.input_path, job.output_folder, record.state, record.error,
+                 record.submitted, now))
+            self.db.execute("INSERT INTO transitions (job_id, state, time) VALUES (?, ?, ?)", (job.id, record.state, now))
+
+    def get(self, job_id):
+        """
+        Stored job as a dict (state, error, submitted, updated, ...), None if it is unknown.
+        """
+        with self.lock:
+            cursor = self.db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,))
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            return dict(zip([c[0] for c in cursor.description], row))
+
+    def unfinished(self, states):
+        """
+        Jobs in one of `states`, the oldest first, as (Job, state, submission time).
+        """
+        with self.lock:
+            rows = self.db.execute(
+                f"SELECT uuid, seed, input_path, output_folder, state, submitted FROM jobs "
+                f"WHERE state IN ({', '.join('?' for _ in states)}) ORDER BY submitted", list(states)).fetchall()
+        return [(Job(uuid, seed, input_path, output_folder), state, submitted)
+                for uuid, seed, input_path, output_folder, state, submitted in rows]
+
+    def timings(self, job_id):
+        """
+        Seconds spent by the last run of the job in each state, e.g. {"QUEUED": 3.2, "SAMPLING": 410.5, ...}.
+        """
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT t.state, t.time FROM transitions t JOIN jobs j ON j.id = t.job_id "
+                "WHERE t.job_id = ? AND t.time >= j.submitted ORDER BY t.time", (job_id,)).fetchall()
+        timings = {}
+        for (state, start), (_, end) in zip(rows[:-1], rows[1:]):
+            timings[state] = timings.get(state, 0.) + end - start
+        return timings
+
+    def prune(self, max_age: float, states):
+        """
+        Removes the jobs in `states` (the finished ones) that were not updated for `max_age` seconds.
+        """
+        cutoff = time.time() - max_age
+        placeholders = ', '.join('?' for _ in states)
+        with self.lock, self.db:
+            self.db.execute(f"DELETE FROM transitions WHERE job_id IN (SELECT id FROM jobs WHERE updated < ? AND state IN ({placeholders}))",
+                            [cutoff] + list(states))
+            removed = self.db.execute(f"DELETE FROM jobs WHERE updated < ? AND state IN ({placeholders})",
+                                      [cutoff] + list(states)).rowcount
+        return removed
+
+    def close(self):
+        with self.lock:
+            self.db.close()
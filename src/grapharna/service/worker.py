@@ -0,0 +1,509 @@
+import os
+import queue
+import shutil
+import threading
+import time
+import multiprocessing as mp
+
+from grapharna.service.executor import Executor
+from grapharna.utils.resources import peak_rss, reset_peak_rss
+
+
+def default_num_workers(threads_per_worker: int = 4, memory_per_worker_gb: float = 8.):
+    """
+    Number of sampling workers that fit on this host, given the CPU threads and the memory used by one worker.
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        cpus = len(os.sched_getaffinity(0))
+    else:
+        cpus = os.cpu_count() or 1
+    memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    return max(1, min(cpus // threads_per_worker, int(memory // (memory_per_worker_gb * 1024 ** 3))))
+
+
+def measure(run):
+    # runs `run()`, returns its result with the wall and CPU time and the peak memory of the process
+    reset_peak_rss()
+    start = time.perf_counter()
+    cpu = time.process_time()
+    result = run()
+    return result, time.perf_counter() - start, time.process_time() - cpu, peak_rss()
+
+
+class Progress():
+    """
+    Progress callback of the sampler (see Sampler.progress). Sends the step and the ETA of the jobs to
+    `send(job_id, payload)`, at most every `interval` seconds, and counts the steps done.
+    """
+    def __init__(self, send, job_ids, interval: float = 1.):
+        self.send = send
+        self.job_ids = job_ids
+        self.interval = interval
+        self.start = time.perf_counter()
+        self.last = None
+        self.done = 0
+
+    def __call__(self, done, total):
+        self.done = done
+        if self.send is None:
+            return
+        now = time.perf_counter()
+        if self.last is not None and now - self.last < self.interval and done < total:
+            return
+        self.last = now
+        eta = (now - self.start) / done * (total - done) if done > 0 else None
+        for job_id in self.job_ids:
+            self.send(job_id, {"step": done, "total": total, "eta": eta})
+
+
+class SamplingRunner():
+    """
+    Runs the sampling jobs inside a worker process. load() imports GraphaRNA and loads the model once,
+    the following calls only preprocess the input and sample it.
+    `sampling_args` are grapharna arguments applied to every job, e.g. ["--compute-schedule", "0.6:local=skip"].
+    """
+    def __init__(self, sampling_args=(), model_path: str = None, data_dir: str = "data/service_inputs", threads: int = None,
+                 device: str = None):
+        self.sampling_args = list(sampling_args)
+        self.model_path = model_path
+        self.data_dir = data_dir
+        self.threads = threads
+        self.device = device # default: cuda if available
+        self.model = None
+        self.load_seconds = None
+        self.send_progress = None # send(job_id, payload), set by the worker
+        self.cancel_token = None # CancellationToken of the running jobs, set by the worker
+
+    def load(self):
+        # imported here, so that the service process does not load torch and the model
+        import torch
+        from grapharna.sample_rna_pdb import build_parser, load_model, MODEL_PATH
+
+        start = time.perf_counter()
+        if self.threads is not None:
+            torch.set_num_threads(self.threads)
+        args = build_parser().parse_args(self.sampling_args)
+        if self.device is None:
+            self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        self.device = torch.device(self.device)
+        self.model = load_model(args, self.model_path or MODEL_PATH, self.device)
+        self.load_seconds = time.perf_counter() - start
+
+    def share(self):
+        """
+        Moves the weights to shared memory, so that the processes forked from this one (see Zygote) use them
+        without copies.
+        """
+        self.model.share_memory()
+
+    def job_args(self, job):
+        from grapharna.sample_rna_pdb import build_parser
+
+        return build_parser().parse_args([
+            f"--input={job.input_path}",
+            f"--seed={job.seed}",
+            f"--output-folder={job.output_folder}",
+            f"--output-name={job.output_name}",
+        ] + self.sampling_args)
+
+    def __call__(self, job):
+        from grapharna.sample_rna_pdb import prepare_input, run, set_seed, validate_args
+
+        args = self.job_args(job)
+        error = validate_args(args)
+        if error is not None:
+            raise ValueError(error)
+        set_seed(job.seed)
+        start = time.perf_counter()
+        dir_name = prepare_input(args, self.data_dir, dir_name=job.id)
+        preprocessed = time.perf_counter()
+        sampler = self.build_sampler(args, [job])
+        try:
+            run(args, self.model, sampler, self.device, dir_name, self.data_dir)
+        finally:
+            shutil.rmtree(os.path.join(self.data_dir, dir_name), ignore_errors=True)
+        if not os.path.exists(job.pdb_path):
+            raise RuntimeError("GraphaRNA finished but output PDB is missing")
+        return self.job_metrics(sampler, preprocessed - start, time.perf_counter() - preprocessed)
+
+    def build_sampler(self, args, jobs):
+        from grapharna.sample_rna_pdb import build_sampler
+
+        sampler = build_sampler(args)
+        sampler.progress = Progress(self.send_progress, [job.id for job in jobs])
+        sampler.cancel = self.cancel_token
+        return sampler
+
+    def job_metrics(self, sampler, preprocess_seconds, sampling_seconds):
+        # figures of a job reported with its result, see metrics.Metrics
+        steps = sampler.progress.done
+        metrics = {
+            "preprocess_seconds": preprocess_seconds,
+            "sampling_seconds": sampling_seconds,
+            "steps": steps,
+            "steps_per_second": steps / sampling_seconds if sampling_seconds > 0 else None,
+            "model_load_seconds": self.load_seconds,
+        }
+        if sampler.feature_cache is not None:
+            metrics["feature_cache_hit_rate"] = sampler.feature_cache.stats()["hit_rate"]
+        return metrics
+
+    def batchable(self, args):
+        # options that change the sampling loop are run job by job
+        return (args.num_samples == 1 and args.time_budget is None and args.start_t is None
+                and args.sampling_resids is None and args.template is None and args.init_structure is None)
+
+    def run_batch(self, jobs):
+        """
+        Samples the jobs together, in one batch of the model. Every structure draws its noise from the stream of
+        its own seed, so the results are the same as when the jobs are sampled one by one.
+        Returns {job id: payload, or the exception of a failed job}.
+        """
+        import torch
+        from torch_geometric.data import Batch
+        from grapharna.datasets import RNAPDBDataset
+        from grapharna.sample_rna_pdb import prepare_input, validate_args
+        from grapharna.utils import SampleToPDB
+
+        args = {job.id: self.job_args(job) for job in jobs}
+        if not self.batchable(args[jobs[0].id]):
+            return {job.id: self.run_single(job) for job in jobs}
+        results = {}
+        prepared = []
+        start = time.perf_counter()
+        try:
+            for job in jobs:
+                try:
+                    error = validate_args(args[job.id])
+                    if error is not None:
+                        raise ValueError(error)
+                    dir_name = prepare_input(args[job.id], self.data_dir, dir_name=job.id)
+                    data, name, seq = RNAPDBDataset(self.data_dir, name=dir_name, mode='coarse-grain')[0]
+                    prepared.append((job, data, name, seq))
+                except Exception as e:
+                    results[job.id] = e
+            if not prepared:
+                return results
+            batch = Batch.from_data_list([data for _, data, _, _ in prepared]).to(self.device)
+            sampler = self.build_sampler(args[prepared[0][0].id], [job for job, _, _, _ in prepared])
+            preprocessed = time.perf_counter()
+            with torch.no_grad():
+                samples = sampler.sample(self.model, [seq for _, _, _, seq in prepared], batch,
+                                         names=[name for _, _, name, _ in prepared],
+                                         seed=[job.seed for job, _, _, _ in prepared])[-1]
+            metrics = self.job_metrics(sampler, preprocessed - start, time.perf_counter() - preprocessed)
+            num_atoms = batch.x.size(0)
+            for i, (job, data, _, _) in enumerate(prepared):
+                try:
+                    SampleToPDB().write_pdb(samples.x[samples.batch == i], job.output_folder, job.output_name)
+                except ValueError:
+                    print("Cannot save molecules with missing P atom.")
+                if not os.path.exists(job.pdb_path):
+                    results[job.id] = RuntimeError("GraphaRNA finished but output PDB is missing")
+                else:
+                    # the sampling time of the batch is shared by the jobs, in proportion to their atoms
+                    results[job.id] = dict(metrics, batch_size=len(prepared), share=data.x.size(0) / num_atoms)
+        finally:
+            for job in jobs:
+                shutil.rmtree(os.path.join(self.data_dir, job.id), ignore_errors=True)
+        return results
+
+    def run_single(self, job):
+        try:
+            return self(job)
+        except Exception as e:
+            return e
+
+
+def run_batch(runner, batch):
+    # runs a batch of jobs, returns {job id: payload or exception}
+    if len(batch) == 1:
+        try:
+            return {batch[0].id: runner(batch[0]) or {}}
+        except Exception as e:
+            return {batch[0].id: e}
+    try:
+        return runner.run_batch(batch)
+    except Exception as e:
+        return {job.id: e for job in batch}
+
+
+class CancelListener():
+    """
+    Thread of a worker process that receives the ids of the cancelled jobs from the pool (`cancels`) and cancels
+    the sampling of the running batch when one of its jobs is cancelled.
+    """
+    def __init__(self, cancels):
+        self.cancels = cancels
+        self.lock = threading.Lock()
+        self.cancelled = set()
+        self.batch = set()
+        self.token = None
+        threading.Thread(target=self.listen, daemon=True).start()
+
+    def listen(self):
+        while True:
+            job_id = self.cancels.get()
+            with self.lock:
+                self.cancelled.add(job_id)
+                if job_id in self.batch:
+                    self.token.cancel()
+
+    def start(self, batch):
+        """
+        CancellationToken of the next batch.
+        """
+        from grapharna.utils.sampler import CancellationToken
+
+        with self.lock:
+            # a cancel may arrive before its batch, the pool sends the next batch only after the previous one is finished
+            self.batch = {job.id for job in batch}
+            self.cancelled &= self.batch
+            self.token = CancellationToken()
+            if self.cancelled:
+                self.token.cancel()
+            return self.token
+
+    def finish(self):
+        """
+        Ids of the cancelled jobs of the finished batch, None if its sampling was not cancelled.
+        """
+        with self.lock:
+            self.batch = set()
+            return set(self.cancelled) if self.token.cancelled else None
+
+
+def worker_main(worker_id, runner, jobs, cancels, results):
+    """
+    Main loop of a worker process: loads the model and runs the batches of jobs from `jobs` until it receives None.
+    When a job of the running batch is cancelled (its id is sent to `cancels`), the sampling stops at the next step
+    and the other jobs of the batch are sent back to the pool. Messages to the pool are tuples (kind, worker id, job id, payload).
+    """
+    try:
+        runner.load()
+    except Exception as e:
+        results.put(("failed_start", worker_id, None, f"{type(e).__name__}: {e}"))
+        return
+    results.put(("ready", worker_id, None, None))
+    runner.send_progress = lambda job_id, payload: results.put(("progress", worker_id, job_id, payload))
+    listener = CancelListener(cancels)
+    while True:
+        batch = jobs.get()
+        if batch is None:
+            return
+        runner.cancel_token = listener.start(batch)
+        payloads, seconds, cpu_seconds, rss = measure(lambda: run_batch(runner, batch))
+        cancelled = listener.finish()
+        for job in batch:
+            payload = payloads.get(job.id, RuntimeError("The job has no result"))
+            if isinstance(payload, Exception) and cancelled is not None and job.id not in cancelled:
+                results.put(("requeue", worker_id, job.id, None)) # stopped with a cancelled job of its batch
+                continue
+            if isinstance(payload, Exception):
+                results.put(("failed", worker_id, job.id, f"{type(payload).__name__}: {payload}"))
+                continue
+            payload = payload or {}
+            share = payload.pop("share", 1. / len(batch))
+            payload["seconds"] = seconds * share
+            payload["cpu_seconds"] = cpu_seconds * share
+            payload["peak_rss_bytes"] = rss # of the whole batch
+            results.put(("done", worker_id, job.id, payload))
+
+
+class WorkerProcess():
+    def __init__(self, worker_id, process, jobs, cancels):
+        self.id = worker_id
+        self.process = process
+        self.jobs = jobs
+        self.cancels = cancels
+        self.ready = False # the model is loaded
+        self.batch = [] # running jobs
+        self.cancelling = {} # job id -> time when the worker is terminated if the job is still running
+
+
+class WorkerPool(Executor):
+    """
+    Long-lived worker processes that load the model once and run the sampling jobs of the service.
+    A running job is cancelled cooperatively: the sampler stops at the next step (see CancellationToken), the worker
+    keeps its model and the other jobs of its batch are queued again. A worker that does not stop the job within
+    `cancel_grace` seconds is terminated and replaced by a new one. Workers that die are replaced as well and
+    their jobs fail.
+
+    With `batch_size` > 1, a worker samples up to `batch_size` jobs together (micro-batching), up to `max_batch_atoms`
+    atoms. A batch that is not full waits up to `batch_window` seconds for more jobs. Small structures do not
+    use the vectorization of the model, so batching them increases the throughput of a worker.
+
+    pool = WorkerPool(SamplingRunner(), num_workers=2).start()
+    pool.submit(Job(uuid, seed, input_path, output_folder)).result()
+    """
+    def __init__(self, runner, num_workers: int = None, context: str = 'spawn', batch_size: int = 1,
+                 max_batch_atoms: int = None, batch_window: float = 0., cancel_grace: float = 10.):
+        super().__init__()
+        self.runner = runner
+        self.num_workers = num_workers if num_workers is not None else default_num_workers()
+        self.batch_size = batch_size
+        self.max_batch_atoms = max_batch_atoms
+        self.batch_window = batch_window
+        self.cancel_grace = cancel_grace
+        self.ctx = mp.get_context(context) # spawn: the workers may use CUDA
+        self.results = self.ctx.Queue()
+        self.workers = {}
+        self.next_id = 0
+        self.collector = None
+
+    def start(self):
+        self.running = True
+        with self.lock:
+            for _ in range(self.num_workers):
+                self.spawn()
+        self.collector = threading.Thread(target=self.collect, daemon=True)
+        self.collector.start()
+        return self
+
+    def spawn(self):
+        jobs = self.ctx.Queue()
+        cancels = self.ctx.Queue()
+        process = self.ctx.Process(target=worker_main, args=(self.next_id, self.runner, jobs, cancels, self.results), daemon=True)
+        process.start()
+        self.workers[self.next_id] = WorkerProcess(self.next_id, process, jobs, cancels)
+        self.next_id += 1
+
+    @property
+    def num_running(self):
+        return sum(len(w.batch) for w in self.workers.values())
+
+    @property
+    def capacity(self):
+        return self.num_workers * self.batch_size
+
+    def dispatch(self):
+        # called with the lock held
+        for worker in self.workers.values():
+            if not self.pending:
+                return
+            if worker.ready and not worker.batch:
+                worker.batch = self.next_batch()
+                if not worker.batch:
+                    return # waiting for more jobs
+                worker.jobs.put(worker.batch)
+
+    def job_atoms(self, job):
+        try:
+            return 5 * job.num_residues # coarse-grained atoms
+        except (OSError, IndexError):
+            return self.max_batch_atoms # unknown size, sampled alone
+
+    def next_batch(self):
+        # the next pending jobs that fit into a batch, or [] if the batch should wait for more jobs
+        batch = []
+        atoms = 0
+        for job in self.pending:
+            if len(batch) == self.batch_size:
+                break
+            if self.max_batch_atoms is not None:
+                size = self.job_atoms(job)
+                if batch and atoms + size > self.max_batch_atoms:
+                    break
+                atoms += size
+            batch.append(job)
+        full = len(batch) == self.batch_size or len(batch) < len(self.pending)
+        waited = time.monotonic() - self.submitted.get(self.pending[0].id, 0.)
+        if not full and waited < self.batch_window:
+            return []
+        return [self.take() for _ in batch]
+
+    def cancel_running(self, job):
+        for worker in self.workers.values():
+            if job in worker.batch:
+                # the job keeps its slot until the worker stops it
+                worker.cancels.put(job.id)
+                worker.cancelling[job.id] = time.monotonic() + self.cancel_grace
+
+    def requeue(self, job):
+        # called with the lock held, the job is sampled again before the other pending jobs
+        if job.id in self.futures:
+            self.pending.appendleft(job)
+            self.submitted[job.id] = 0.
+
+    def check_cancelling(self):
+        # terminates the workers that did not stop a cancelled job in time, called with the lock held
+        now = time.monotonic()
+        for worker in list(self.workers.values()):
+            if worker.cancelling and min(worker.cancelling.values()) < now:
+                print(f"Worker {worker.id} did not stop the cancelled jobs {list(worker.cancelling)}, terminating it")
+                for job in reversed(worker.batch):
+                    self.requeue(job)
+                self.replace(worker)
+
+    def replace(self, worker):
+        # called with the lock held
+        worker.process.terminate()
+        del self.workers[worker.id]
+        if self.running and self.error is None:
+            self.spawn()
+
+    def collect(self):
+        while self.running:
+            try:
+                # the pending batches are dispatched when their window ends
+                kind, worker_id, job_id, payload = self.results.get(timeout=min(1., self.batch_window or 1.))
+            except queue.Empty:
+                self.check_workers()
+                continue
+            if kind == "progress":
+                if worker_id in self.workers:
+                    self.report(job_id, payload)
+                if any(worker.cancelling for worker in list(self.workers.values())):
+                    self.check_workers() # the progress of a job that does not stop
+                continue
+            with self.lock:
+                worker = self.workers.get(worker_id)
+                if worker is None:
+                    continue # message of a terminated worker
+                if job_id is not None:
+                    worker.cancelling.pop(job_id, None)
+                if kind == "ready":
+                    worker.ready = True
+                elif kind == "failed_start":
+                    print(f"Worker {worker_id} failed to start: {payload}")
+                    self.error = payload
+                    self.fail_all(f"Workers failed to start: {payload}")
+                elif kind == "done":
+                    worker.batch = [job for job in worker.batch if job.id != job_id]
+                    self.finish(job_id, result=payload)
+                elif kind == "failed":
+                    worker.batch = [job for job in worker.batch if job.id != job_id]
+                    self.finish(job_id, error=payload)
+                elif kind == "requeue":
+                    self.requeue(next(job for job in worker.batch if job.id == job_id))
+                    worker.batch = [job for job in worker.batch if job.id != job_id]
+                self.dispatch()
+            self.resolve()
+
+    def check_workers(self):
+        with self.lock:
+            for worker in list(self.workers.values()):
+                if worker.process.is_alive():
+                    continue
+                print(f"Worker {worker.id} exited with code {worker.process.exitcode}")
+                for job in worker.batch:
+                    self.finish(job.id, error=f"Worker exited with code {worker.process.exitcode}")
+                self.replace(worker)
+            self.check_cancelling()
+            self.dispatch()
+        self.resolve()
+
+    def shutdown(self):
+        self.running = False
+        with self.lock:
+            self.cancel_all()
+            workers = list(self.workers.values())
+            for worker in workers:
+                worker.jobs.put(None)
+        self.resolve()
+        for worker in workers:
+            worker.process.join(timeout=5)
+            if worker.process.is_alive():
+                worker.process.terminate()
+        if self.collector is not None:
+            self.collector.join()
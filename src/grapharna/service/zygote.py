@@ -0,0 +1,188 @@
+import os
+import queue
+import signal
+import threading
+import time
+import multiprocessing as mp
+from multiprocessing.connection import wait
+
+from grapharna.service.executor import Executor
+from grapharna.service.worker import measure
+
+
+def run_child(runner, job, conn):
+    # body of the process forked for a job, never returns. The messages go to the child's own pipe `conn`
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    runner.send_progress = lambda job_id, payload: conn.send(("progress", job_id, payload))
+    code = 0
+    try:
+        payload, seconds, cpu_seconds, rss = measure(lambda: runner(job))
+        payload = payload or {}
+        payload.update(seconds=seconds, cpu_seconds=cpu_seconds, peak_rss_bytes=rss)
+        conn.send(("done", job.id, payload))
+    except BaseException as e:
+        conn.send(("failed", job.id, f"{type(e).__name__}: {e}"))
+        code = 1
+    finally:
+        os._exit(code)
+
+
+def relay(children, results, timeout):
+    """
+    Forwards the messages of the children (pid -> (job id, pipe)) to the service. Every child writes only to its own
+    pipe, so a child killed in the middle of a message cannot block the others nor the zygote. The pipe of a child
+    reaches EOF once it exited and all its messages were read, then the child is reaped.
+    """
+    pipes = {conn: pid for pid, (_, conn) in children.items()}
+    for conn in wait(list(pipes), timeout=timeout):
+        try:
+            results.put(conn.recv())
+        except (EOFError, OSError):
+            conn.close()
+            pid = pipes[conn]
+            job_id, _ = children.pop(pid)
+            _, status = os.waitpid(pid, 0)
+            results.put(("exited", job_id, os.waitstatus_to_exitcode(status)))
+
+
+def zygote_main(runner, requests, results):
+    """
+    Main loop of the zygote: loads the model once, moves it to shared memory and forks a child for every job
+    from `requests` until it receives None. Messages to the service are tuples (kind, job id, payload).
+    """
+    try:
+        runner.load()
+        runner.share()
+    except Exception as e:
+        results.put(("failed_start", None, f"{type(e).__name__}: {e}"))
+        return
+    results.put(("ready", None, None))
+    children = {} # pid -> (job id, read end of its pipe)
+    while True:
+        relay(children, results, timeout=0.05)
+        try:
+            job = requests.get(timeout=0.05 if children else 0.2)
+        except queue.Empty:
+            continue
+        if job is None:
+            break
+        reader, writer = mp.Pipe(duplex=False)
+        pid = os.fork()
+        if pid == 0:
+            reader.close()
+            run_child(runner, job, writer)
+        writer.close() # the pipe reaches EOF when the child exits
+        children[pid] = (job.id, reader)
+        results.put(("started", job.id, pid))
+    for pid in children:
+        os.kill(pid, signal.SIGTERM)
+    for pid in children:
+        os.waitpid(pid, 0)
+
+
+class Zygote(Executor):
+    """
+    Runs every job in its own process, forked from a zygote process that has imported GraphaRNA and loaded
+    the model once. The children start instantly and share the read-only weights with the zygote (the model
+    is moved to shared memory), so the memory of a job is mostly its activations. Jobs stay isolated:
+    cancelling a running job terminates its process. At most `max_jobs` jobs run at the same time.
+    CUDA cannot be used in forked processes, so the model of the zygote stays on the CPU.
+
+    zygote = Zygote(SamplingRunner(device='cpu'), max_jobs=8).start()
+    zygote.submit(Job(uuid, seed, input_path, output_folder)).result()
+    """
+    def __init__(self, runner, max_jobs: int = 4, context: str = 'spawn'):
+        super().__init__()
+        self.runner = runner
+        self.max_jobs = max_jobs
+        self.ctx = mp.get_context(context)
+        self.requests = self.ctx.Queue()
+        self.results = self.ctx.SimpleQueue() # written by the zygote only, it relays the messages of the children
+        self.process = None
+        self.children = {} # job id -> pid, None until the child is forked
+        self.cancelled = set() # jobs cancelled before their child was forked
+        self.collector = None
+
+    def start(self):
+        self.running = True
+        self.process = self.ctx.Process(target=zygote_main, args=(self.runner, self.requests, self.results), daemon=True)
+        self.process.start()
+        self.collector = threading.Thread(target=self.collect, daemon=True)
+        self.collector.start()
+        return self
+
+    @property
+    def num_running(self):
+        return len(self.children)
+
+    @property
+    def capacity(self):
+        return self.max_jobs
+
+    def dispatch(self):
+        # called with the lock held
+        while self.pending and len(self.children) < self.max_jobs:
+            job = self.take()
+            self.children[job.id] = None
+            self.requests.put(job)
+
+    def cancel_running(self, job):
+        pid = self.children.get(job.id)
+        if pid is None:
+            self.cancelled.add(job.id) # terminated as soon as it is forked (see collect)
+        else:
+            self.kill(pid)
+
+    def kill(self, pid):
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass # already finished
+
+    def collect(self):
+        while self.running:
+            if self.results.empty():
+                if not self.process.is_alive():
+                    with self.lock:
+                        self.error = f"Zygote exited with code {self.process.exitcode}"
+                        self.children.clear()
+                        self.fail_all(self.error)
+                    self.resolve()
+                    return
+                time.sleep(0.05)
+                continue
+            kind, job_id, payload = self.results.get()
+            if kind == "progress":
+                self.report(job_id, payload)
+                continue
+            with self.lock:
+                if kind == "failed_start":
+                    print(f"Zygote failed to start: {payload}")
+                    self.error = payload
+                    self.fail_all(f"Workers failed to start: {payload}")
+                elif kind == "started":
+                    self.children[job_id] = payload
+                    if job_id in self.cancelled:
+                        self.cancelled.discard(job_id)
+                        self.kill(payload)
+                elif kind == "done":
+                    self.finish(job_id, result=payload)
+                elif kind == "failed":
+                    self.finish(job_id, error=payload)
+                elif kind == "exited":
+                    self.children.pop(job_id, None)
+                    self.finish(job_id, error=f"Job process exited with code {payload}")
+                self.dispatch()
+            self.resolve()
+
+    def shutdown(self):
+        with self.lock:
+            self.cancel_all()
+        self.resolve()
+        self.running = False
+        self.requests.put(None)
+        self.process.join(timeout=10)
+        if self.process.is_alive():
+            self.process.terminate()
+        if self.collector is not None:
+            self.collector.join()
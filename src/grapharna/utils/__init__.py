@@ -1,14 +1,19 @@
 from .sbf import bessel_basis, real_sph_harm
 from .ema import EMA
-from .metrics import rmse, mae, sd, pearson
-from .sampler import Sampler, generate_per_residue_noise
+from .metrics import rmse, mae, sd, pearson, kabsch_rmsd, ensemble_diversity
+from .sampler import Sampler, CancellationToken, SamplingCancelled, generate_per_residue_noise
+from .sampling_engine import SamplingEngine
 from .sample_to_pdb import SampleToPDB
 from .sampling_masks import SamplingMask
+from .reduced_compute import ComputeSchedule, FeatureCache
 from .prepare_user_input import read_dotseq_file
+from .cost_estimate import estimate_cost
 
 __all__ = [
     "bessel_basis", "real_sph_harm",
     "EMA",
-    "rmse", "mae", "sd", "pearson",
-    "Sampler", "SampleToPDB", "SamplingMask"
+    "rmse", "mae", "sd", "pearson", "kabsch_rmsd", "ensemble_diversity",
+    "Sampler", "CancellationToken", "SamplingCancelled", "SamplingEngine", "SampleToPDB", "SamplingMask",
+    "ComputeSchedule", "FeatureCache",
+    "estimate_cost"
 ]
\ No newline at end of file
@@ -0,0 +1,77 @@
+import time
+import torch
+from grapharna.utils.resources import peak_rss, reset_peak_rss
+
+
+def reset_peak_memory(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+    else:
+        reset_peak_rss()
+
+
+def peak_memory(device):
+    """
+    Peak memory of the device since reset_peak_memory: the allocated CUDA memory, or the resident memory
+    of the process (with the model) on the CPU.
+    """
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+        return torch.cuda.max_memory_allocated(device)
+    return peak_rss()
+
+
+def time_step(session, pos, t_index, device):
+    t = torch.full((pos.size(0),), t_index, device=device, dtype=torch.long)
+    seconds = None
+    for _ in range(2): # the first step also pays for the one-time allocations
+        start = time.perf_counter()
+        session(pos, t)
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        seconds = time.perf_counter() - start
+    return seconds
+
+
+@torch.no_grad()
+def estimate_cost(model, sampler, data, seqs, steps: int = None, num_samples: int = 1, fork_step: int = 0):
+    """
+    Estimates the cost of sampling the batch `data` in `steps` denoising steps (default: all the timesteps of the sampler)
+    from one instrumented step of the model on the initial noise. Returns the sizes of the graphs built by the model
+    (see PAMNet.graph_stats), the peak memory of the precomputation and of a step, and the runtime extrapolated to
+    all the steps. The step runs with the full compute of the model (no compute schedule nor feature cache),
+    so the runtime is an upper bound for the reduced settings.
+    With `num_samples` > 1, the cost of an ensemble (see Sampler.sample_ensemble): the first `fork_step` steps run
+    on the batch and the others on `num_samples` copies of it, whose graphs and peak memory are reported.
+    """
+    device = next(model.parameters()).device
+    sampler.to(device)
+    steps = sampler.timesteps if steps is None else steps
+
+    reset_peak_memory(device)
+    start = time.perf_counter()
+    session = model.sampling_session(data, seqs, sampler.timesteps) # the sequence embeddings and the time table
+    setup_seconds = time.perf_counter() - start
+    pos = sampler.structure_noise(data).rand_(torch.empty((data.x.size(0), 3), device=device))
+    batch, edge_index = data.batch, data.edge_index
+
+    shared, shared_seconds = 0, 0.
+    if num_samples > 1:
+        shared = max(0, min(fork_step, steps))
+        if shared:
+            shared_seconds = time_step(session, pos, sampler.timesteps - 1, device)
+        session = session.concat([session] * num_samples)
+        pos = pos.repeat(num_samples, 1)
+        batch = torch.cat([data.batch + k * data.num_graphs for k in range(num_samples)])
+        edge_index = torch.cat([data.edge_index + k * data.x.size(0) for k in range(num_samples)], dim=1)
+    stats = model.graph_stats(pos, batch, edge_index)
+    step_seconds = time_step(session, pos, sampler.timesteps - 1 - shared, device)
+    return dict(stats,
+                steps=steps,
+                num_samples=num_samples,
+                setup_seconds=setup_seconds,
+                shared_step_seconds=shared_seconds,
+                step_seconds=step_seconds,
+                total_seconds=setup_seconds + shared * shared_seconds + (steps - shared) * step_seconds,
+                peak_memory_bytes=peak_memory(device))
@@ -21,4 +21,23 @@ def sd(y,f):
 
 def pearson(y,f):
     rp = np.corrcoef(y, f)[0,1]
-    return rp
\ No newline at end of file
+    return rp
+
+def kabsch_rmsd(p, q):
+    """
+    RMSD between two (N, 3) sets of coordinates after their optimal superposition (Kabsch algorithm).
+    """
+    p = p - p.mean(axis=0)
+    q = q - q.mean(axis=0)
+    u, _, vt = np.linalg.svd(p.T @ q)
+    d = np.sign(np.linalg.det(vt.T @ u.T)) # avoid reflections
+    rotation = vt.T @ np.diag([1., 1., d]) @ u.T
+    diff = p @ rotation.T - q
+    return sqrt((diff ** 2).sum(axis=1).mean())
+
+def ensemble_diversity(coords):
+    """
+    Mean pairwise Kabsch RMSD within an ensemble of conformations of the same structure, given as (N, 3) arrays.
+    """
+    rmsds = [kabsch_rmsd(coords[i], coords[j]) for i in range(len(coords)) for j in range(i + 1, len(coords))]
+    return float(np.mean(rmsds)) if rmsds else 0.
@@ -0,0 +1,121 @@
+# Reduced compute of PAMNet during sampling: the per-timestep compute schedule and the reuse of the deep features
+# between adjacent denoising steps (see PAMNet.denoise and Sampler)
+import torch
+
+LOCAL_MODES = ['full', 'pairs', 'skip']
+
+class ComputeSchedule(object):
+    """
+    Per-timestep compute of PAMNet during sampling. At high noise levels the fine local geometry is not meaningful,
+    so the early steps can use fewer knn neighbours, a reduced local stage or fewer message passing layers.
+    Each phase applies from a fraction of the timesteps upwards, e.g. "0.6:knns=8,local=skip,n_layer=3;0.3:knns=12,local=pairs"
+    uses the first settings for t >= 0.6*T, the second ones for 0.3*T <= t < 0.6*T and the full model below.
+    """
+    KEYS = {'knns': int, 'n_layer': int, 'local': str}
+
+    def __init__(self, phases, timesteps):
+        self.phases = sorted(phases, key=lambda p: p[0], reverse=True)
+        self.timesteps = timesteps
+        for _, settings in self.phases:
+            if not set(settings) <= set(self.KEYS):
+                raise ValueError(f"Invalid settings: {settings}. Accepted: {list(self.KEYS)}")
+            if settings.get('local', 'full') not in LOCAL_MODES:
+                raise ValueError(f"Invalid local mode: {settings['local']}. Accepted: {LOCAL_MODES}")
+
+    @classmethod
+    def parse(cls, schedule, timesteps):
+        """
+        Parses a schedule such as "0.6:knns=8,local=skip;0.3:local=pairs". Raises ValueError if it is malformed.
+        """
+        phases = []
+        for phase in schedule.split(';'):
+            if not phase.strip():
+                continue
+            try:
+                start, settings = phase.split(':')
+                settings = [s.split('=') for s in settings.split(',') if s.strip()]
+                settings = {k.strip(): cls.KEYS[k.strip()](v.strip()) for k, v in settings}
+                phases.append((float(start), settings))
+            except (ValueError, KeyError) as e:
+                raise ValueError(f"Invalid phase of the compute schedule: {phase!r}. "
+                                 f"Expected <fraction>:<key>=<value>,... with keys {list(cls.KEYS)}") from e
+        return cls(phases, timesteps)
+
+    def at(self, t_index):
+        for start, settings in self.phases:
+            if t_index >= start * self.timesteps:
+                return settings
+        return {}
+
+    def __str__(self):
+        return ";".join(f"{start}:" + ",".join(f"{k}={v}" for k, v in settings.items()) for start, settings in self.phases)
+
+
+class FeatureCache(object):
+    """
+    Reuse of the deep features of PAMNet between adjacent denoising steps. The message passing stack, the fusion module
+    and the sequence-structure transformer are recomputed every `every` steps, or earlier if the coordinates drifted by
+    more than `drift` (RMS displacement relative to the RMS of the coordinates) since the last recomputation.
+    In between, only the input embeddings and the output layer are recomputed, reusing the cached residual of the
+    message passing stack and the cached transformer output. On every recomputation the reused prediction is compared
+    with the exact one, so the hit rate and the error of the policy can be monitored (see stats).
+    The cached features belong to one input: `graph` (the edges and the sequence features) of another input resets the cache.
+    """
+    def __init__(self, every: int = 4, drift: float = None):
+        self.every = every
+        self.drift = drift
+        self.hits = 0
+        self.misses = 0
+        self.errors = []
+        self.reset()
+
+    def reset(self):
+        self.pos = None
+        self.delta = None
+        self.out = None
+        self.graph = None
+        self.age = 0
+
+    def same_graph(self, graph):
+        if self.graph is None or graph is None:
+            return self.graph is graph
+        return all(a is b or (a.shape == b.shape and torch.equal(a, b)) for a, b in zip(self.graph, graph))
+
+    def valid(self, pos, graph=None):
+        if self.pos is not None and not self.same_graph(graph):
+            self.reset()
+        if self.pos is None or self.pos.shape != pos.shape or self.age + 1 >= self.every:
+            return False
+        if self.drift is not None:
+            drift = (pos - self.pos).pow(2).mean().sqrt() / self.pos.pow(2).mean().sqrt()
+            return drift.item() <= self.drift
+        return True
+
+    def reuse(self):
+        # the cached residual of the message passing stack and transformer output
+        self.hits += 1
+        self.age += 1
+        return self.delta, self.out
+
+    def store(self, pos, delta, out, graph=None):
+        self.pos = pos.clone()
+        self.delta = delta
+        self.out = out
+        self.graph = graph
+        self.age = 0
+        self.misses += 1
+
+    def record_error(self, reused, exact):
+        # relative error of the reused noise prediction (coordinates only)
+        error = (reused[:, :3] - exact[:, :3]).norm() / exact[:, :3].norm()
+        self.errors.append(error.item())
+
+    def stats(self):
+        calls = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / calls if calls else 0.,
+            "mean_error": sum(self.errors) / len(self.errors) if self.errors else 0.,
+            "max_error": max(self.errors) if self.errors else 0.,
+        }
@@ -0,0 +1,27 @@
+# Resources used by the process: its peak resident memory (used by the service workers and utils.estimate_cost)
+import sys
+
+
+def reset_peak_rss():
+    # resets the peak resident memory of the process (VmHWM, Linux only), so that peak_rss() measures the next job
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def peak_rss():
+    """
+    Peak resident memory of the process in bytes, since the last reset_peak_rss() where it is supported.
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    import resource
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == "darwin" else maxrss * 1024 # bytes on macOS, kB elsewhere
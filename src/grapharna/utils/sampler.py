@@ -1,6 +1,11 @@
+import hashlib
+import math
+import threading
+import time
 import torch
 import torch.nn.functional as F
 from tqdm import tqdm
+from grapharna.utils.sampling_masks import residue_index
 
 
 def cosine_beta_schedule(timesteps, s=0.008):
@@ -46,10 +51,114 @@ def generate_per_residue_noise(x_data, eps=1e-3):
 
     return noise
 
+TABLES = ["betas", "sqrt_recip_alphas", "sqrt_alphas_cumprod", "sqrt_one_minus_alphas_cumprod",
+          "posterior_variance", "eps_coef", "posterior_std"]
+
+class StepBuffers():
+    """
+    Preallocated per-atom buffers of the reverse diffusion step, reused by every timestep.
+    """
+    def __init__(self, num_atoms, device):
+        self.noise = torch.empty((num_atoms, 3), device=device)
+        self.eps_coef = torch.empty((num_atoms, 1), device=device)
+        self.mean_coef = torch.empty((num_atoms, 1), device=device)
+        self.std = torch.empty((num_atoms, 1), device=device)
+
+def structure_seed(seed, name):
+    """
+    Seed of the random stream of a single structure, derived from the request seed and the structure name.
+    """
+    digest = hashlib.sha256(f"{seed}:{name}".encode()).digest()
+    return int.from_bytes(digest[:8], 'little') & ((1 << 63) - 1)
+
+class StructureNoise():
+    """
+    Independent random streams of the structures in a batch. Every structure draws its noise
+    from its own generator, so its trajectory does not depend on the structures it is batched with.
+    `ptr` holds the offsets of the structures in the batch (as in torch_geometric Batch.ptr).
+    """
+    def __init__(self, seeds, ptr, device):
+        device = torch.device(device)
+        self.generators = [torch.Generator(device=device).manual_seed(s) for s in seeds]
+        self.ptr = [int(p) for p in ptr]
+
+    @classmethod
+    def from_names(cls, seed, names, ptr, device):
+        return cls([structure_seed(seed, name) for name in names], ptr, device)
+
+    @classmethod
+    def concat(cls, streams):
+        """
+        Batches the streams of separate inputs. The generators are shared, so every structure continues its own stream.
+        """
+        out = cls.__new__(cls)
+        out.generators = []
+        out.ptr = [0]
+        for stream in streams:
+            offset = out.ptr[-1]
+            out.generators.extend(stream.generators)
+            out.ptr.extend(p + offset for p in stream.ptr[1:])
+        return out
+
+    def select(self, graphs):
+        """
+        Streams of the structures `graphs` (indices in the batch), batched in this order. The generators are shared.
+        """
+        out = StructureNoise.__new__(StructureNoise)
+        out.generators = [self.generators[g] for g in graphs]
+        out.ptr = [0]
+        for g in graphs:
+            out.ptr.append(out.ptr[-1] + self.ptr[g + 1] - self.ptr[g])
+        return out
+
+    def slices(self):
+        return zip(self.generators, self.ptr[:-1], self.ptr[1:])
+
+    def rand_(self, out):
+        for generator, start, end in self.slices():
+            out[start:end].uniform_(generator=generator)
+        return out
+
+    def randn_(self, out):
+        for generator, start, end in self.slices():
+            out[start:end].normal_(generator=generator)
+        return out
+
+class SamplingCancelled(Exception):
+    """
+    Raised by the sampling loops of a cancelled Sampler. `snapshot` is the state of an interrupted p_sample_loop
+    if the token asked for it (see CancellationToken), None otherwise.
+    """
+    def __init__(self, snapshot=None):
+        super().__init__("Sampling cancelled")
+        self.snapshot = snapshot
+
+class CancellationToken():
+    """
+    Cooperative cancellation of the sampling (see Sampler.cancel). The sampling loops check the token between
+    the timesteps, so they stop within one step after cancel() is called, from any thread.
+    With `snapshot`, p_sample_loop keeps the coordinates and the random streams of the interrupted sampling
+    in SamplingCancelled.snapshot, and p_sample_loop(..., resume=snapshot) continues it to the same result.
+    """
+    def __init__(self, snapshot: bool = False):
+        self.snapshot = snapshot
+        self.event = threading.Event()
+
+    def cancel(self):
+        self.event.set()
+
+    @property
+    def cancelled(self):
+        return self.event.is_set()
+
 class Sampler():
-    def __init__(self, timesteps: int, channels: int=3):
+    def __init__(self, timesteps: int, channels: int=3, compute_schedule=None, feature_cache=None, progress=None, cancel=None):
         self.timesteps = timesteps
         self.channels = channels
+        self.compute_schedule = compute_schedule # see reduced_compute.ComputeSchedule
+        self.feature_cache = feature_cache # see reduced_compute.FeatureCache
+        self.progress = progress # called with (steps done, total steps) after every step of the sampling loops
+        self.cancel = cancel # CancellationToken checked before every step of the sampling loops
         # define beta schedule
         # self.betas = cosine_beta_schedule(timesteps=timesteps)
         self.betas = linear_beta_schedule(timesteps=timesteps)
@@ -61,75 +170,391 @@ class Sampler():
         self.sqrt_recip_alphas = torch.sqrt(1.0 / alphas)
 
         # calculations for diffusion q(x_t | x_{t-1}) and others
+        self.alphas_cumprod = alphas_cumprod # stays on the CPU, see jump_coefficients
         self.sqrt_alphas_cumprod = torch.sqrt(alphas_cumprod)
         self.sqrt_one_minus_alphas_cumprod = torch.sqrt(1. - alphas_cumprod)
 
         # calculations for posterior q(x_{t-1} | x_t, x_0)
         self.posterior_variance = self.betas * (1. - alphas_cumprod_prev) / (1. - alphas_cumprod)
 
+        # coefficients of the reverse step: x_{t-1} = mean_coef * (x_t - eps_coef * eps) + posterior_std * z
+        # posterior_std is 0 for t = 0, so the last step does not add noise
+        self.eps_coef = self.betas / self.sqrt_one_minus_alphas_cumprod
+        self.posterior_std = torch.sqrt(self.posterior_variance)
+        self.device = torch.device('cpu')
+
+    def to(self, device):
+        """
+        Moves the coefficient tables to the device, so that the sampling steps do not copy anything between host and device.
+        """
+        for name in TABLES:
+            setattr(self, name, getattr(self, name).to(device))
+        self.device = torch.device(device)
+        return self
+
+    def set_compute(self, session, t_index):
+        """
+        Selects the compute of the model for timestep `t_index` according to the compute schedule.
+        """
+        if self.compute_schedule is not None:
+            session.compute = self.compute_schedule.at(t_index)
+
+    def report(self, done, total):
+        if self.progress is not None:
+            self.progress(done, total)
+
+    def check_cancelled(self, snapshot=None):
+        """
+        Raises SamplingCancelled if the token of the sampler is cancelled. `snapshot()` returns the state
+        of the loop, it is called only if the token asks for a snapshot.
+        """
+        if self.cancel is not None and self.cancel.cancelled:
+            raise SamplingCancelled(snapshot() if self.cancel.snapshot and snapshot is not None else None)
+
+    def attach_cache(self, session):
+        """
+        Attaches the feature cache to a new session. The cached features of the previous session are dropped,
+        the statistics are kept.
+        """
+        if self.feature_cache is not None:
+            self.feature_cache.reset()
+            session.feature_cache = self.feature_cache
+        return session
 
     @torch.no_grad()
-    def p_sample(self, model, seqs, x_raw, t, t_index, coord_mask, atoms_mask):
-        x = x_raw.x * coord_mask
-        betas_t = self.extract(self.betas, t, x.shape)
-        sqrt_one_minus_alphas_cumprod_t = self.extract(
-            self.sqrt_one_minus_alphas_cumprod, t, x.shape
-        )
-        sqrt_recip_alphas_t = self.extract(self.sqrt_recip_alphas, t, x.shape)
-        
-        # Equation 11 in the paper
-        # Use our model (noise predictor) to predict the mean
-        model_mean = sqrt_recip_alphas_t * (
-            x - betas_t * model(x_raw, seqs, t)*coord_mask / sqrt_one_minus_alphas_cumprod_t
-        )
+    def p_sample(self, session, pos, t, buffers, noise=None):
+        """
+        Algorithm 2 (lines 3-4), updating the coordinates `pos` (N, 3) in place.
+        `t` holds the timestep of each atom and `buffers` is a StepBuffers instance of the same size.
+        `noise` (StructureNoise) draws the posterior noise, the global generator is used if it is None.
+        """
+        eps = session(pos, t)[:, :3]
+        torch.index_select(self.eps_coef, 0, t, out=buffers.eps_coef.view(-1))
+        torch.index_select(self.sqrt_recip_alphas, 0, t, out=buffers.mean_coef.view(-1))
+        torch.index_select(self.posterior_std, 0, t, out=buffers.std.view(-1))
+
+        return self.update(pos, eps, buffers, noise)
+
+    def update(self, pos, eps, buffers, noise=None):
+        # Equation 11 in the paper, with the coefficients of the step in `buffers`
+        pos.addcmul_(eps, buffers.eps_coef, value=-1).mul_(buffers.mean_coef)
+        if noise is None:
+            buffers.noise.normal_()
+        else:
+            noise.randn_(buffers.noise)
+        pos.addcmul_(buffers.noise, buffers.std)
+        return pos
+
+    def jump_coefficients(self, t_index, t_prev):
+        """
+        Coefficients (eps_coef, mean_coef, std) of a reverse step from `t_index` directly to `t_prev` < `t_index`
+        in the respaced process (t_prev = -1 is the clean structure). For t_prev = t_index - 1 these are the
+        coefficients of the regular step.
+        """
+        alpha_t = float(self.alphas_cumprod[t_index])
+        alpha_prev = float(self.alphas_cumprod[t_prev]) if t_prev >= 0 else 1.
+        beta = 1. - alpha_t / alpha_prev
+        return beta / math.sqrt(1. - alpha_t), 1. / math.sqrt(1. - beta), math.sqrt(beta * (1. - alpha_prev) / (1. - alpha_t))
+
+    @torch.no_grad()
+    def p_sample_jump(self, session, pos, t, t_prev, buffers, noise=None):
+        """
+        Reverse step of all atoms from the timestep in `t` (the same for all atoms) to `t_prev`, updating `pos` in place.
+        """
+        eps = session(pos, t)[:, :3]
+        eps_coef, mean_coef, std = self.jump_coefficients(int(t[0]), t_prev)
+        buffers.eps_coef.fill_(eps_coef)
+        buffers.mean_coef.fill_(mean_coef)
+        buffers.std.fill_(std)
+        return self.update(pos, eps, buffers, noise)
 
+
+    def add_fixed(self, pos, fixed, t_index, x_start, buffers, noise=None):
+        """
+        Sets the fixed atoms to the template coordinates diffused to the level of the next step, x_{t-1} ~ q(x_{t-1} | x_0),
+        and to the template itself after the last step. `fixed` indexes the rows of `pos`, `x_start` holds their coordinates.
+        """
         if t_index == 0:
-            x_raw.x = model_mean * coord_mask + x_raw.x * atoms_mask
-            return x_raw.x
+            pos[fixed] = x_start
+            return pos
+        if noise is None:
+            buffers.noise.normal_()
         else:
-            posterior_variance_t = self.extract(self.posterior_variance, t, x.shape)
-            noise = torch.randn_like(x)
-            # Algorithm 2 line 4:
-            out = model_mean + torch.sqrt(posterior_variance_t) * noise
-            x_raw.x = out * coord_mask + x_raw.x * atoms_mask
-            return x_raw.x
-
-
-    def add_fixed(self, raw_x, fixed, t, t_index, x_start):
-        if torch.any(fixed) and t_index > 0:
-            denoised_raw = self.q_sample(x_start, t - 1)
-            raw_x[fixed] = denoised_raw[fixed]
-        if torch.any(fixed) and t_index == 0:
-            raw_x[fixed] = x_start[fixed]
-        return raw_x
- 
- 
+            noise.randn_(buffers.noise)
+        pos[fixed] = self.sqrt_alphas_cumprod[t_index - 1] * x_start + \
+            self.sqrt_one_minus_alphas_cumprod[t_index - 1] * buffers.noise[fixed]
+        return pos
+
+    def inpainting_subgraph(self, context_mols, mask, cutoff, chunk_size=1024):
+        """
+        Selects the residues to resample (`mask`) together with a shell of fixed context: the residues with any atom
+        within `cutoff` of a resampled atom, and the residues adjacent in sequence. Returns the indices of the atoms
+        of the subgraph and the mask of the resampled atoms within it.
+        """
+        pos = context_mols.x[:, :3]
+        batch = context_mols.batch
+        residue, _ = residue_index(context_mols.x, batch)
+        residue_batch = torch.zeros(residue[-1] + 1, dtype=batch.dtype, device=pos.device)
+        residue_batch[residue] = batch
+        masked = mask.nonzero().view(-1)
+
+        near = torch.zeros_like(mask)
+        for chunk in masked.split(chunk_size):
+            dist = torch.cdist(pos, pos[chunk])
+            same_graph = batch[:, None] == batch[chunk][None, :]
+            near |= ((dist <= cutoff) & same_graph).any(dim=1)
+
+        selected = torch.zeros(residue[-1] + 1, dtype=torch.bool, device=pos.device)
+        selected[residue[near | mask]] = True
+        masked_res = residue[masked].unique()
+        source = masked_res.repeat(2)
+        neighbors = torch.cat((masked_res - 1, masked_res + 1))
+        valid = (neighbors >= 0) & (neighbors < selected.size(0))
+        neighbors, source = neighbors[valid], source[valid]
+        selected[neighbors[residue_batch[neighbors] == residue_batch[source]]] = True # only within the same structure
+
+        sub_index = selected[residue].nonzero().view(-1)
+        return sub_index, mask[sub_index]
+
+    @torch.no_grad()
+    def inpaint(self, model, seqs, context_mols, mask, cutoff, names=None, seed=None):
+        """
+        Resamples the atoms selected by `mask` while the rest of the structure stays as in `context_mols`.
+        Only the subgraph of the resampled residues and their fixed context (see inpainting_subgraph) is denoised,
+        the fixed atoms of the subgraph follow the diffused template (see add_fixed).
+        """
+        device = next(model.parameters()).device
+        self.to(device)
+        mask = mask.to(device)
+        sub_index, resampled = self.inpainting_subgraph(context_mols, mask, cutoff)
+        fixed = (~resampled).nonzero().view(-1)
+        x_start = context_mols.x[sub_index, :3]
+        x_start_fixed = x_start[fixed]
+
+        session = self.attach_cache(model.sampling_session(context_mols, seqs, self.timesteps).subset(sub_index))
+        counts = torch.bincount(context_mols.batch[sub_index], minlength=context_mols.num_graphs)
+        ptr = torch.cat((counts.new_zeros(1), torch.cumsum(counts, dim=0)))
+        noise = self.structure_noise(context_mols, names, seed, ptr=ptr)
+
+        n = sub_index.size(0)
+        t = torch.empty(n, device=device, dtype=torch.long)
+        buffers = StepBuffers(n, device)
+        pos = noise.rand_(torch.empty((n, 3), device=device)) # start from pure noise
+        self.add_fixed(pos, fixed, self.timesteps, x_start_fixed, buffers, noise)
+        for i in tqdm(reversed(range(0, self.timesteps)), desc='sampling loop time step', total=self.timesteps):
+            self.check_cancelled()
+            t.fill_(i)
+            self.set_compute(session, i)
+            self.p_sample(session, pos, t, buffers, noise)
+            self.add_fixed(pos, fixed, i, x_start_fixed, buffers, noise)
+            self.report(self.timesteps - i, self.timesteps)
+        context_mols.x[sub_index, :3] = pos
+        return [context_mols.clone().cpu()]
+
     # Algorithm 2
+    def structure_noise(self, context_mols, names=None, seed=None, ptr=None):
+        """
+        Random streams of the structures in the batch, seeded from (seed, name). By default the structures are named
+        by their position in the batch and the seed is the one of the global generator (see set_seed).
+        `ptr` overrides the offsets of the structures, e.g. when only a subgraph is sampled.
+        `seed` may also be a list with the seed of every structure, e.g. when the requests of several users are batched.
+        """
+        num_graphs = context_mols.num_graphs if hasattr(context_mols, 'num_graphs') else 1
+        if ptr is None:
+            ptr = context_mols.ptr if hasattr(context_mols, 'ptr') else [0, context_mols.x.size(0)]
+        if names is None:
+            names = [str(i) for i in range(num_graphs)]
+        if seed is None:
+            seed = torch.initial_seed()
+        assert len(names) == num_graphs, f"Expected {num_graphs} names, got {len(names)}"
+        if isinstance(seed, (list, tuple)):
+            assert len(seed) == num_graphs, f"Expected {num_graphs} seeds, got {len(seed)}"
+            return StructureNoise([structure_seed(s, name) for s, name in zip(seed, names)], ptr, context_mols.x.device)
+        return StructureNoise.from_names(seed, names, ptr, context_mols.x.device)
+
     @torch.no_grad()
-    def p_sample_loop(self, model, seqs, shape, context_mols):
+    def p_sample_loop(self, model, seqs, shape, context_mols, names=None, seed=None, resume=None):
+        """
+        Samples the structures from pure noise. `resume` is the snapshot of a cancelled p_sample_loop
+        of the same batch (see CancellationToken), the sampling continues from its timestep.
+        """
         device = next(model.parameters()).device
 
+        self.to(device)
         b = shape[0]
+        noise = self.structure_noise(context_mols, names, seed)
         # start from pure noise (for each example in the batch)
-        coord_mask = torch.ones_like(context_mols.x)
-        coord_mask[:, 3:] = 0
-        atoms_mask = 1 - coord_mask
-        noise = torch.rand_like(context_mols.x, device=device)
+        pos = noise.rand_(torch.empty((b, 3), device=device))
+        start = self.timesteps
+        if resume is not None:
+            pos.copy_(resume["pos"])
+            for generator, state in zip(noise.generators, resume["rng"]):
+                generator.set_state(state)
+            start = resume["t"] + 1
+        t = torch.empty(b, device=device, dtype=torch.long)
+        buffers = StepBuffers(b, device)
         denoised = []
-        
-        context_mols.x = noise * coord_mask + context_mols.x * atoms_mask
-        for i in tqdm(reversed(range(0, self.timesteps)), desc='sampling loop time step', total=self.timesteps):
-            context_mols.x = self.p_sample(model, seqs, context_mols, torch.full((b,), i, device=device, dtype=torch.long), i, coord_mask, atoms_mask)
+
+        def snapshot():
+            # the state before the step i
+            return {"t": i, "pos": pos.cpu().clone(), "rng": [g.get_state() for g in noise.generators]}
+
+        session = self.attach_cache(model.sampling_session(context_mols, seqs, self.timesteps)) # inputs shared by all timesteps
+        for i in tqdm(reversed(range(0, start)), desc='sampling loop time step', total=start):
+            self.check_cancelled(snapshot)
+            t.fill_(i)
+            self.set_compute(session, i)
+            self.p_sample(session, pos, t, buffers, noise)
+            self.report(self.timesteps - i, self.timesteps)
             # denoised.append(context_mols.clone().cpu())
+        context_mols.x[:, :3] = pos
         denoised.append(context_mols.clone().cpu())
         return denoised
 
 
 
     @torch.no_grad()
-    def sample(self, model, seqs, context_mols):
-        return self.p_sample_loop(model, seqs, shape=context_mols.x.shape, context_mols=context_mols)
+    def sample(self, model, seqs, context_mols, names=None, seed=None, resume=None):
+        return self.p_sample_loop(model, seqs, shape=context_mols.x.shape, context_mols=context_mols, names=names, seed=seed,
+                                  resume=resume)
+
+    @torch.no_grad()
+    def sample_ensemble(self, model, seqs, context_mols, num_samples: int, fork_step: int = 0, names=None, seed=None):
+        """
+        Samples `num_samples` structures for each input. The first `fork_step` (high noise) steps are shared:
+        the trajectory is then forked into `num_samples` copies, which continue as one batch with their own random
+        streams (named "<name>/<k>"). This costs fork_step + num_samples * (timesteps - fork_step) model evaluations
+        per input instead of num_samples * timesteps. Returns a list of `num_samples` batches.
+        """
+        device = next(model.parameters()).device
+        self.to(device)
+        fork_step = max(0, min(fork_step, self.timesteps))
+        n = context_mols.x.size(0)
+        noise = self.structure_noise(context_mols, names, seed)
+        pos = noise.rand_(torch.empty((n, 3), device=device)) # start from pure noise
+        t = torch.empty(n, device=device, dtype=torch.long)
+        buffers = StepBuffers(n, device)
+        session = self.attach_cache(model.sampling_session(context_mols, seqs, self.timesteps))
+        for i in tqdm(range(self.timesteps - 1, self.timesteps - 1 - fork_step, -1), desc='shared time step', total=fork_step):
+            self.check_cancelled()
+            t.fill_(i)
+            self.set_compute(session, i)
+            self.p_sample(session, pos, t, buffers, noise)
+            self.report(self.timesteps - i, self.timesteps)
+
+        # fork
+        if names is None:
+            names = [str(i) for i in range(context_mols.num_graphs)]
+        noise = StructureNoise.concat([self.structure_noise(context_mols, [f"{name}/{k}" for name in names], seed)
+                                       for k in range(num_samples)])
+        session = self.attach_cache(session.concat([session] * num_samples))
+        pos = pos.repeat(num_samples, 1)
+        t = torch.empty(n * num_samples, device=device, dtype=torch.long)
+        buffers = StepBuffers(n * num_samples, device)
+        for i in tqdm(reversed(range(0, self.timesteps - fork_step)), desc='branch time step', total=self.timesteps - fork_step):
+            self.check_cancelled()
+            t.fill_(i)
+            self.set_compute(session, i)
+            self.p_sample(session, pos, t, buffers, noise)
+            self.report(self.timesteps - i, self.timesteps)
+
+        samples = []
+        for k in range(num_samples):
+            out = context_mols.clone()
+            out.x[:, :3] = pos[k * n:(k + 1) * n]
+            samples.append(out.cpu())
+        return samples
+
+    @torch.no_grad()
+    def refine(self, model, seqs, context_mols, start_t, names=None, seed=None):
+        """
+        Warm start from the coordinates in `context_mols`: they are noised to timestep `start_t` (q_sample)
+        and denoised from there, which takes start_t + 1 steps instead of `timesteps`.
+        `start_t` is a single timestep or one per structure. All structures reach t = 0 in the same step,
+        so a structure with a lower start time joins the batch later and only the started ones are evaluated.
+        """
+        device = next(model.parameters()).device
+        self.to(device)
+        num_graphs = context_mols.num_graphs
+        start_t = torch.as_tensor(start_t, dtype=torch.long).view(-1).clamp(0, self.timesteps - 1)
+        if start_t.numel() == 1:
+            start_t = start_t.repeat(num_graphs)
+        assert start_t.numel() == num_graphs, f"Expected {num_graphs} start timesteps, got {start_t.numel()}"
+
+        noise = self.structure_noise(context_mols, names, seed)
+        x_start = context_mols.x[:, :3]
+        pos = self.q_sample(x_start, start_t.to(device)[context_mols.batch], noise=noise.randn_(torch.empty_like(x_start)))
+        full_session = model.sampling_session(context_mols, seqs, self.timesteps)
+        ptr = context_mols.ptr.tolist()
+        starts = start_t.tolist()
+        phases = sorted(set(starts), reverse=True) + [-1]
+        for hi, lo in zip(phases[:-1], phases[1:]):
+            # the structures started so far, denoised from `hi` down to the next start time
+            graphs = [g for g in range(num_graphs) if starts[g] >= hi]
+            if len(graphs) == num_graphs:
+                index = torch.arange(pos.size(0), device=device)
+                session = full_session
+            else:
+                index = torch.cat([torch.arange(ptr[g], ptr[g + 1]) for g in graphs]).to(device)
+                session = full_session.subset(index)
+            self.attach_cache(session)
+            active = pos[index]
+            active_noise = noise.select(graphs)
+            t = torch.empty(index.size(0), device=device, dtype=torch.long)
+            buffers = StepBuffers(index.size(0), device)
+            for i in tqdm(range(hi, lo, -1), desc='refinement time step', total=hi - lo):
+                self.check_cancelled()
+                t.fill_(i)
+                self.set_compute(session, i)
+                self.p_sample(session, active, t, buffers, active_noise)
+                self.report(phases[0] - i + 1, phases[0] + 1)
+            pos[index] = active
+        context_mols.x[:, :3] = pos
+        return [context_mols.clone().cpu()]
+
+    @torch.no_grad()
+    def sample_with_deadline(self, model, seqs, context_mols, time_budget: float, names=None, seed=None, margin: float = 0.9):
+        """
+        Anytime sampling within `time_budget` seconds. The latency of the steps is measured while sampling
+        and before every step the remaining timesteps are respaced (strided) to fit into the remaining budget,
+        so the plan adapts if the steps slow down. Every step moves the coordinates by at least one timestep
+        and the last one always reaches t = 0, so a complete structure is returned; if the budget is too small
+        even for two steps it is exceeded by at most one step. Returns the samples and the number of steps used.
+        """
+        start = time.perf_counter()
+        deadline = start + margin * time_budget
+        device = next(model.parameters()).device
+        self.to(device)
+        b = context_mols.x.size(0)
+        noise = self.structure_noise(context_mols, names, seed)
+        pos = noise.rand_(torch.empty((b, 3), device=device)) # start from pure noise
+        t = torch.empty(b, device=device, dtype=torch.long)
+        buffers = StepBuffers(b, device)
+        session = self.attach_cache(model.sampling_session(context_mols, seqs, self.timesteps))
 
+        step_time = None
+        steps = 0
+        t_index = self.timesteps - 1
+        while t_index >= 0:
+            self.check_cancelled()
+            if step_time is None:
+                t_prev = t_index - 1 # the first step measures the latency
+            else:
+                steps_left = max(1, int((deadline - time.perf_counter()) / step_time))
+                t_prev = max(t_index - max(1, math.ceil((t_index + 1) / steps_left)), -1)
+            step_start = time.perf_counter()
+            t.fill_(t_index)
+            self.set_compute(session, t_index)
+            self.p_sample_jump(session, pos, t, t_prev, buffers, noise)
+            if device.type == 'cuda':
+                torch.cuda.synchronize(device)
+            elapsed = time.perf_counter() - step_start
+            step_time = elapsed if step_time is None else 0.8 * step_time + 0.2 * elapsed
+            steps += 1
+            t_index = t_prev
+            self.report(self.timesteps - 1 - t_index, self.timesteps)
+        context_mols.x[:, :3] = pos
+        return [context_mols.clone().cpu()], steps
 
     # forward diffusion (using the nice property)
     def q_sample(self,
@@ -150,5 +575,5 @@ class Sampler():
 
     def extract(self, a, t, x_shape):
         batch_size = t.shape[0]
-        out = a.gather(-1, t.cpu())
-        return out.reshape(batch_size, *((1,) * (len(x_shape) - 1))).to(t.device)
\ No newline at end of file
+        out = a.to(t.device).gather(-1, t) # no copy if the tables are already on the device (see Sampler.to)
+        return out.reshape(batch_size, *((1,) * (len(x_shape) - 1)))
\ No newline at end of file
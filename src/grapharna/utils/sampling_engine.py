@@ -0,0 +1,252 @@
+import threading
+from collections import deque
+from concurrent.futures import Future
+import torch
+from torch_geometric.data import Batch
+
+from grapharna.utils.sampler import SamplingCancelled, StepBuffers, StructureNoise
+
+
+class SamplingRequest():
+    def __init__(self, data, seq, name, seed):
+        self.data = data
+        self.seq = seq
+        self.name = name
+        self.seed = seed
+        self.future = Future()
+        self.session = None
+        self.noise = None
+        self.pos = None
+        self.t = None
+        self.skipped = 0 # how many times a later request was admitted before this one
+
+    @property
+    def num_atoms(self):
+        return self.data.x.size(0)
+
+
+class SamplingEngine():
+    """
+    Continuous batching of the reverse diffusion, in the style of LLM serving schedulers.
+    Requests enter the live batch at their first timestep and are emitted and evicted as soon as they reach t = 0,
+    while the other structures keep being denoised at their own timesteps. Pending requests are admitted whenever
+    the live batch has room (up to `max_atoms`), so the model runs on a full batch under a steady stream of requests.
+    Smaller requests may be admitted before a larger one that does not fit yet, but at most `max_skips` times.
+    Every structure uses its own random stream (see StructureNoise), so its result does not depend on the batching.
+    A request is cancelled with cancel(future), the requests that are not finished when the engine stops
+    fail with SamplingCancelled.
+
+    engine = SamplingEngine(model, Sampler(timesteps=5000)).start()
+    future = engine.submit(data, seq, name, seed)
+    sample = future.result() # or await asyncio.wrap_future(future)
+    """
+    def __init__(self, model, sampler, max_atoms: int = 10000, max_skips: int = 8):
+        self.model = model
+        self.sampler = sampler
+        self.max_atoms = max_atoms
+        self.max_skips = max_skips
+        self.device = next(model.parameters()).device
+        self.sampler.to(self.device)
+        self.time_table = None
+
+        self.pending = deque()
+        self.live = []
+        self.changed = False
+        self.cond = threading.Condition()
+        self.thread = None
+        self.running = False
+
+        # state of the live batch
+        self.members = []
+        self.session = None
+        self.pos = None
+        self.t = None
+        self.buffers = None
+        self.noise = None
+
+    def submit(self, data, seq: str, name: str, seed: int = 0) -> Future:
+        """
+        Queues a single structure (Data or a Batch with one graph) for sampling.
+        The returned future resolves to the sampled structure, as a Batch on the CPU.
+        """
+        if not isinstance(data, Batch):
+            data = Batch.from_data_list([data])
+        assert data.num_graphs == 1, "Submit the structures one by one"
+        request = SamplingRequest(data, seq, name, seed)
+        with self.cond:
+            self.pending.append(request)
+            self.cond.notify()
+        return request.future
+
+    def sample(self, data, seq: str, name: str, seed: int = 0):
+        return self.submit(data, seq, name, seed).result()
+
+    def cancel(self, future) -> bool:
+        """
+        Cancels the request of `future`: a pending request is dropped, a live one leaves the batch before the next step.
+        Returns False if the request already finished.
+        """
+        with self.cond:
+            if not future.cancel():
+                return False
+            for request in self.pending:
+                if request.future is future:
+                    self.pending.remove(request)
+                    break
+            self.cond.notify()
+        return True
+
+    def resolve(self, request, result=None, error=None):
+        # the futures are resolved under the lock, so that a result does not race with cancel()
+        with self.cond:
+            if request.future.done():
+                return
+            if error is not None:
+                request.future.set_exception(error)
+            else:
+                request.future.set_result(result)
+
+    def evict_cancelled(self):
+        live = [r for r in self.live if not r.future.cancelled()]
+        if len(live) < len(self.live):
+            self.live = live
+            self.changed = True
+
+    @property
+    def num_pending(self):
+        return len(self.pending)
+
+    @property
+    def live_atoms(self):
+        return sum(r.num_atoms for r in self.live)
+
+    def admit(self):
+        live_atoms = self.live_atoms
+        admitted = []
+        blocked = []
+        with self.cond:
+            for request in list(self.pending):
+                if (self.live or admitted) and live_atoms + request.num_atoms > self.max_atoms:
+                    blocked.append(request)
+                    if request.skipped >= self.max_skips:
+                        break # keep the room for a request that was overtaken too many times
+                    continue
+                self.pending.remove(request)
+                admitted.append(request)
+                live_atoms += request.num_atoms
+                for b in blocked:
+                    b.skipped += 1
+        for request in admitted:
+            try:
+                self.start_request(request)
+            except Exception as e:
+                self.resolve(request, error=e)
+                continue
+            self.live.append(request)
+            self.changed = True
+
+    def start_request(self, request):
+        request.data = request.data.to(self.device)
+        request.session = self.model.sampling_session(request.data, [request.seq], self.sampler.timesteps, time_table=self.time_table)
+        if self.time_table is None:
+            self.time_table = request.session.time_table
+        request.noise = StructureNoise.from_names(request.seed, [request.name], [0, request.num_atoms], self.device)
+        request.pos = request.noise.rand_(torch.empty((request.num_atoms, 3), device=self.device)) # start from pure noise
+        request.t = self.sampler.timesteps - 1
+
+    def write_back(self):
+        # the coordinates of each member are views of the batched buffer, valid until it is rebuilt
+        start = 0
+        for request in self.members:
+            request.pos = self.pos[start:start + request.num_atoms]
+            start += request.num_atoms
+
+    def rebuild(self):
+        if self.members:
+            self.write_back()
+        self.members = list(self.live)
+        self.session = self.sampler.attach_cache(self.members[0].session.concat([r.session for r in self.members]))
+        self.pos = torch.cat([r.pos for r in self.members], dim=0)
+        self.t = torch.cat([torch.full((r.num_atoms,), r.t, device=self.device, dtype=torch.long) for r in self.members])
+        self.buffers = StepBuffers(self.pos.size(0), self.device)
+        self.noise = StructureNoise.concat([r.noise for r in self.members])
+        self.changed = False
+
+    def finish(self, request):
+        out = request.data.clone()
+        out.x[:, :3] = request.pos
+        self.resolve(request, result=out.cpu())
+
+    @torch.no_grad()
+    def step(self):
+        """
+        Admits pending requests and runs one denoising step of the live batch. Returns False if there was nothing to do.
+        """
+        self.evict_cancelled()
+        self.admit()
+        if not self.live:
+            return False
+        try:
+            if self.changed:
+                self.rebuild()
+            # the least noisy structure decides the compute of the whole batch
+            self.sampler.set_compute(self.session, min(r.t for r in self.live))
+            self.sampler.p_sample(self.session, self.pos, self.t, self.buffers, self.noise)
+        except Exception as e:
+            for request in self.live:
+                self.resolve(request, error=e)
+            self.live, self.members = [], []
+            return True
+        self.t.sub_(1)
+
+        finished = []
+        for request in self.live:
+            request.t -= 1
+            if request.t < 0:
+                finished.append(request)
+        if finished:
+            self.write_back()
+            for request in finished:
+                self.finish(request)
+                self.live.remove(request)
+            self.members = [] # coordinates are already written back to the requests
+            self.changed = True
+        return True
+
+    def run_until_idle(self):
+        while self.step():
+            pass
+
+    def start(self):
+        """
+        Runs the engine in a background thread until stop() is called.
+        """
+        self.running = True
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stops the engine, the pending and live requests fail with SamplingCancelled.
+        """
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        if self.thread is not None:
+            self.thread.join()
+        with self.cond:
+            unfinished = list(self.pending) + self.live
+            self.pending.clear()
+        self.live, self.members = [], []
+        for request in unfinished:
+            self.resolve(request, error=SamplingCancelled())
+
+    def loop(self):
+        while True:
+            with self.cond:
+                while self.running and not self.pending and not self.live:
+                    self.cond.wait()
+                if not self.running:
+                    return
+            self.step()
@@ -1,4 +1,30 @@
 import torch
+from grapharna.constants import ATOM_TYPES
+
+
+def residue_index(x, batch):
+    """
+    Residue of every atom of a batch of coarse-grained structures, from the atom types in x[:, 3:7]. The atoms of
+    a residue are P, C4', N1/N9, C2 and C4/C6, the P may be missing. Returns the index of the residue within the batch
+    and within its structure. Raises ValueError if the atoms do not follow this layout.
+    """
+    atom_type = x[:, 3:7].argmax(dim=1)
+    same = batch[1:] == batch[:-1]
+    # C4' is the only carbon followed by a nitrogen of the same residue, the residue starts at it or at the P before it
+    c4 = torch.zeros_like(batch, dtype=torch.bool)
+    c4[:-1] = (atom_type[:-1] == ATOM_TYPES['C']) & (atom_type[1:] == ATOM_TYPES['N']) & same
+    p_before = (atom_type[:-1] == ATOM_TYPES['P']) & c4[1:] & same
+    start = c4.clone()
+    start[:-1] |= p_before
+    start[1:] &= ~p_before
+    counts = torch.bincount(batch)
+    first_atom = torch.cumsum(counts, dim=0) - counts
+    residue = torch.cumsum(start.long(), dim=0) - 1
+    sizes = torch.bincount(residue[residue >= 0])
+    if not start[first_atom].all() or not ((sizes == 4) | (sizes == 5)).all():
+        raise ValueError("The atoms are not coarse-grained residues of P, C4', N1/N9, C2 and C4/C6 (with an optional P)")
+    return residue, residue - residue[first_atom][batch]
+
 
 class SamplingMask():
     def __init__(self, path: str = None, device='cpu'):
@@ -35,27 +61,20 @@ class SamplingMask():
 
     def get_mask(self, data, name):
         names = [n.split('.')[0] for n in name]
-        names_masks = [n in self.resids_dict for n in names]
-        # find indeces where mask is True
-        indices = [i for i, x in enumerate(names_masks) if x]
-        mask = torch.zeros(data.x.shape[0], dtype=torch.bool)
-        mask = mask.to(self.device)
-        for index in indices:
-            mask = self.create_mask(data, index, mask, names[index])
-        if not indices: # if not in file, or no file given
+        # (structure index, first residue, last residue + 1) of every range to resample
+        ranges = [(i, *self.parse_range(r)) for i, n in enumerate(names) for r in self.resids_dict.get(n, [])]
+        if not any(n in self.resids_dict for n in names): # if not in file, or no file given
             mask = torch.ones(data.x.shape[0], dtype=torch.bool) # all residuses are predicted.
-            mask = mask.to(self.device)
-        return mask
-
-    def create_mask(self, data, index, mask, name):
-        batch_indeces = torch.where(data.batch == index)[0]
-        assert batch_indeces.shape[0] % 5 == 0
-        resids = self.resids_dict[name]
-        batch_indeces.to(self.device)
-        interest_mask = mask[batch_indeces]
-        interest_mask = interest_mask.reshape(-1, 5)
-        for r in resids:
-            start, end = self.parse_range(r)
-            interest_mask[start:end] = True
-        mask[batch_indeces] = interest_mask.reshape(-1)
-        return mask
+            return mask.to(self.device)
+        return self.create_mask(data, ranges)
+
+    def create_mask(self, data, ranges):
+        batch = data.batch.to(self.device)
+        if not ranges:
+            return torch.zeros(batch.size(0), dtype=torch.bool, device=self.device)
+        _, residue = residue_index(data.x.to(self.device), batch) # residue index within its structure
+        ranges = torch.tensor(ranges, dtype=torch.long, device=self.device)
+        in_range = (batch[:, None] == ranges[None, :, 0]) & \
+                   (residue[:, None] >= ranges[None, :, 1]) & \
+                   (residue[:, None] < ranges[None, :, 2])
+        return in_range.any(dim=1)
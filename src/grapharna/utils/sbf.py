@@ -1,6 +1,7 @@
 # Utils for spherical bessel functions. Similar as those used in DimeNet/DimeNet++:
 # https://github.com/gasteigerjo/dimenet/blob/master/dimenet/model/layers/basis_utils.py
 
+import math
 import numpy as np
 from scipy.optimize import brentq
 from scipy import special as sp
@@ -62,8 +63,8 @@ def bessel_basis(n, k):
 
 
 def sph_harm_prefactor(k, m):
-    return ((2 * k + 1) * np.math.factorial(k - abs(m)) /
-            (4 * np.pi * np.math.factorial(k + abs(m))))**0.5
+    return ((2 * k + 1) * math.factorial(k - abs(m)) /
+            (4 * np.pi * math.factorial(k + abs(m))))**0.5
 
 
 def associated_legendre_polynomials(k, zero_m_only=True):
@@ -0,0 +1,18 @@
+from grapharna.sample_rna_pdb import build_parser, validate_args
+
+
+def parse(*argv):
+    return build_parser().parse_args(list(argv))
+
+
+class TestArguments:
+    def test_valid_combinations(self):
+        assert validate_args(parse('--input', 'a.dotseq')) is None
+        assert validate_args(parse('--input', 'a.dotseq', '--template', 'a.pdb', '--sampling-resids', 'r.txt')) is None
+        assert validate_args(parse('--input', 'a.dotseq', '--init-structure', 'a.pdb', '--start-t', '500')) is None
+
+    def test_template_requires_sampling_resids(self):
+        assert "--sampling-resids" in validate_args(parse('--input', 'a.dotseq', '--template', 'a.pdb'))
+
+    def test_start_t_requires_init_structure(self):
+        assert "--init-structure" in validate_args(parse('--input', 'a.dotseq', '--start-t', '500'))
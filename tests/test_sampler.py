@@ -0,0 +1,546 @@
+import sys
+import types
+import pytest
+import torch
+from torch_geometric.data import Data, Batch
+from torch_geometric.nn import knn
+from grapharna.utils import Sampler, SamplingEngine, SamplingMask, ComputeSchedule, FeatureCache, ensemble_diversity, estimate_cost
+from grapharna.utils.sampler import StepBuffers, CancellationToken, SamplingCancelled
+
+
+class ConstantSession:
+    def __init__(self, out):
+        self.out = out
+
+    def __call__(self, pos, t):
+        return self.out.clone()
+
+
+class TestSampler:
+    timesteps = 50
+    num_atoms = 20
+
+    def reference_step(self, sampler, x, eps, t, noise):
+        # Equation 11 in the paper, computed as in the original implementation
+        betas_t = sampler.extract(sampler.betas, t, x.shape)
+        sqrt_one_minus_alphas_cumprod_t = sampler.extract(sampler.sqrt_one_minus_alphas_cumprod, t, x.shape)
+        sqrt_recip_alphas_t = sampler.extract(sampler.sqrt_recip_alphas, t, x.shape)
+        posterior_variance_t = sampler.extract(sampler.posterior_variance, t, x.shape)
+        model_mean = sqrt_recip_alphas_t * (x - betas_t * eps / sqrt_one_minus_alphas_cumprod_t)
+        return model_mean + torch.sqrt(posterior_variance_t) * noise
+
+    def test_p_sample_matches_reference(self):
+        sampler = Sampler(timesteps=self.timesteps)
+        out = torch.randn(self.num_atoms, 15)
+        session = ConstantSession(out)
+        buffers = StepBuffers(self.num_atoms, 'cpu')
+        for i in [self.timesteps - 1, 10, 0]:
+            pos = torch.randn(self.num_atoms, 3)
+            x = pos.clone()
+            t = torch.full((self.num_atoms,), i, dtype=torch.long)
+            sampler.p_sample(session, pos, t, buffers)
+            expected = self.reference_step(sampler, x, out[:, :3], t, buffers.noise)
+            assert torch.allclose(pos, expected, atol=1e-5)
+
+    def test_last_step_is_deterministic(self):
+        sampler = Sampler(timesteps=self.timesteps)
+        assert sampler.posterior_std[0] == 0
+
+
+class AtomwiseSession:
+    def __init__(self, model, num_atoms, timesteps):
+        self.model = model
+        self.num_atoms = num_atoms
+        self.num_graphs = 1
+        self.time_table = torch.arange(timesteps).float() / timesteps
+
+    @classmethod
+    def concat(cls, sessions):
+        out = cls(sessions[0].model, sum(s.num_atoms for s in sessions), 1)
+        out.time_table = sessions[0].time_table
+        return out
+
+    def subset(self, index):
+        out = AtomwiseSession(self.model, index.size(0), 1)
+        out.time_table = self.time_table
+        return out
+
+    def __call__(self, pos, t):
+        return self.model.linear(torch.cat((pos, self.time_table[t][:, None]), dim=1))
+
+
+class AtomwiseModel(torch.nn.Module):
+    """
+    Stand-in for PAMNet whose prediction for an atom depends only on its own coordinates and timestep.
+    """
+    def __init__(self):
+        super().__init__()
+        self.linear = torch.nn.Linear(4, 15)
+
+    def sampling_session(self, data, seqs, timesteps, time_table=None):
+        return AtomwiseSession(self, data.x.size(0), timesteps)
+
+
+def make_graph(num_residues, without_p=()):
+    # coarse-grained residues of P, C4', N, C2 and C4/C6, the residues in `without_p` have no P
+    atom_types = torch.tensor([t for i in range(num_residues) for t in ([0, 1, 0, 0] if i in without_p else [3, 0, 1, 0, 0])])
+    num_atoms = atom_types.size(0)
+    x = torch.cat((torch.zeros(num_atoms, 3), torch.nn.functional.one_hot(atom_types, 4).float(),
+                   torch.rand(num_atoms, 8)), dim=1)
+    edge_index = torch.stack((torch.arange(num_atoms - 1), torch.arange(1, num_atoms)))
+    return Data(x=x, edge_index=edge_index, edge_attr=torch.zeros(num_atoms - 1, 3))
+
+
+class FakeAlphabet:
+    # RiNALMo tokens: 0 and 1 for the start and the end of a sequence, 2 for padding, the nucleotides from 5
+    def batch_tokenize(self, seqs):
+        length = max(len(seq) for seq in seqs)
+        return [[0] + [5 + "ACGU".index(c) for c in seq] + [1] + [2] * (length - len(seq)) for seq in seqs]
+
+
+class FakeRiNALMo(torch.nn.Module):
+    """
+    Stand-in for the pretrained RiNALMo: random embeddings of the tokens.
+    """
+    def __init__(self):
+        super().__init__()
+        self.embedding = torch.nn.Embedding(9, 1280)
+
+    def forward(self, tokens):
+        return {"representation": self.embedding(tokens)}
+
+
+def knn_available():
+    try:
+        knn(torch.zeros(2, 3), torch.zeros(2, 3), 1)
+    except ImportError:
+        return False
+    return True
+
+
+@pytest.fixture
+def pamnet(monkeypatch):
+    """
+    Builds a small PAMNet, RiNALMo is replaced by FakeRiNALMo.
+    """
+    def get_pretrained_model(model_name):
+        return FakeRiNALMo(), FakeAlphabet()
+    rinalmo = types.ModuleType("rinalmo.pretrained")
+    rinalmo.get_pretrained_model = get_pretrained_model
+    monkeypatch.setitem(sys.modules, "rinalmo", types.ModuleType("rinalmo"))
+    monkeypatch.setitem(sys.modules, "rinalmo.pretrained", rinalmo)
+    from grapharna import models
+    monkeypatch.setattr(models, "get_pretrained_model", get_pretrained_model)
+
+    def build(n_layer=2, knns=6):
+        torch.manual_seed(0)
+        config = models.Config("test", dim=16, n_layer=n_layer, cutoff_l=2.0, cutoff_g=6.0, mode="all",
+                               knns=knns, transformer_blocks=1)
+        return models.PAMNet(config).eval()
+    return build
+
+
+class TestStructureNoise:
+    timesteps = 20
+
+    def sample(self, graphs, names, seed=0):
+        torch.manual_seed(0)
+        model = AtomwiseModel()
+        batch = Batch.from_data_list([g.clone() for g in graphs])
+        sampler = Sampler(timesteps=self.timesteps)
+        return sampler.sample(model, None, batch, names=names, seed=seed)[-1]
+
+    def test_batched_matches_single(self):
+        graphs = [make_graph(3), make_graph(7), make_graph(4)]
+        names = ["a", "b", "c"]
+        batched = self.sample(graphs, names)
+        for i, (graph, name) in enumerate(zip(graphs, names)):
+            single = self.sample([graph], [name])
+            assert torch.allclose(batched.x[batched.batch == i], single.x, atol=1e-6)
+
+    def test_per_structure_seeds(self):
+        graphs = [make_graph(3), make_graph(4)]
+        batched = self.sample(graphs, ["a", "a"], seed=[5, 7])
+        for i, seed in enumerate([5, 7]):
+            single = self.sample([graphs[i]], ["a"], seed=seed)
+            assert torch.allclose(batched.x[batched.batch == i], single.x, atol=1e-6)
+
+    def test_progress_reports(self):
+        reports = []
+        sampler = Sampler(timesteps=self.timesteps, progress=lambda done, total: reports.append((done, total)))
+        torch.manual_seed(0)
+        sampler.sample(AtomwiseModel(), None, Batch.from_data_list([make_graph(3)]))
+        assert reports == [(i, self.timesteps) for i in range(1, self.timesteps + 1)]
+
+    def test_seed_changes_trajectory(self):
+        graph = make_graph(3)
+        assert not torch.allclose(self.sample([graph], ["a"], seed=0).x, self.sample([graph], ["a"], seed=1).x)
+
+
+class TestCancellation:
+    timesteps = 20
+
+    def test_cancel_and_resume(self):
+        graphs = [make_graph(3), make_graph(4)]
+        reference = TestStructureNoise().sample(graphs, ["a", "b"])
+        token = CancellationToken(snapshot=True)
+        # cancelled after 5 steps, the loop stops before the next one
+        steps = []
+        sampler = Sampler(timesteps=self.timesteps, cancel=token,
+                          progress=lambda done, total: (steps.append(done), done == 5 and token.cancel()))
+        torch.manual_seed(0)
+        model = AtomwiseModel()
+        with pytest.raises(SamplingCancelled) as cancelled:
+            sampler.sample(model, None, Batch.from_data_list([g.clone() for g in graphs]), names=["a", "b"], seed=0)
+        snapshot = cancelled.value.snapshot
+        assert steps == [1, 2, 3, 4, 5] and snapshot["t"] == self.timesteps - 6
+
+        resumed = Sampler(timesteps=self.timesteps).sample(model, None, Batch.from_data_list([g.clone() for g in graphs]),
+                                                           names=["a", "b"], seed=0, resume=snapshot)[-1]
+        assert torch.allclose(resumed.x, reference.x, atol=1e-6)
+
+
+class TestCostEstimate:
+    def test_estimate_extrapolates_steps(self):
+        model = AtomwiseModel()
+        model.graph_stats = lambda pos, batch, edge_index: {"atoms": pos.size(0)}
+        data = Batch.from_data_list([make_graph(3), make_graph(4)])
+        cost = estimate_cost(model, Sampler(timesteps=20), data, None, steps=10)
+        assert cost["atoms"] == 35 and cost["steps"] == 10
+        assert cost["total_seconds"] == pytest.approx(cost["setup_seconds"] + 10 * cost["step_seconds"])
+        assert cost["peak_memory_bytes"] > 0
+
+    def test_ensemble_runs_on_forked_batch(self):
+        model = AtomwiseModel()
+        model.graph_stats = lambda pos, batch, edge_index: {"atoms": pos.size(0), "graphs": int(batch.max()) + 1}
+        data = Batch.from_data_list([make_graph(3), make_graph(4)])
+        cost = estimate_cost(model, Sampler(timesteps=20), data, None, num_samples=3, fork_step=5)
+        assert cost["atoms"] == 3 * 35 and cost["graphs"] == 6
+        assert cost["total_seconds"] == pytest.approx(cost["setup_seconds"] + 5 * cost["shared_step_seconds"] +
+                                                      15 * cost["step_seconds"])
+
+
+class TestEnsemble:
+    timesteps = 20
+
+    def ensemble(self, fork_step, num_samples=3):
+        torch.manual_seed(0)
+        model = AtomwiseModel()
+        batch = Batch.from_data_list([make_graph(3), make_graph(4)])
+        sampler = Sampler(timesteps=self.timesteps)
+        return sampler.sample_ensemble(model, None, batch, num_samples, fork_step, names=["a", "b"], seed=0)
+
+    def test_fork_at_the_end_matches_single_trajectory(self):
+        samples = self.ensemble(fork_step=self.timesteps)
+        reference = TestStructureNoise().sample([make_graph(3), make_graph(4)], ["a", "b"])
+        for sample in samples:
+            assert torch.allclose(sample.x[:, :3], reference.x[:, :3], atol=1e-6)
+        assert ensemble_diversity([s.x[:, :3].numpy() for s in samples]) < 1e-6
+
+    def test_branches_diverge_after_the_fork(self):
+        samples = self.ensemble(fork_step=10)
+        assert len(samples) == 3
+        assert samples[0].num_graphs == 2
+        assert ensemble_diversity([s.x[:, :3].numpy() for s in samples]) > 0
+
+
+class TestRefinement:
+    timesteps = 20
+
+    def refine(self, graphs, names, start_t):
+        torch.manual_seed(0)
+        model = AtomwiseModel()
+        batch = Batch.from_data_list([g.clone() for g in graphs])
+        return Sampler(timesteps=self.timesteps).refine(model, None, batch, start_t, names=names, seed=0)[-1]
+
+    def test_per_structure_start_matches_single(self):
+        graphs = [make_graph(3), make_graph(5), make_graph(4)]
+        for g in graphs:
+            g.x[:, :3] = torch.randn(g.x.size(0), 3)
+        names, starts = ["a", "b", "c"], [5, 12, 5]
+        batched = self.refine(graphs, names, starts)
+        for i, (graph, name, start) in enumerate(zip(graphs, names, starts)):
+            single = self.refine([graph], [name], start)
+            assert torch.allclose(batched.x[batched.batch == i], single.x, atol=1e-6)
+
+    def test_start_time_controls_the_noise(self):
+        graph = make_graph(4)
+        graph.x[:, :3] = torch.randn(graph.x.size(0), 3)
+        close = self.refine([graph], ["a"], 0).x[:, :3]
+        far = self.refine([graph], ["a"], self.timesteps - 1).x[:, :3]
+        assert (close - graph.x[:, :3]).abs().max() < (far - graph.x[:, :3]).abs().max()
+
+
+class TestDeadline:
+    timesteps = 20
+
+    def sample(self, time_budget):
+        torch.manual_seed(0)
+        model = AtomwiseModel()
+        batch = Batch.from_data_list([make_graph(3), make_graph(4)])
+        return Sampler(timesteps=self.timesteps).sample_with_deadline(model, None, batch, time_budget, names=["a", "b"], seed=0)
+
+    def test_jump_by_one_matches_regular_step(self):
+        sampler = Sampler(timesteps=self.timesteps)
+        for t in [0, 7, self.timesteps - 1]:
+            eps_coef, mean_coef, std = sampler.jump_coefficients(t, t - 1)
+            assert abs(eps_coef - sampler.eps_coef[t]) < 1e-5
+            assert abs(mean_coef - sampler.sqrt_recip_alphas[t]) < 1e-5
+            assert abs(std - sampler.posterior_std[t]) < 1e-5
+
+    def test_large_budget_runs_all_steps(self):
+        samples, steps = self.sample(time_budget=1e6)
+        reference = TestStructureNoise().sample([make_graph(3), make_graph(4)], ["a", "b"])
+        assert steps == self.timesteps
+        assert torch.allclose(samples[-1].x[:, :3], reference.x[:, :3], atol=1e-4)
+
+    def test_exhausted_budget_still_completes(self):
+        samples, steps = self.sample(time_budget=0.)
+        assert steps == 2 # the measured step and a jump to t = 0
+        assert torch.isfinite(samples[-1].x).all()
+
+
+class TestSamplingEngine:
+    timesteps = 20
+
+    def single(self, model, graph, name, seed):
+        sampler = Sampler(timesteps=self.timesteps)
+        return sampler.sample(model, None, Batch.from_data_list([graph.clone()]), names=[name], seed=seed)[-1]
+
+    def test_staggered_requests_match_single_sampling(self):
+        torch.manual_seed(0)
+        model = AtomwiseModel()
+        graphs = {"a": make_graph(3), "b": make_graph(7), "c": make_graph(4), "d": make_graph(2)}
+        engine = SamplingEngine(model, Sampler(timesteps=self.timesteps), max_atoms=60)
+        futures = {}
+        for name, graph in graphs.items():
+            futures[name] = engine.submit(graph.clone(), None, name, seed=3)
+            for _ in range(7): # the next request joins in the middle of the trajectories
+                engine.step()
+        engine.run_until_idle()
+        for name, graph in graphs.items():
+            assert torch.allclose(futures[name].result().x, self.single(model, graph, name, 3).x, atol=1e-6)
+        assert not engine.live and not engine.pending
+
+    def test_background_thread(self):
+        torch.manual_seed(0)
+        model = AtomwiseModel()
+        engine = SamplingEngine(model, Sampler(timesteps=self.timesteps)).start()
+        try:
+            graph = make_graph(5)
+            result = engine.submit(graph.clone(), None, "a", seed=1).result(timeout=30)
+        finally:
+            engine.stop()
+        assert torch.allclose(result.x, self.single(model, graph, "a", 1).x, atol=1e-6)
+
+    def test_cancel_request(self):
+        torch.manual_seed(0)
+        model = AtomwiseModel()
+        graphs = {"a": make_graph(3), "b": make_graph(4), "c": make_graph(5)}
+        engine = SamplingEngine(model, Sampler(timesteps=self.timesteps), max_atoms=40)
+        futures = {name: engine.submit(graph.clone(), None, name, seed=3) for name, graph in graphs.items()}
+        for _ in range(5):
+            engine.step()
+        assert len(engine.live) == 2 and engine.num_pending == 1
+        assert engine.cancel(futures["a"]) and engine.cancel(futures["c"]) # live and pending
+        engine.run_until_idle()
+        assert futures["a"].cancelled() and futures["c"].cancelled() and not engine.pending
+        assert torch.allclose(futures["b"].result().x, self.single(model, graphs["b"], "b", 3).x, atol=1e-6)
+        assert not engine.cancel(futures["b"]) # already finished
+
+    def test_stop_fails_unfinished_requests(self):
+        engine = SamplingEngine(AtomwiseModel(), Sampler(timesteps=self.timesteps), max_atoms=20)
+        futures = [engine.submit(make_graph(3), None, name, seed=0) for name in ["a", "b"]]
+        engine.step()
+        assert len(engine.live) == 1 and engine.num_pending == 1
+        engine.stop()
+        for future in futures:
+            with pytest.raises(SamplingCancelled):
+                future.result(timeout=1)
+        assert not engine.live and not engine.pending
+
+
+class TestComputeSchedule:
+    def test_parse_errors(self):
+        for schedule in ["0.6", "0.6:knns", "high:knns=8", "0.6:knns=eight", "0.6:depth=3", "0.6:local=none"]:
+            with pytest.raises(ValueError):
+                ComputeSchedule.parse(schedule, 100)
+
+    def test_phase_boundaries(self):
+        schedule = ComputeSchedule.parse("0.3:local=pairs;0.6:knns=8,local=skip", 100)
+        assert str(schedule) == "0.6:knns=8,local=skip;0.3:local=pairs"
+        assert schedule.at(99) == schedule.at(60) == {'knns': 8, 'local': 'skip'}
+        assert schedule.at(59) == schedule.at(30) == {'local': 'pairs'}
+        assert schedule.at(29) == schedule.at(0) == {}
+
+
+class TestFeatureCache:
+    def test_recomputed_every_n_steps(self):
+        cache = FeatureCache(every=3)
+        pos = torch.randn(10, 3)
+        assert not cache.valid(pos)
+        cache.store(pos, torch.zeros(10, 4), torch.zeros(10, 4))
+        for _ in range(2):
+            assert cache.valid(pos)
+            cache.reuse()
+        assert not cache.valid(pos) # the third step recomputes
+        stats = cache.stats()
+        assert stats["hits"] == 2 and stats["misses"] == 1 and stats["hit_rate"] == pytest.approx(2 / 3)
+
+    def test_invalidated_by_graph_and_drift(self):
+        cache = FeatureCache(every=10, drift=0.1)
+        pos = torch.randn(10, 3)
+        cache.store(pos, torch.zeros(10, 4), torch.zeros(10, 4))
+        assert cache.valid(pos + 0.01)
+        assert not cache.valid(pos * 2) # drifted
+        assert not cache.valid(torch.randn(12, 3)) # another graph
+        cache.reset()
+        assert not cache.valid(pos)
+
+    def test_reset_by_other_edges_or_sequence(self):
+        cache = FeatureCache(every=10)
+        pos, seq_x = torch.randn(10, 3), torch.randn(10, 4)
+        chain = torch.stack((torch.arange(9), torch.arange(1, 10)))
+        for graph in [(chain.flip(0), seq_x), (chain, seq_x + 1)]: # same shapes, other input
+            cache.store(pos, torch.zeros(10, 4), torch.zeros(10, 4), (chain, seq_x))
+            assert cache.valid(pos, (chain.clone(), seq_x.clone()))
+            assert not cache.valid(pos, graph)
+            assert cache.out is None
+
+
+@pytest.mark.skipif(not knn_available(), reason="torch_geometric cannot run knn")
+class TestPAMNet:
+    timesteps = 10
+    seqs = ["ACGUA", "GGC"]
+
+    def batch(self):
+        torch.manual_seed(1)
+        batch = Batch.from_data_list([make_graph(len(seq)) for seq in self.seqs])
+        batch.x[:, :3] = 3 * torch.randn(batch.num_nodes, 3)
+        return batch
+
+    def sample(self, model, **kwargs):
+        sampler = Sampler(timesteps=self.timesteps, **kwargs)
+        return sampler.sample(model, self.seqs, self.batch(), names=["a", "b"], seed=0)[-1].x
+
+    def test_session_matches_forward(self, pamnet):
+        model = pamnet()
+        batch = self.batch()
+        session = model.sampling_session(batch, self.seqs, self.timesteps)
+        pos = batch.x[:, :3].contiguous()
+        with torch.no_grad():
+            for i in [self.timesteps - 1, 4, 0]:
+                t = torch.full((batch.num_nodes,), i)
+                assert torch.allclose(session(pos, t), model(batch, self.seqs, t), atol=1e-5)
+
+    def test_reduced_compute(self, pamnet):
+        model = pamnet(n_layer=3, knns=8)
+        batch = self.batch()
+        session = model.sampling_session(batch, self.seqs, self.timesteps)
+        pos = batch.x[:, :3].contiguous()
+        t = torch.full((batch.num_nodes,), 5)
+        with torch.no_grad():
+            exact = session(pos, t)
+            for compute in [{'local': 'pairs'}, {'local': 'skip'}, {'n_layer': 1}, {'knns': 3}]:
+                session.compute = compute
+                out = session(pos, t)
+                assert out.shape == exact.shape and torch.isfinite(out).all()
+                assert not torch.allclose(out, exact), compute
+
+    def test_schedule_phases_follow_the_timesteps(self, pamnet, monkeypatch):
+        from grapharna.models import SamplingSession
+        steps = []
+        call = SamplingSession.__call__
+        def record(session, pos, t):
+            steps.append((int(t[0]), dict(session.compute)))
+            return call(session, pos, t)
+        monkeypatch.setattr(SamplingSession, "__call__", record)
+        schedule = ComputeSchedule.parse("0.7:knns=3,local=skip;0.4:local=pairs,n_layer=1", self.timesteps)
+        out = self.sample(pamnet(), compute_schedule=schedule)
+        assert torch.isfinite(out).all()
+        assert [t for t, _ in steps] == list(reversed(range(self.timesteps)))
+        for t, compute in steps:
+            if t >= 7:
+                assert compute == {'knns': 3, 'local': 'skip'}
+            elif t >= 4:
+                assert compute == {'local': 'pairs', 'n_layer': 1}
+            else:
+                assert compute == {}
+
+    def test_feature_cache_every_step_matches_exact(self, pamnet):
+        model = pamnet()
+        cache = FeatureCache(every=1)
+        assert torch.allclose(self.sample(model, feature_cache=cache), self.sample(model), atol=1e-5)
+        assert cache.stats()["hits"] == 0
+
+    def test_feature_cache_reuses_features(self, pamnet):
+        model = pamnet()
+        cache = FeatureCache(every=3)
+        out = self.sample(model, feature_cache=cache)
+        stats = cache.stats()
+        assert torch.isfinite(out).all()
+        assert stats["hits"] == 6 and stats["misses"] == 4
+        assert len(cache.errors) == 3 and stats["max_error"] > 0 # compared on every recomputation after the first
+
+
+class TestSamplingMask:
+    def test_create_mask_in_batch(self):
+        sampling_mask = SamplingMask(None)
+        sampling_mask.resids_dict = {'first': ['2-4'], 'second': ['1-2', '5']}
+        data = Batch.from_data_list([make_graph(6), make_graph(6)])
+        mask = sampling_mask.get_mask(data, ['first.pkl', 'second.pkl']).reshape(-1, 5)
+        assert torch.all(mask == mask[:, :1]) # whole residues are selected
+        assert mask[:, 0].tolist() == [False, True, True, False, False, False,
+                                       True, False, False, False, False, True]
+
+    def test_residues_without_p(self):
+        sampling_mask = SamplingMask(None)
+        sampling_mask.resids_dict = {'first': ['2-4'], 'second': ['3']}
+        graphs = [make_graph(6, without_p=[0]), make_graph(4, without_p=[0, 2])]
+        mask = sampling_mask.get_mask(Batch.from_data_list(graphs), ['first.pkl', 'second.pkl'])
+        assert mask.nonzero().view(-1).tolist() == list(range(4, 14)) + list(range(29 + 13, 29 + 18))
+
+    def test_invalid_layout(self):
+        graph = make_graph(2)
+        graph.x[1, 3:7] = torch.tensor([0., 0., 0., 1.]) # C4' typed as P
+        with pytest.raises(ValueError):
+            SamplingMask(None).create_mask(Batch.from_data_list([graph]), [(0, 0, 1)])
+
+
+class TestInpainting:
+    timesteps = 20
+
+    def make_chain(self, num_residues):
+        # residues placed 1 unit apart along the x axis
+        graph = make_graph(num_residues)
+        graph.x[:, 0] = torch.arange(graph.x.size(0)).float() // 5
+        return Batch.from_data_list([graph])
+
+    def test_subgraph_selection(self):
+        data = self.make_chain(20)
+        mask = torch.zeros(data.x.size(0), dtype=torch.bool)
+        mask[5 * 10:5 * 12] = True # residues 10 and 11
+        sub_index, resampled = Sampler(timesteps=self.timesteps).inpainting_subgraph(data, mask, cutoff=2.0)
+        residues = (sub_index // 5).unique().tolist()
+        assert residues == [8, 9, 10, 11, 12, 13]
+        assert torch.equal(sub_index[resampled], mask.nonzero().view(-1))
+
+    def test_subgraph_without_p(self):
+        graph = make_graph(6, without_p=[0])
+        graph.x[:, 0] = 100. # far apart, only the sequence neighbours are selected
+        graph.x[9:14, 0] = 0.
+        data = Batch.from_data_list([graph, make_graph(2)])
+        mask = torch.zeros(data.x.size(0), dtype=torch.bool)
+        mask[9:14] = True # residue 2
+        sub_index, resampled = Sampler(timesteps=self.timesteps).inpainting_subgraph(data, mask, cutoff=2.0)
+        assert sub_index.tolist() == list(range(4, 19))
+
+    def test_fixed_atoms_keep_template(self):
+        torch.manual_seed(0)
+        data = self.make_chain(20)
+        template = data.x.clone()
+        mask = torch.zeros(data.x.size(0), dtype=torch.bool)
+        mask[5 * 10:5 * 12] = True
+        out = Sampler(timesteps=self.timesteps).inpaint(AtomwiseModel(), None, data, mask, cutoff=2.0, names=["a"], seed=0)[-1]
+        assert torch.equal(out.x[~mask], template[~mask])
+        assert not torch.allclose(out.x[mask, :3], template[mask, :3])
@@ -0,0 +1,659 @@
+import gzip
+import json
+import os
+import threading
+import time
+import pytest
+from concurrent.futures import CancelledError
+from grapharna.service import Job, WorkerPool, Zygote, Scheduler, JobRecord, QueueFull, JobTooLarge
+from grapharna.service.cache import ResultCache
+from grapharna.service.metrics import Histogram, Metrics
+from grapharna.service.results import ResultBuffer
+from grapharna.service.spool import Spool, SpoolExecutor, SpoolWorker
+from grapharna.service.postprocess import Annotator
+from grapharna.service.store import JobStore
+from grapharna.service.worker import Progress
+from grapharna.service.policy import CostModel, MemoryModel, ShortestJobFirst
+
+
+class EchoRunner:
+    """
+    Stand-in for SamplingRunner: writes the seed to the output PDB, fails for negative seeds
+    and sleeps for seeds above 100 (until it is cancelled, except for seeds above 200).
+    """
+    def load(self):
+        self.pid = os.getpid()
+
+    def share(self):
+        pass
+
+    def __call__(self, job):
+        if job.seed < 0:
+            raise ValueError("negative seed")
+        if getattr(self, "send_progress", None) is not None:
+            self.send_progress(job.id, {"step": 1, "total": 2, "eta": 0.5})
+        if job.seed > 100:
+            deadline = time.time() + 60
+            while time.time() < deadline:
+                token = getattr(self, "cancel_token", None)
+                if job.seed <= 200 and token is not None and token.cancelled:
+                    raise RuntimeError("cancelled")
+                time.sleep(0.05)
+        with open(job.pdb_path, "w") as f:
+            f.write(str(job.seed))
+        return {"pid": os.getpid(), "loaded_in": self.pid}
+
+    def run_batch(self, jobs):
+        results = {job.id: self(job) for job in jobs}
+        for result in results.values():
+            result["batch"] = sorted(job.seed for job in jobs)
+        return results
+
+
+class ChattyRunner(EchoRunner):
+    """
+    EchoRunner that keeps sending large progress reports for seeds above 100, until it is killed.
+    """
+    def __call__(self, job):
+        while job.seed > 100:
+            self.send_progress(job.id, {"step": 1, "total": 2, "eta": 0.5, "log": "x" * 100000})
+        return super().__call__(job)
+
+
+class TestWorkerPool:
+    def test_jobs_reuse_workers(self, tmp_path):
+        pool = WorkerPool(EchoRunner(), num_workers=2, context='fork').start()
+        try:
+            jobs = [Job("a", seed, "a.dotseq", str(tmp_path)) for seed in range(6)]
+            results = [f.result(timeout=30) for f in [pool.submit(job) for job in jobs]]
+        finally:
+            pool.shutdown()
+        for job in jobs:
+            with open(job.pdb_path) as f:
+                assert f.read() == str(job.seed)
+        assert len({r["pid"] for r in results}) <= 2
+        assert all(r["pid"] == r["loaded_in"] for r in results)
+
+    def test_failed_job(self, tmp_path):
+        pool = WorkerPool(EchoRunner(), num_workers=1, context='fork').start()
+        try:
+            with pytest.raises(RuntimeError, match="negative seed"):
+                pool.submit(Job("a", -1, "a.dotseq", str(tmp_path))).result(timeout=30)
+            assert pool.submit(Job("a", 1, "a.dotseq", str(tmp_path))).result(timeout=30)
+        finally:
+            pool.shutdown()
+
+    def test_cancel_running_job_keeps_worker(self, tmp_path):
+        pool = WorkerPool(EchoRunner(), num_workers=1, context='fork').start()
+        try:
+            slow = pool.submit(Job("a", 101, "a.dotseq", str(tmp_path)))
+            queued = pool.submit(Job("a", 1, "a.dotseq", str(tmp_path)))
+            while pool.num_running == 0:
+                time.sleep(0.05)
+            pid = next(iter(pool.workers.values())).process.pid
+            assert pool.cancel("a_101")
+            with pytest.raises(CancelledError):
+                slow.result(timeout=1)
+            assert queued.result(timeout=30)["pid"] == pid
+        finally:
+            pool.shutdown()
+
+    def test_job_that_does_not_stop_replaces_worker(self, tmp_path):
+        pool = WorkerPool(EchoRunner(), num_workers=1, context='fork', cancel_grace=0.5).start()
+        try:
+            pool.submit(Job("a", 201, "a.dotseq", str(tmp_path)))
+            queued = pool.submit(Job("a", 1, "a.dotseq", str(tmp_path)))
+            while pool.num_running == 0:
+                time.sleep(0.05)
+            pid = next(iter(pool.workers.values())).process.pid
+            assert pool.cancel("a_201")
+            assert queued.result(timeout=30)["pid"] != pid
+        finally:
+            pool.shutdown()
+
+
+class TestMicroBatching:
+    def test_jobs_in_window_are_batched(self, tmp_path):
+        pool = WorkerPool(EchoRunner(), num_workers=1, context='fork', batch_size=3, batch_window=0.5).start()
+        try:
+            while not all(w.ready for w in pool.workers.values()):
+                time.sleep(0.05)
+            futures = [pool.submit(Job("a", seed, "a.dotseq", str(tmp_path))) for seed in range(4)]
+            results = [f.result(timeout=30) for f in futures]
+        finally:
+            pool.shutdown()
+        assert [r.get("batch") for r in results] == [[0, 1, 2]] * 3 + [None] # the last job ran alone
+        assert all(os.path.exists(job.pdb_path) for job in [Job("a", seed, "a.dotseq", str(tmp_path)) for seed in range(4)])
+
+    def test_cancel_requeues_batch(self, tmp_path):
+        pool = WorkerPool(EchoRunner(), num_workers=1, context='fork', batch_size=2, batch_window=5).start()
+        try:
+            while not all(w.ready for w in pool.workers.values()):
+                time.sleep(0.05)
+            other = pool.submit(Job("a", 1, "a.dotseq", str(tmp_path)))
+            pool.submit(Job("a", 101, "a.dotseq", str(tmp_path)))
+            while pool.num_running < 2:
+                time.sleep(0.05)
+            assert pool.cancel("a_101")
+            # sampled again, alone
+            assert other.result(timeout=30).get("batch") is None
+        finally:
+            pool.shutdown()
+
+    def test_atom_budget(self, tmp_path):
+        pool = WorkerPool(EchoRunner(), num_workers=1, context='fork', batch_size=4, max_batch_atoms=500, batch_window=30)
+        sizes = [40, 40, 30, 5]
+        jobs = [Job(f"j{i}", i, write_dotseq(tmp_path / f"j{i}.dotseq", n), str(tmp_path)) for i, n in enumerate(sizes)]
+        for job in jobs:
+            pool.pending.append(job)
+            pool.submitted[job.id] = time.monotonic()
+        # 200 + 200 atoms fit, the third job does not: the batch is full and does not wait for the window
+        assert pool.next_batch() == jobs[:2]
+        # the remaining jobs wait for more
+        assert pool.next_batch() == []
+
+
+class TestSpool:
+    def test_claim_and_requeue_expired(self, tmp_path):
+        spool = Spool(str(tmp_path / "spool"), lease=0.2, max_attempts=2)
+        spool.put(Job("a", 1, "a.dotseq", str(tmp_path)))
+        claim, job = spool.claim("host1")
+        assert job.id == "a_1" and spool.claim("host2") is None
+        assert spool.heartbeat(claim)
+        time.sleep(0.3)
+        assert spool.requeue_expired() == 1 and not spool.heartbeat(claim) # the lease of host1 is lost
+        spool.finish(claim, job.id, result={}) # ignored, the job is sampled again
+        claim, job = spool.claim("host2")
+        time.sleep(0.3)
+        assert spool.requeue_expired() == 0 # the last attempt failed
+        assert spool.results() == [("a_1", None, "The job was abandoned by 2 workers")]
+
+    def test_claim_job_older_than_lease(self, tmp_path, monkeypatch):
+        spool = Spool(str(tmp_path / "spool"), lease=0.2)
+        name = spool.put(Job("a", 1, "a.dotseq", str(tmp_path)))
+        old = time.time() - 10 # waited in pending/ longer than the lease
+        os.utime(spool.path("pending", name), (old, old))
+        rename = os.rename
+
+        def rename_and_requeue(source, target):
+            # another host requeues the expired claims right after the rename
+            rename(source, target)
+            if os.path.dirname(target) == spool.path("claimed"):
+                spool.requeue_expired()
+
+        monkeypatch.setattr(os, "rename", rename_and_requeue)
+        claim, job = spool.claim("host1")
+        assert job.id == "a_1" and spool.heartbeat(claim) and spool.claim("host2") is None
+
+    def test_cancel_marker_of_finished_job(self, tmp_path):
+        spool = Spool(str(tmp_path / "spool"))
+        job = Job("a", 1, "a.dotseq", str(tmp_path))
+        spool.put(job)
+        claim, _ = spool.claim("host1")
+        spool.finish(claim, job.id, result={})
+        spool.cancel(job.id) # cancelled after it finished, before its result was collected
+        assert spool.results() == [("a_1", {}, None)] and not spool.cancelled(job.id)
+        spool.cancel(job.id)
+        spool.put(job) # resubmitted
+        assert not spool.cancelled(job.id)
+
+    def test_jobs_pulled_by_workers(self, tmp_path):
+        spool = Spool(str(tmp_path / "spool"))
+        executor = SpoolExecutor(spool, capacity=4, interval=0.05).start()
+        pools = [WorkerPool(EchoRunner(), num_workers=1, context='fork').start() for _ in range(2)]
+        workers = [SpoolWorker(spool, pool, owner=f"host{i}", interval=0.05) for i, pool in enumerate(pools)]
+        threads = [threading.Thread(target=worker.run, daemon=True) for worker in workers]
+        for thread in threads:
+            thread.start()
+        try:
+            futures = [executor.submit(Job("a", seed, "a.dotseq", str(tmp_path))) for seed in range(4)]
+            slow = executor.submit(Job("slow", 101, "a.dotseq", str(tmp_path)))
+            assert all(f.result(timeout=30)["pid"] for f in futures)
+            while not os.listdir(tmp_path / "spool" / "claimed"):
+                time.sleep(0.05)
+            assert executor.cancel("slow_101")
+            # the worker stops the job and reports it
+            deadline = time.time() + 30
+            while executor.num_running and time.time() < deadline:
+                time.sleep(0.05)
+            assert executor.num_running == 0 and slow.cancelled()
+        finally:
+            for worker in workers:
+                worker.stop()
+            for pool in pools:
+                pool.shutdown()
+            executor.shutdown()
+
+
+class TestZygote:
+    def test_job_per_forked_process(self, tmp_path):
+        zygote = Zygote(EchoRunner(), max_jobs=2, context='fork').start()
+        try:
+            jobs = [Job("a", seed, "a.dotseq", str(tmp_path)) for seed in range(4)]
+            results = [f.result(timeout=30) for f in [zygote.submit(job) for job in jobs]]
+            with pytest.raises(RuntimeError, match="negative seed"):
+                zygote.submit(Job("a", -1, "a.dotseq", str(tmp_path))).result(timeout=30)
+        finally:
+            zygote.shutdown()
+        assert len({r["pid"] for r in results}) == 4
+        assert len({r["loaded_in"] for r in results}) == 1 # the model is loaded once, in the zygote
+        assert all(r["pid"] != r["loaded_in"] for r in results)
+
+    def test_cancel_running_job(self, tmp_path):
+        zygote = Zygote(EchoRunner(), max_jobs=1, context='fork').start()
+        try:
+            slow = zygote.submit(Job("a", 101, "a.dotseq", str(tmp_path)))
+            queued = zygote.submit(Job("a", 1, "a.dotseq", str(tmp_path)))
+            while zygote.children.get("a_101") is None:
+                time.sleep(0.05)
+            assert zygote.cancel("a_101")
+            with pytest.raises(CancelledError):
+                slow.result(timeout=1)
+            assert queued.result(timeout=30)
+        finally:
+            zygote.shutdown()
+
+
+    def test_cancel_child_while_sending_progress(self, tmp_path):
+        zygote = Zygote(ChattyRunner(), max_jobs=1, context='fork').start()
+        try:
+            for round in range(3):
+                chatty = zygote.submit(Job("chatty", 101 + round, "a.dotseq", str(tmp_path)))
+                while zygote.children.get(f"chatty_{101 + round}") is None:
+                    time.sleep(0.01)
+                time.sleep(0.1)
+                assert zygote.cancel(f"chatty_{101 + round}")
+                with pytest.raises(CancelledError):
+                    chatty.result(timeout=1)
+                # the child was killed in the middle of a message, the other jobs still report their results
+                assert zygote.submit(Job("a", round, "a.dotseq", str(tmp_path))).result(timeout=30)
+        finally:
+            zygote.shutdown()
+
+def write_json(record):
+    with open(record.job.json_path, "w") as f:
+        f.write("{}")
+
+
+class TestScheduler:
+    def make_scheduler(self, **kwargs):
+        pool = WorkerPool(EchoRunner(), num_workers=1, context='fork').start()
+        return pool, Scheduler(pool, arena=lambda record: None, annotate=write_json, **kwargs)
+
+    def test_bounded_queue(self, tmp_path):
+        pool, scheduler = self.make_scheduler(max_queue=2, max_sampling=1)
+        try:
+            running = scheduler.submit(Job("slow", 101, "a.dotseq", str(tmp_path)))
+            queued = [scheduler.submit(Job("a", seed, "a.dotseq", str(tmp_path))) for seed in range(2)]
+            with pytest.raises(QueueFull):
+                scheduler.submit(Job("a", 2, "a.dotseq", str(tmp_path)))
+            assert running.state == "SAMPLING"
+            assert [scheduler.position(r.job.id) for r in queued] == [1, 2]
+            assert scheduler.submit(Job("a", 1, "a.dotseq", str(tmp_path))) is queued[1] # already queued
+
+            assert scheduler.cancel("slow") == [running]
+            for record in queued:
+                assert record.done.wait(30)
+                assert record.state == "COMPLETED"
+                assert os.path.exists(record.job.json_path)
+            assert running.done.wait(30)
+            with open(running.job.error_path) as f:
+                assert "cancelled" in f.read()
+        finally:
+            scheduler.shutdown()
+            pool.shutdown()
+
+    def test_cancel_queued_job(self, tmp_path):
+        pool, scheduler = self.make_scheduler(max_sampling=1)
+        try:
+            running = scheduler.submit(Job("slow", 101, "a.dotseq", str(tmp_path)))
+            queued = scheduler.submit(Job("b", 1, "a.dotseq", str(tmp_path)))
+            assert scheduler.cancel("b") == [queued]
+            assert queued.state == "CANCELLED" and scheduler.queue_depth == 0
+            scheduler.cancel("slow")
+            assert running.done.wait(30)
+        finally:
+            scheduler.shutdown()
+            pool.shutdown()
+
+
+    def test_dispatch_jobs_that_fail_at_once(self, tmp_path):
+        pool = WorkerPool(EchoRunner(), num_workers=1, context='fork') # not started
+        pool.error = "no GPU"
+        scheduler = Scheduler(pool, max_queue=1000, max_sampling=0, arena=lambda record: None, annotate=write_json)
+        records = [scheduler.submit(Job("a", seed, "a.dotseq", str(tmp_path))) for seed in range(600)]
+        with scheduler.lock:
+            scheduler.lanes[0].max_sampling = 1
+            scheduler.dispatch() # the callbacks of the failed futures do not recurse once per job
+        assert all(record.state == "FAILED" for record in records)
+        scheduler.shutdown()
+
+    def test_estimated_once(self, tmp_path):
+        calls = []
+
+        class CountingCostModel(CostModel):
+            def estimate(self, num_residues):
+                calls.append(num_residues)
+                return super().estimate(num_residues)
+
+        pool, scheduler = self.make_scheduler(cost_model=CountingCostModel(), memory_model=MemoryModel())
+        try:
+            record = scheduler.submit(Job("a", 1, write_dotseq(tmp_path / "a.dotseq", 30), str(tmp_path)))
+            assert record.done.wait(30) and calls == [30]
+        finally:
+            scheduler.shutdown()
+            pool.shutdown()
+
+class TestProgress:
+    def test_events_of_a_job(self, tmp_path):
+        pool, scheduler = TestScheduler().make_scheduler()
+        events = []
+        try:
+            job = Job("a", 1, "a.dotseq", str(tmp_path))
+            scheduler.subscribe(job.id, lambda record: events.append((record.state, record.progress)))
+            record = scheduler.submit(job)
+            assert record.done.wait(30)
+        finally:
+            scheduler.shutdown()
+            pool.shutdown()
+        states = [state for state, _ in events]
+        assert states[:2] == ["QUEUED", "SAMPLING"] and states[-1] == "COMPLETED"
+        assert ("SAMPLING", {"step": 1, "total": 2, "eta": 0.5}) in events
+        assert states.index("ARENA") < states.index("ANNOTATING")
+
+    def test_sampler_progress(self):
+        steps = []
+        progress = Progress(lambda job_id, payload: steps.append(payload["step"]), ["a"], interval=3600)
+        for done in range(1, 6):
+            progress(done, 5)
+        assert steps == [1, 5] # throttled, except the first and the last step
+
+
+class TestPipeline:
+    def test_sampling_continues_while_arena_runs(self, tmp_path):
+        release = threading.Event()
+        pool = WorkerPool(EchoRunner(), num_workers=1, context='fork').start()
+        scheduler = Scheduler(pool, max_arena=1, arena=lambda record: release.wait(30), annotate=write_json)
+        try:
+            records = [scheduler.submit(Job("a", seed, "a.dotseq", str(tmp_path))) for seed in range(3)]
+            # the single worker samples all the jobs while the first one blocks Arena
+            deadline = time.time() + 30
+            while scheduler.stages[0].waiting < 2 and time.time() < deadline:
+                time.sleep(0.05)
+            assert scheduler.stages[0].running == 1 and scheduler.stages[0].waiting == 2
+            assert all(r.state == "ARENA" for r in records) and scheduler.num_sampling == 0
+            # a job waiting for its stage is cancelled at once
+            assert scheduler.cancel("a") == records
+            release.set()
+            for record in records:
+                assert record.done.wait(30) and record.state == "CANCELLED"
+            assert scheduler.stages[0].waiting == 0
+        finally:
+            release.set()
+            scheduler.shutdown()
+            pool.shutdown()
+
+
+class TestMetrics:
+    def test_histogram(self):
+        histogram = Histogram([1, 10])
+        for value in [0.5, 2, 50]:
+            histogram.observe(value)
+        assert histogram.render("t", {"stage": "ARENA"}) == [
+            't_bucket{stage="ARENA",le="1"} 1',
+            't_bucket{stage="ARENA",le="10"} 2',
+            't_bucket{stage="ARENA",le="+Inf"} 3',
+            't_sum{stage="ARENA"} 52.5',
+            't_count{stage="ARENA"} 3',
+        ]
+
+    def test_job_metrics(self, tmp_path):
+        pool, scheduler = TestScheduler().make_scheduler(metrics=Metrics())
+        try:
+            record = scheduler.submit(Job("a", 1, "a.dotseq", str(tmp_path)))
+            assert record.done.wait(30) and record.state == "COMPLETED"
+            text = scheduler.metrics.render(scheduler)
+        finally:
+            scheduler.shutdown()
+            pool.shutdown()
+        with open(record.job.json_path) as f:
+            metrics = json.load(f)["metrics"]
+        assert metrics["peak_rss_bytes"] > 0 and metrics["cpu_seconds"] >= 0
+        assert set(metrics["stage_seconds"]) == {"QUEUED", "SAMPLING", "ARENA", "ANNOTATING"}
+        assert 'grapharna_queue_depth{lane="default"} 0' in text
+        assert 'grapharna_jobs_finished_total{state="COMPLETED"} 1' in text
+        assert 'grapharna_stage_seconds_count{stage="SAMPLING"} 1' in text
+        assert "grapharna_job_peak_rss_bytes_count 1" in text
+
+
+    def test_cache_hit_reports_own_metrics(self, tmp_path):
+        pool = WorkerPool(EchoRunner(), num_workers=1, context='fork').start()
+        scheduler = Scheduler(pool, arena=lambda record: None, annotate=write_json,
+                              cache=ResultCache(str(tmp_path / "cache")), metrics=Metrics())
+        dotseq = write_dotseq(tmp_path / "in.dotseq", 20)
+        try:
+            first = scheduler.submit(Job("a", 1, dotseq, str(tmp_path)))
+            assert first.done.wait(30) and first.state == "COMPLETED"
+            cached = scheduler.submit(Job("b", 1, dotseq, str(tmp_path)))
+            assert cached.cached and cached.state == "COMPLETED"
+        finally:
+            scheduler.shutdown()
+            pool.shutdown()
+        with open(cached.job.json_path) as f:
+            metrics = json.load(f)["metrics"]
+        # the cached job was not sampled, it does not report the time and resources of the first one
+        assert "SAMPLING" not in metrics["stage_seconds"] and "peak_rss_bytes" not in metrics
+
+class TestResultDelivery:
+    def test_results_packed_and_archived(self, tmp_path):
+        archive = tmp_path / "archive"
+        results = ResultBuffer()
+        pool, scheduler = TestScheduler().make_scheduler(results=results, archive_dir=str(archive))
+        try:
+            record = scheduler.submit(Job("a", 7, "a.dotseq", str(tmp_path)))
+            assert record.done.wait(30) and record.state == "COMPLETED"
+        finally:
+            scheduler.shutdown()
+            pool.shutdown()
+        assert json.loads(gzip.decompress(results.get("a_7"))) == {"pdb": "7", "json": {}}
+        assert sorted(os.listdir(archive)) == ["a_7.json", "a_7.pdb"]
+
+    def test_buffer_drops_oldest(self):
+        results = ResultBuffer(max_bytes=10)
+        for job_id in ["a", "b", "c"]:
+            results.put(job_id, b"12345")
+        assert results.get("a") is None and results.get("c") == b"12345"
+        assert results.stats() == {"entries": 2, "bytes": 10}
+
+
+def write_dotseq(path, length):
+    with open(path, "w") as f:
+        f.write(f">rna\n{'A' * length}\n{'.' * length}\n")
+    return str(path)
+
+
+class TestShortestJobFirst:
+    def test_cost_model_fit(self):
+        model = CostModel(min_samples=3)
+        for n in [20, 50, 100, 400]:
+            model.observe(n, 0.5 * n ** 2)
+        assert abs(model.b - 2) < 1e-6
+        assert abs(model.estimate(200) - 0.5 * 200 ** 2) < 1e-3
+
+    def test_order_and_aging(self):
+        queue = ShortestJobFirst(aging=1.0)
+        records = []
+        for estimate, waited in [(1000, 0), (10, 0), (100, 0), (2000, 1500)]:
+            record = JobRecord(Job("a", len(records), "a.dotseq", "."))
+            record.estimate = estimate
+            record.submitted -= waited
+            records.append(record)
+            queue.push(record)
+        # the oldest job gained 1500 s of priority and overtakes the 1000 s one
+        assert [r.estimate for r in queue.ordered()] == [10, 100, 2000, 1000]
+        assert queue.pop() is records[1]
+
+    def test_large_job_lane(self, tmp_path):
+        pool = WorkerPool(EchoRunner(), num_workers=2, context='fork').start()
+        scheduler = Scheduler(pool, arena=lambda record: None, annotate=write_json, queue=ShortestJobFirst(),
+                              cost_model=CostModel(a=1., b=1.), large_job_seconds=500)
+        try:
+            large = [scheduler.submit(Job(f"large{i}", 101, write_dotseq(tmp_path / f"large{i}.dotseq", 1000), str(tmp_path)))
+                     for i in range(2)]
+            small = scheduler.submit(Job("small", 1, write_dotseq(tmp_path / "small.dotseq", 50), str(tmp_path)))
+            # one worker is reserved for the small jobs
+            assert [r.state for r in large] == ["SAMPLING", "QUEUED"]
+            assert small.done.wait(30) and small.state == "COMPLETED"
+            assert large[1].lane.name == "large" and small.lane.name == "default"
+        finally:
+            for i in range(2):
+                scheduler.cancel(f"large{i}")
+            scheduler.shutdown()
+            pool.shutdown()
+
+
+class TestAdmission:
+    def test_memory_model_fit(self):
+        model = MemoryModel(min_samples=3)
+        for n in [20, 50, 100, 400]:
+            model.observe(n, 2e9 + 1e6 * n + 100 * n ** 2)
+        assert abs(model.estimate(1000) - (2e9 + 1e9 + 1e8)) < 1e3
+        # an ensemble of 4 holds the graphs of 4000 residues
+        assert MemoryModel(base=0., linear=1., quadratic=1., copies=4).estimate(1000) == 4000 + 4000 ** 2
+
+    def test_reject_and_route_by_memory(self, tmp_path):
+        pool = WorkerPool(EchoRunner(), num_workers=2, context='fork').start()
+        scheduler = Scheduler(pool, arena=lambda record: None, annotate=write_json,
+                              memory_model=MemoryModel(base=0., linear=0., quadratic=1.),
+                              max_job_bytes=1000 ** 2, large_job_bytes=100 ** 2)
+        try:
+            with pytest.raises(JobTooLarge):
+                scheduler.submit(Job("huge", 1, write_dotseq(tmp_path / "huge.dotseq", 2000), str(tmp_path)))
+            assert scheduler.get("huge_1") is None
+            plan = scheduler.plan(Job("large", 1, write_dotseq(tmp_path / "large.dotseq", 500), str(tmp_path)))
+            assert plan["estimated_memory_bytes"] == 500 ** 2 and plan["lane"] == "large" and plan["admitted"]
+            small = scheduler.submit(Job("small", 1, write_dotseq(tmp_path / "small.dotseq", 50), str(tmp_path)))
+            assert small.lane.name == "default" and small.done.wait(30) and small.state == "COMPLETED"
+        finally:
+            scheduler.shutdown()
+            pool.shutdown()
+
+
+class TestResultCache:
+    def test_lru_eviction(self, tmp_path):
+        cache = ResultCache(str(tmp_path / "cache"), max_bytes=25)
+        jobs = [Job(f"j{i}", 1, write_dotseq(tmp_path / f"j{i}.dotseq", 10 + i), str(tmp_path)) for i in range(3)]
+        for job in jobs:
+            for path in [job.pdb_path, job.json_path]:
+                with open(path, "w") as f:
+                    f.write("x" * 5)
+        for job in jobs[:2]:
+            cache.store(cache.key(job), job)
+        assert cache.fetch(cache.key(jobs[0]), jobs[0]) # jobs[1] is now the least recently used
+        cache.store(cache.key(jobs[2]), jobs[2])
+        assert not cache.fetch(cache.key(jobs[1]), jobs[1])
+        assert cache.stats()["entries"] == 2 and cache.stats()["hit_rate"] == 0.5
+        # the entries survive a restart
+        assert ResultCache(str(tmp_path / "cache"), max_bytes=25).stats()["entries"] == 2
+
+    def test_key_ignores_name_and_whitespace(self, tmp_path):
+        cache = ResultCache(str(tmp_path / "cache"))
+        with open(tmp_path / "b.dotseq", "w") as f:
+            f.write(">other\n aaaa \n....\n")
+        a = Job("a", 1, write_dotseq(tmp_path / "a.dotseq", 4), str(tmp_path))
+        assert cache.key(a) == cache.key(Job("b", 1, str(tmp_path / "b.dotseq"), str(tmp_path)))
+        assert cache.key(a) != cache.key(Job("a", 2, a.input_path, str(tmp_path)))
+
+    def test_scheduler_serves_cached_and_inflight_results(self, tmp_path):
+        pool = WorkerPool(EchoRunner(), num_workers=1, context='fork').start()
+        scheduler = Scheduler(pool, arena=lambda record: None, annotate=write_json, cache=ResultCache(str(tmp_path / "cache")))
+        dotseq = write_dotseq(tmp_path / "in.dotseq", 20)
+        try:
+            first = scheduler.submit(Job("a", 1, dotseq, str(tmp_path)))
+            assert first.done.wait(30) and first.state == "COMPLETED"
+            cached = scheduler.submit(Job("b", 1, dotseq, str(tmp_path)))
+            assert cached.cached and cached.state == "COMPLETED"
+            with open(cached.job.pdb_path) as f:
+                assert f.read() == "1"
+
+            leader = scheduler.submit(Job("c", 101, dotseq, str(tmp_path)))
+            follower = scheduler.submit(Job("d", 101, dotseq, str(tmp_path)))
+            assert follower.leader is leader and follower.state == "SAMPLING"
+            assert scheduler.deduplicated == 1
+            # cancelling the leader does not cancel the identical job of another user
+            scheduler.cancel("c")
+            assert follower.leader is None and follower.active
+            assert leader.done.wait(30) and leader.state == "CANCELLED"
+        finally:
+            scheduler.cancel("d")
+            scheduler.shutdown()
+            pool.shutdown()
+
+
+class TestJobStore:
+    def test_transitions_and_timings(self, tmp_path):
+        store = JobStore(str(tmp_path / "jobs.sqlite"))
+        record = JobRecord(Job("a", 1, "a.dotseq", str(tmp_path)))
+        for state in ["QUEUED", "SAMPLING", "COMPLETED"]:
+            record.state = state
+            store.update(record)
+        assert store.get("a_1")["state"] == "COMPLETED"
+        assert set(store.timings("a_1")) == {"QUEUED", "SAMPLING"}
+        assert store.unfinished(["QUEUED", "SAMPLING"]) == []
+        assert store.prune(0, ["COMPLETED"]) == 1 and store.get("a_1") is None
+
+    def test_recover_interrupted_jobs(self, tmp_path):
+        path = str(tmp_path / "jobs.sqlite")
+        dotseq = write_dotseq(tmp_path / "in.dotseq", 10)
+        # the state left by a service that stopped while sampling one job and reconstructing another
+        store = JobStore(path)
+        for seed, state in [(1, "SAMPLING"), (2, "ARENA")]:
+            record = JobRecord(Job("a", seed, dotseq, str(tmp_path)))
+            record.state = state
+            store.update(record)
+        store.close()
+        with open(tmp_path / "a_2.pdb", "w") as f:
+            f.write("sampled before the restart")
+
+        pool = WorkerPool(EchoRunner(), num_workers=1, context='fork').start()
+        scheduler = Scheduler(pool, arena=lambda record: None, annotate=write_json, store=JobStore(path))
+        try:
+            assert scheduler.recover() == 2
+            for seed in [1, 2]:
+                record = scheduler.get(f"a_{seed}")
+                assert record.done.wait(30) and record.state == "COMPLETED"
+        finally:
+            scheduler.shutdown()
+            pool.shutdown()
+        with open(tmp_path / "a_2.pdb") as f:
+            assert f.read() == "sampled before the restart" # not sampled again
+        with open(tmp_path / "a_1.pdb") as f:
+            assert f.read() == "1"
+        assert scheduler.store.get("a_1")["state"] == "COMPLETED"
+
+
+MINI_PDB = """\
+ATOM      1  P     G A   1       0.000   0.000   0.000  1.00  0.00           P
+ATOM      2  C4'   G A   1       1.500   0.000   0.000  1.00  0.00           C
+ATOM      3  N9    G A   1       3.000   0.500   0.000  1.00  0.00           N
+ATOM      4  P     C A   2       6.000   0.000   0.000  1.00  0.00           P
+ATOM      5  C4'   C A   2       7.500   0.000   0.000  1.00  0.00           C
+ATOM      6  N1    C A   2       9.000   0.500   0.000  1.00  0.00           N
+END
+"""
+
+
+class TestAnnotator:
+    def test_annotation_in_process_pool(self, tmp_path):
+        annotator = Annotator(workers=1, context='fork')
+        try:
+            record = JobRecord(Job("a", 1, "a.dotseq", str(tmp_path)))
+            with open(record.job.pdb_path, "w") as f:
+                f.write(MINI_PDB)
+            annotator(record)
+            with open(record.job.json_path) as f:
+                assert "extendedDotBracket" in json.load(f)
+            with pytest.raises(RuntimeError, match="Annotator failed"):
+                annotator(JobRecord(Job("missing", 1, "a.dotseq", str(tmp_path))))
+        finally:
+            annotator.shutdown()
@@ -0,0 +1,99 @@
+"""
+Microbenchmark of the per-step overhead of the sampler outside of the model call.
+The model is replaced with a session returning a precomputed output, so the timings only
+include the diffusion update (coefficients lookup, noise, masking and copies).
+
+python tools/benchmark_sampler_step.py --atoms 500 2500 10000 --device cuda
+"""
+import argparse
+import time
+import torch
+
+from grapharna.utils import Sampler
+from grapharna.utils.sampler import StepBuffers
+
+
+class NullSession:
+    def __init__(self, num_atoms, device):
+        self.out = torch.randn((num_atoms, 15), device=device)
+
+    def __call__(self, pos, t):
+        return self.out
+
+
+def legacy_extract(a, t, x_shape):
+    batch_size = t.shape[0]
+    out = a.gather(-1, t.cpu())
+    return out.reshape(batch_size, *((1,) * (len(x_shape) - 1))).to(t.device)
+
+
+def legacy_step(sampler, session, x_raw, t, t_index, coord_mask, atoms_mask):
+    # Sampler.p_sample before the coefficient tables were moved to the device
+    x = x_raw * coord_mask
+    betas_t = legacy_extract(sampler.betas, t, x.shape)
+    sqrt_one_minus_alphas_cumprod_t = legacy_extract(sampler.sqrt_one_minus_alphas_cumprod, t, x.shape)
+    sqrt_recip_alphas_t = legacy_extract(sampler.sqrt_recip_alphas, t, x.shape)
+    model_mean = sqrt_recip_alphas_t * (
+        x - betas_t * session(x_raw[:, :3].contiguous(), t) * coord_mask / sqrt_one_minus_alphas_cumprod_t
+    )
+    if t_index == 0:
+        return model_mean * coord_mask + x_raw * atoms_mask
+    posterior_variance_t = legacy_extract(sampler.posterior_variance, t, x.shape)
+    noise = torch.randn_like(x)
+    out = model_mean + torch.sqrt(posterior_variance_t) * noise
+    return out * coord_mask + x_raw * atoms_mask
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def bench_legacy(sampler, num_atoms, steps, device):
+    session = NullSession(num_atoms, device)
+    x_raw = torch.rand((num_atoms, 15), device=device)
+    coord_mask = torch.ones_like(x_raw)
+    coord_mask[:, 3:] = 0
+    atoms_mask = 1 - coord_mask
+    synchronize(device)
+    start = time.perf_counter()
+    for i in reversed(range(steps)):
+        t = torch.full((num_atoms,), i, device=device, dtype=torch.long)
+        x_raw = legacy_step(sampler, session, x_raw, t, i, coord_mask, atoms_mask)
+    synchronize(device)
+    return (time.perf_counter() - start) / steps
+
+
+def bench_in_place(sampler, num_atoms, steps, device):
+    sampler.to(device)
+    session = NullSession(num_atoms, device)
+    pos = torch.rand((num_atoms, 3), device=device)
+    t = torch.empty(num_atoms, device=device, dtype=torch.long)
+    buffers = StepBuffers(num_atoms, device)
+    synchronize(device)
+    start = time.perf_counter()
+    for i in reversed(range(steps)):
+        t.fill_(i)
+        sampler.p_sample(session, pos, t, buffers)
+    synchronize(device)
+    return (time.perf_counter() - start) / steps
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--atoms', type=int, nargs='+', default=[500, 2500, 10000], help='Number of atoms in the batch')
+    parser.add_argument('--steps', type=int, default=1000, help='Number of timesteps to run')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    print(f"Device: {device}, steps: {args.steps}")
+    print(f"{'atoms':>8} {'legacy [us/step]':>18} {'in-place [us/step]':>20} {'speedup':>8}")
+    for num_atoms in args.atoms:
+        legacy = bench_legacy(Sampler(timesteps=args.steps), num_atoms, args.steps, device)
+        in_place = bench_in_place(Sampler(timesteps=args.steps), num_atoms, args.steps, device)
+        print(f"{num_atoms:>8} {legacy * 1e6:>18.1f} {in_place * 1e6:>20.1f} {legacy / in_place:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
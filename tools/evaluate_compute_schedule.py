@@ -0,0 +1,99 @@
+"""
+Quality/speed trade-off of the compute schedules (see grapharna.models.ComputeSchedule).
+Every structure is sampled with the full model and with each schedule, using the same seeds, so the per-structure
+random streams are identical and the RMSD to the full-model sample measures only the effect of the schedule.
+If the dataset contains the experimental coordinates, the RMSD to them is reported as well (--with-targets).
+
+python tools/evaluate_compute_schedule.py --dataset data/eval-pdb/5_segment --with-targets \
+    --schedules "0.6:knns=8,local=skip" "0.6:knns=8,local=skip,n_layer=3;0.3:local=pairs" --seeds 0 1
+"""
+import os
+import time
+import numpy as np
+import pandas as pd
+import torch
+from torch_geometric.loader import DataLoader
+
+from grapharna.datasets import RNAPDBDataset
+from grapharna.models import ComputeSchedule
+from grapharna.sample_rna_pdb import build_parser, load_model, set_seed
+from grapharna.utils import Sampler, kabsch_rmsd
+
+
+def timed_sample(sampler, model, data, seqs, name, seed, device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    sample = sampler.sample(model, seqs, data.clone(), names=name, seed=seed)[-1]
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    return sample, time.perf_counter() - start
+
+
+def rmsds(sample, reference):
+    # coordinates are stored in nm, RMSD is reported in Angstroms
+    out = []
+    for i in range(int(sample.batch.max()) + 1):
+        p = sample.x[sample.batch == i, :3].numpy() * 10
+        q = reference.x[reference.batch == i, :3].numpy() * 10
+        out.append(kabsch_rmsd(p, q))
+    return out
+
+
+def main():
+    parser = build_parser()
+    parser.add_argument('--schedules', type=str, nargs='+', required=True, help='Compute schedules to evaluate')
+    parser.add_argument('--seeds', type=int, nargs='+', default=[0], help='Seeds used for every structure')
+    parser.add_argument('--num-batches', type=int, default=None, help='Evaluate only the first batches of the dataset')
+    parser.add_argument('--with-targets', action='store_true', help='The dataset contains experimental coordinates')
+    parser.add_argument('--model-path', type=str, default="save/grapharna/model_800.h5", help='Model checkpoint')
+    parser.add_argument('--output', type=str, default="compute_schedules.csv", help='Output CSV file')
+    args = parser.parse_args()
+
+    set_seed(args.seeds[0])
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    model = load_model(args, args.model_path, device)
+    ds = RNAPDBDataset(os.path.dirname(args.dataset), name=os.path.basename(args.dataset), mode='coarse-grain')
+    loader = DataLoader(ds, batch_size=args.batch_size, shuffle=False)
+
+    schedules = {"full": None}
+    schedules.update({s: ComputeSchedule.parse(s, args.timesteps) for s in args.schedules})
+    samplers = {name: Sampler(timesteps=args.timesteps, compute_schedule=s) for name, s in schedules.items()}
+    seconds = {name: 0. for name in schedules}
+    to_full = {name: [] for name in schedules}
+    to_target = {name: [] for name in schedules}
+
+    for b, (data, name, seqs) in enumerate(loader):
+        if args.num_batches is not None and b >= args.num_batches:
+            break
+        data = data.to(device)
+        target = data.clone().cpu()
+        for seed in args.seeds:
+            reference = None
+            for schedule_name, sampler in samplers.items():
+                print(f"Batch {b}, seed {seed}, schedule {schedule_name}")
+                sample, elapsed = timed_sample(sampler, model, data, seqs, name, seed, device)
+                seconds[schedule_name] += elapsed
+                if reference is None:
+                    reference = sample
+                to_full[schedule_name].extend(rmsds(sample, reference))
+                if args.with_targets:
+                    to_target[schedule_name].extend(rmsds(sample, target))
+
+    rows = []
+    for schedule_name in schedules:
+        rows.append({
+            "schedule": schedule_name,
+            "seconds": seconds[schedule_name],
+            "speedup": seconds["full"] / seconds[schedule_name],
+            "rmsd_to_full": np.mean(to_full[schedule_name]),
+            "rmsd_to_target": np.mean(to_target[schedule_name]) if args.with_targets else np.nan,
+        })
+    df = pd.DataFrame(rows)
+    print(df.to_string(index=False))
+    df.to_csv(args.output, index=False)
+    print(f"Results stored in {args.output}")
+
+
+if __name__ == "__main__":
+    main()